@@ -2,6 +2,8 @@ import time
 import threading
 from functools import wraps
 
+from metrics import RATE_LIMIT_SLEEP
+
 # Rate limiter decorator
 class RateLimiter:
     def __init__(self, max_calls, period):
@@ -21,6 +23,7 @@ class RateLimiter:
                     sleep_time = self.period - (now - self.calls[0])
                     if sleep_time > 0:
                         print(f"{time.strftime('%Y-%m-%d %H:%M:%S')}: Rate limit reached. Sleeping for {sleep_time:.2f} seconds...")
+                        RATE_LIMIT_SLEEP.inc(sleep_time, limiter=func.__name__)
                         time.sleep(sleep_time)
                 
                 self.calls.append(time.time())
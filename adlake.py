@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import re
+import uuid
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from prompts import FACET_FIELDS
+
+PARTITIONING = ds.partitioning(pa.schema([('ingest_date', pa.string()), ('category', pa.string())]), flavor='hive')
+
+# Columns shared by raw and processed rows, read from a raw ad's snapshot
+AD_COLUMNS = [
+    ('ad_id', pa.string()),
+    ('page_id', pa.string()),
+    ('page_name', pa.string()),
+    ('title', pa.string()),
+    ('body', pa.string()),
+    ('cta_text', pa.string()),
+    ('cta_type', pa.string()),
+    ('display_format', pa.string()),
+    ('link_url', pa.string()),
+    ('start_date', pa.int64()),
+    ('end_date', pa.int64()),
+    ('total_active_time', pa.int64()),
+    ('page_like_count', pa.int64()),
+    ('keywords', pa.list_(pa.string())),
+    ('categories', pa.list_(pa.string())),
+]
+
+SCHEMAS = {
+    'raw': pa.schema(AD_COLUMNS + [
+        ('collected_at', pa.string()),
+        ('ad_json', pa.string()),
+    ]),
+    'processed': pa.schema(AD_COLUMNS + [
+        ('summary', pa.string()),
+        ('company_description', pa.string()),
+        ('thumbnail', pa.string()),
+        ('processed_at', pa.string()),
+    ] + [(field, pa.list_(pa.string()) if field == 'key_benefits' else pa.string()) for field in FACET_FIELDS]),
+}
+
+
+def _partition_value(value: Optional[str]) -> str:
+    """Category as a directory-safe partition value"""
+    value = re.sub(r'[^\w.-]+', '_', str(value or '').strip()).strip('_')
+    return value or 'uncategorized'
+
+
+def _int(value) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _str(value) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+
+def _strings(values) -> List[str]:
+    if values is None:
+        return []
+    if isinstance(values, str):
+        return [values]
+    return [str(value) for value in values]
+
+
+class AdLake:
+    """Columnar copy of raw and processed ads, as hive-partitioned Parquet datasets.
+
+    ``<root>/<table>/ingest_date=YYYY-MM-DD/category=<first category>/part-<id>.parquet``
+    for the tables ``raw`` (collected GraphQL ads, with the full ad as JSON in
+    ``ad_json``) and ``processed`` (enriched ad documents, flattened). Every
+    write adds new files, and rows are sorted by page so row-group statistics
+    let filters on page_id skip most of a file. ``scan`` prunes partitions and
+    pushes column filters down into the Parquet reader.
+
+    Re-collected or re-processed ads are written again under their new ingest
+    date; ``scan(..., latest=True)`` keeps the most recent row per ad.
+    """
+
+    def __init__(self, root: str = "lake", row_group_size: int = 64 * 1024):
+        self.root = root
+        self.row_group_size = row_group_size
+
+    def _rows(self, table: str, rows: List[Dict], ingest_date: Optional[str]) -> int:
+        if not rows:
+            return 0
+        ingest_date = ingest_date or date.today().isoformat()
+        by_category: Dict[str, List[Dict]] = {}
+        for row in rows:
+            by_category.setdefault(_partition_value(row['categories'][0] if row['categories'] else None), []).append(row)
+
+        for category, partition_rows in by_category.items():
+            directory = os.path.join(self.root, table, f"ingest_date={ingest_date}", f"category={category}")
+            os.makedirs(directory, exist_ok=True)
+            partition_rows.sort(key=lambda row: (row['page_id'] or '', row['ad_id'] or ''))
+            data = pa.Table.from_pylist(partition_rows, schema=SCHEMAS[table])
+            name = f"part-{uuid.uuid4().hex}.parquet"
+            # Written under a hidden name first, so scans never see a partial file
+            temp_path = os.path.join(directory, f".{name}.tmp")
+            pq.write_table(data, temp_path, row_group_size=self.row_group_size, compression='zstd')
+            os.replace(temp_path, os.path.join(directory, name))
+        logging.info(f"Wrote {len(rows)} {table} ads to {self.root} ({len(by_category)} partitions)")
+        return len(rows)
+
+    @staticmethod
+    def _ad_columns(page_data: Dict) -> Dict:
+        snapshot = page_data.get('snapshot', {}) or {}
+        return {
+            'ad_id': _str(page_data.get('ad_archive_id')),
+            'page_id': _str(snapshot.get('page_id') or page_data.get('page_id')),
+            'page_name': _str(snapshot.get('page_name') or page_data.get('page_name')),
+            'title': _str(snapshot.get('title')),
+            'body': _str((snapshot.get('body') or {}).get('text')),
+            'cta_text': _str(snapshot.get('cta_text')),
+            'cta_type': _str(snapshot.get('cta_type')),
+            'display_format': _str(snapshot.get('display_format')),
+            'link_url': _str(snapshot.get('link_url')),
+            'start_date': _int(page_data.get('start_date')),
+            'end_date': _int(page_data.get('end_date')),
+            'total_active_time': _int(page_data.get('total_active_time')),
+            'page_like_count': _int(snapshot.get('page_like_count')),
+            'keywords': _strings(page_data.get('keywords')),
+            'categories': _strings(page_data.get('categories')),
+        }
+
+    def write_raw(self, edges: Iterable[Dict], collected_at: str = None, ingest_date: str = None) -> int:
+        """Append collected GraphQL edges to the raw table"""
+        rows = []
+        for edge in edges:
+            page_data = edge['node']['collated_results'][0]
+            rows.append({
+                **self._ad_columns(page_data),
+                'collected_at': collected_at,
+                'ad_json': json.dumps(page_data, default=str),
+            })
+        return self._rows('raw', rows, ingest_date)
+
+    def write_processed(self, docs: Iterable[Dict], ingest_date: str = None) -> int:
+        """Append processed ad documents to the processed table"""
+        rows = []
+        for doc in docs:
+            ad_info, advertiser_info = doc.get('ad_info', {}), doc.get('advertiser_info', {})
+            rows.append({
+                'ad_id': _str(doc.get('ad_id')),
+                'page_id': _str(advertiser_info.get('page_id')),
+                'page_name': _str(advertiser_info.get('page_name')),
+                'title': _str(ad_info.get('title')),
+                'body': _str(ad_info.get('body')),
+                'cta_text': _str(ad_info.get('cta_text')),
+                'cta_type': _str(ad_info.get('cta_type')),
+                'display_format': _str(ad_info.get('display_format')),
+                'link_url': _str(ad_info.get('link_url')),
+                'start_date': _int(ad_info.get('start_date')),
+                'end_date': _int(ad_info.get('end_date')),
+                'total_active_time': _int(ad_info.get('total_active_time')),
+                'page_like_count': _int(advertiser_info.get('page_like_count')),
+                'keywords': _strings(doc.get('keywords')),
+                'categories': _strings(doc.get('categories')),
+                'summary': _str(doc.get('enriched_data')),
+                'company_description': _str(doc.get('company_description')),
+                'thumbnail': _str(doc.get('thumbnail')),
+                'processed_at': _str(doc.get('processed_at')),
+                **{field: _strings(doc.get(field)) if field == 'key_benefits' else _str(doc.get(field)) for field in FACET_FIELDS},
+            })
+        return self._rows('processed', rows, ingest_date)
+
+    def dataset(self, table: str) -> Optional[ds.Dataset]:
+        path = os.path.join(self.root, table)
+        if not os.path.isdir(path):
+            return None
+        schema = pa.unify_schemas([SCHEMAS[table], PARTITIONING.schema])
+        return ds.dataset(path, format='parquet', partitioning=PARTITIONING, schema=schema)
+
+    def counts(self) -> Dict[str, int]:
+        """Rows per table, from Parquet metadata"""
+        counts = {}
+        for table in SCHEMAS:
+            dataset = self.dataset(table)
+            counts[table] = dataset.count_rows() if dataset is not None else 0
+        return counts
+
+    def scan(self, table: str, columns: Sequence[str] = None, filters: List[tuple] = None, latest: bool = False) -> pd.DataFrame:
+        """Read a table into a DataFrame, pruning partitions and row groups with ``filters``
+
+        Args:
+            table (str): 'raw' or 'processed'
+            columns (list): Columns to read (default: all)
+            filters (list): (column, op, value) tuples ANDed together, e.g.
+                [('ingest_date', '>=', '2025-01-01'), ('cta_type', '=', 'SHOP_NOW')];
+                ops are those of pyarrow.parquet filters (=, !=, <, <=, >, >=, in, not in)
+            latest (bool): Keep only the most recently ingested row per ad
+        """
+        dataset = self.dataset(table)
+        if dataset is None:
+            return pd.DataFrame(columns=list(columns) if columns else SCHEMAS[table].names)
+        read_columns = list(columns) if columns else None
+        if latest and read_columns is not None:
+            read_columns += [column for column in ('ad_id', 'ingest_date') if column not in read_columns]
+        expression = pq.filters_to_expression(filters) if filters else None
+        frame = dataset.to_table(columns=read_columns, filter=expression).to_pandas()
+        if latest and not frame.empty:
+            frame = frame.sort_values('ingest_date', kind='stable').drop_duplicates('ad_id', keep='last').reset_index(drop=True)
+            if columns:
+                frame = frame[list(columns)]
+        return frame
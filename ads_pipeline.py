@@ -1,26 +1,42 @@
+import argparse
 import base64
+import hashlib
 import os
 import logging
 import sys
+import threading
 from urllib.parse import quote_plus
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne
 import time
 from dotenv import load_dotenv
 import pandas as pd
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Set
 from tqdm import tqdm
 import openai
 import anthropic
-import faiss
 import json
 from datetime import datetime
 import numpy as np
-import re
-import requests
-import io
-from PIL import Image
+from concurrent.futures import Future, ProcessPoolExecutor
 
 from meta import FacebookScraper
+from ads_search import AdsSearch
+from media import MediaFetcher
+from image_prep import prepare_image
+from creative_hash import CreativeIndex, text_hash
+from video_frames import VideoKeyframer
+from prompts import FACET_FIELDS, build_enrichment_request, parse_enrichment
+from mongo_indexes import ensure_indexes, remove_duplicate_ads
+from thumbnails import ThumbnailStore
+from llm_cache import CacheMiss, LLMCache, MongoCacheBackend, SQLiteCacheBackend
+from metrics import REGISTRY, STAGE_ERRORS, STAGE_ITEMS, retry_hook, tracked
+from profiling import Profiler, profile_stage
+from usage import BudgetExceeded, UsageMeter
+from adlake import AdLake
+from artifacts import StageArtifacts
+from vector_store import VectorStore
+from clustering import AdClusterer, index_vectors
+from neighbors import NeighborGraph
 from Logging import LoggingManager
 
 logging.basicConfig(
@@ -33,9 +49,20 @@ logging.basicConfig(
 )
 
 class AdsPipeline:
-    def __init__(self, openai_api_key: str = None, anthropic_api_key: str = None, mongo_uri: str = None, keywords_file: str = 'skincare_keywords.csv', use_proxy: bool = True, verbose: bool = False):
+    def __init__(self, openai_api_key: str = None, anthropic_api_key: str = None, mongo_uri: str = None, keywords_file: str = 'skincare_keywords.csv', use_proxy: bool = True, verbose: bool = False, replay: bool = False, llm_cache_backend: str = "sqlite", cache_only: bool = False, thumbnail_store: str = "local", budget_usd: float = None, lake_dir: str = None, index_dir: str = "vector_index", compact_every: int = 1000, graph_dir: str = "neighbor_graph", index_mode: str = "write"):
         self.logger = LoggingManager.setup_logging(verbose=verbose)
-        self.scraper = FacebookScraper(use_proxy=use_proxy)
+        self.scraper = FacebookScraper(use_proxy=use_proxy, replay=replay)
+        self.media = MediaFetcher(proxies=self.scraper.proxy_pool.get_proxy() if use_proxy else None)
+        self.keyframer = VideoKeyframer(proxies=self.scraper.proxy_pool.get_proxy() if use_proxy else None)
+        # Started on first use, so processes that never prepare images don't spawn workers
+        self._image_pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+        self.prepared_media: Dict[str, Future] = {}
+        # Ads whose creatives are downloaded ahead of the one being analysed
+        self.prefetch_ahead = 16
+        # URLs whose prepared image is still wanted: prefetched and not yet consumed
+        self.awaited_media: Set[str] = set()
+        self._media_lock = threading.Lock()
 
         self.openai = openai
         if openai_api_key:
@@ -44,14 +71,18 @@ class AdsPipeline:
             self.openai.api_key = os.getenv("OPENAI_API_KEY")
         else:
             raise ValueError("OpenAI API key must be provided either through constructor or OPENAI_API_KEY environment variable")
+        # Count the 429/5xx responses the SDKs retry internally
+        self.openai.http_client = openai.DefaultHttpxClient(event_hooks={'response': [retry_hook('openai')]})
         
         if anthropic_api_key:
             self.claude = anthropic.Anthropic(
                 api_key=anthropic_api_key,
+                http_client=anthropic.DefaultHttpxClient(event_hooks={'response': [retry_hook('anthropic')]}),
             )
         elif os.getenv("ANTHROPIC_API_KEY"):
             self.claude = anthropic.Anthropic(
                 api_key=os.getenv("ANTHROPIC_API_KEY"),
+                http_client=anthropic.DefaultHttpxClient(event_hooks={'response': [retry_hook('anthropic')]}),
             )
         else:
             raise ValueError("ANTHROPIC API key must be provided either through constructor or ANTHROPIC_API_KEY environment variable")
@@ -65,6 +96,19 @@ class AdsPipeline:
         self.client = MongoClient(self.mongo_uri)
         self.db = self.client["main"]
         self.collection = self.db["meta-ads-backup"]
+        self.creative_index = CreativeIndex(self.db["creative-hashes"])
+
+        if llm_cache_backend == "mongo":
+            cache_backend = MongoCacheBackend(self.db["llm-cache"])
+        else:
+            cache_backend = SQLiteCacheBackend()
+        self.llm_cache = LLMCache(cache_backend, cache_only=cache_only)
+        # Enrichment slows down near the budget and pauses before exceeding it
+        self.usage = UsageMeter(budget_usd=budget_usd)
+        self.thumbnails = ThumbnailStore(db=self.db if thumbnail_store == "gridfs" else None)
+        # Optional columnar copy of raw and processed ads for bulk analytics
+        self.lake = AdLake(lake_dir) if lake_dir else None
+        self.ensure_indexes()
             
         self.keywords_file = keywords_file
 
@@ -72,15 +116,49 @@ class AdsPipeline:
         self.processed_ads = []
         
         self.dimension = 1536
+        # New vectors go to a write-ahead log and are compacted into index generations.
+        # Only one process may write ('write'); others serve the published generation
+        # ('read') or, if they never search, skip loading it ('off').
+        self.vectors = VectorStore(index_dir, self.dimension)
+        self.compact_every = compact_every
+        self.index_mode = index_mode
+        if index_mode == 'write':
+            self.index, self.ad_ids = self.vectors.open()
+            self.logger.info(f"Loaded index generation {self.vectors.generation} with {self.index.ntotal} vectors")
+
+        # Precomputed nearest neighbours of every indexed ad, for more-like-this
+        self.neighbors = NeighborGraph(graph_dir)
+
+        if index_mode == 'write':
+            self.searcher = AdsSearch(index=self.index, ad_ids=self.ad_ids, collection=self.collection, embed=self.get_embedding, graph_dir=graph_dir)
+        else:
+            self.searcher = AdsSearch(index_dir=index_dir, collection=self.collection, embed=self.get_embedding, graph_dir=graph_dir)
+            self.index, self.ad_ids = (self.searcher.index, self.searcher.ad_ids) if index_mode == 'read' else (None, [])
+
+    def close(self):
+        """Stop the background pools and release the index writer lock"""
+        with self._pool_lock:
+            if self._image_pool is not None:
+                self._image_pool.shutdown(cancel_futures=True)
+                self._image_pool = None
+        self.media.close()
+        self.keyframer.close()
+        if self.index_mode == 'write':
+            self.vectors.close()
+
+    @property
+    def image_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._image_pool is None:
+                self._image_pool = ProcessPoolExecutor()
+            return self._image_pool
+
+    def ensure_indexes(self):
+        """Create and verify the MongoDB indexes used by search and faceted filtering"""
         try:
-            self.index = faiss.read_index("skincare_ads.index")
-            with open("ad_ids.json", "r") as f:
-                self.ad_ids = json.load(f)
-            self.logger.info(f"Loaded existing index with {self.index.ntotal} vectors")
-        except:
-            self.index = faiss.IndexFlatL2(self.dimension)
-            self.ad_ids = []
-            self.logger.info("Created new FAISS index")
+            ensure_indexes(self.collection)
+        except Exception as e:
+            self.logger.error(f"Error creating MongoDB indexes: {e}")
 
     def read_keywords_from_csv(self) -> List[Dict]:
         """Read keywords and their metadata from CSV file"""
@@ -101,40 +179,61 @@ class AdsPipeline:
             logging.error(f"Error reading keywords file: {str(e)}")
             return []
 
+    @tracked('collect')
     def collect_ads(self, keywords_data: List[Dict]):
-        pages = []
+        pages = {}
+        matches = 0
         for keyword_info in tqdm(keywords_data, desc="Searching pages"):
             try:
                 results = self.scraper.search_pages(query=keyword_info['Keyword'])
-                for page in results:
-                    page['keyword_info'] = keyword_info
-                    pages.append(page)
-            except:
+            except Exception as e:
                 self.logger.error(f"Error searching pages for {keyword_info['Keyword']}: {str(e)}")
                 continue
 
-        self.logger.info(f"Found {len(pages)} pages to process")
+            # Fetch each page once per run, remembering every keyword that matched it
+            for page in results:
+                matches += 1
+                page = pages.setdefault(page['page_id'], {**page, 'keyword_infos': []})
+                page['keyword_infos'].append(keyword_info)
 
-        for page in tqdm(pages, desc='Collecting Ads'):
+        self.logger.info(f"Found {len(pages)} unique pages to process ({matches} keyword matches)")
+
+        seen_ads = {ad['node']['collated_results'][0].get('ad_archive_id') for ad in self.full_ads}
+        collected_before = len(self.full_ads)
+        for page in tqdm(pages.values(), desc='Collecting Ads'):
             try:
-                page_id = page['page_id']
-                has_next_page = True
-                cursor = None
-                while has_next_page:
-                    ads = self.scraper.get_page_ads(page_id=page_id,active=False,country=['IN'],limit=30,cursor=cursor)
-                    next_page = ads['data']['ad_library_main']['search_results_connection']['page_info']
-                    cursor = next_page['end_cursor']
-                    has_next_page = next_page['has_next_page']
-
-                    self.full_ads.extend(ads['data']['ad_library_main']['search_results_connection']['edges'])
-                    logging.info(f'Got {len(ads)}')
-                    break
+                for edge in self.fetch_page_ads(page['page_id'], page['keyword_infos']):
+                    ad_id = edge['node']['collated_results'][0].get('ad_archive_id')
+                    if ad_id in seen_ads:
+                        continue
+                    seen_ads.add(ad_id)
+                    self.full_ads.append(edge)
             except Exception as e:
                 self.logger.error(f"Error collecting ads: {str(e)}")
 
+        STAGE_ITEMS.inc(len(self.full_ads), stage='collect')
+        if self.lake is not None:
+            try:
+                self.lake.write_raw(self.full_ads[collected_before:], collected_at=datetime.now().isoformat())
+            except Exception as e:
+                self.logger.error(f"Error writing raw ads to the lake: {e}")
         self.logger.info(f"Successfully collected {len(self.full_ads)} ads")
         return self.full_ads
 
+    def fetch_page_ads(self, page_id: str, keyword_infos: List[Dict]) -> List[Dict]:
+        """Fetch the first page of a page's ads, tagged with the keywords and categories that matched it"""
+        keywords = list(dict.fromkeys(info['Keyword'] for info in keyword_infos))
+        categories = list(dict.fromkeys(info['Category'] for info in keyword_infos))
+        ads = self.scraper.get_page_ads(page_id=page_id,active=False,country=['IN'],limit=30)
+        edges = ads['data']['ad_library_main']['search_results_connection']['edges']
+        for edge in edges:
+            for result in edge['node']['collated_results']:
+                result['keyword_info'] = keyword_infos
+                result['keywords'] = keywords
+                result['categories'] = categories
+        logging.info(f'Got {len(edges)} ads for page {page_id}')
+        return edges
+
     def clean_data(self, ad):
         """Clean invalid characters in ad data."""
         if isinstance(ad, str):
@@ -145,72 +244,71 @@ class AdsPipeline:
             return [self.clean_data(item) for item in ad]
         return ad
 
+    @tracked('mongo_write')
     def push_to_mongo(self):
         """Push data to MongoDB"""
         try:
             self.processed_ads = [self.clean_data(ad) for ad in tqdm(self.processed_ads, desc='Cleaning ads')]
             self.logger.debug(f"Pushing {len(self.processed_ads)} ads to MongoDB")
-            self.collection.insert_many(self.processed_ads)
+            # ad_id is unique, so re-processed ads replace their previous document
+            self.collection.bulk_write(
+                [ReplaceOne({'ad_id': ad['ad_id']}, ad, upsert=True) for ad in self.processed_ads],
+                ordered=False
+            )
+            STAGE_ITEMS.inc(len(self.processed_ads), stage='mongo_write')
             self.logger.info(f"Stored {len(self.processed_ads)} ads to MongoDB")
         except Exception as e:
+            STAGE_ERRORS.inc(stage='mongo_write')
             self.logger.error(f"MongoDB error: {e}")
 
-    def _compress_media(self, content, max_size_mb=5):
-        """ Compress media to fit within size limit """
+        if self.lake is not None:
+            try:
+                self.lake.write_processed(self.processed_ads)
+            except Exception as e:
+                self.logger.error(f"Error writing processed ads to the lake: {e}")
+
+    def _prefetch_media(self, urls):
+        """Download creatives in the background and hand each one to the image pool as it arrives"""
+        for url, download in self.media.prefetch(urls).items():
+            with self._media_lock:
+                self.awaited_media.add(url)
+            download.add_done_callback(lambda download, url=url: self._submit_prepare(url, download))
+
+    def _submit_prepare(self, url: str, download: Future):
+        # Cancelled when the ad was released before its creative arrived
+        if download.cancelled():
+            return
         try:
-            image = Image.open(io.BytesIO(content))
-            
-            compression_qualities = [85, 75, 65, 50]
-            for quality in compression_qualities:
-                buffer = io.BytesIO()
-                image.save(buffer, format='JPEG', quality=quality)
-                compressed_content = buffer.getvalue()
-                
-                if len(compressed_content) <= max_size_mb * 1024 * 1024:
-                    base64_data = base64.b64encode(compressed_content).decode('utf-8')
-                    return base64_data, 'image/jpeg'
-            
-            base_width = image.width
-            while base_width > 100:
-                base_width = int(base_width * 0.8)
-                resized_image = image.resize(
-                    (base_width, int(base_width * image.height / image.width)), 
-                    Image.LANCZOS
-                )
-                
-                buffer = io.BytesIO()
-                resized_image.save(buffer, format='JPEG', quality=65)
-                compressed_content = buffer.getvalue()
-                
-                if len(compressed_content) <= max_size_mb * 1024 * 1024:
-                    base64_data = base64.b64encode(compressed_content).decode('utf-8')
-                    return base64_data, 'image/jpeg'
-        
+            content, _ = download.result()
         except Exception as e:
-            self.logger.debug(f"Error compressing media: {e}")
-            return None, None
-
+            # prepare_media_from_url downloads the creative again if it is still wanted
+            self.logger.debug(f"Prefetching {url} failed: {e}")
+            return
+        if content is None:
+            return
+        # Skipped once prepare_media_from_url has taken over the URL, which can
+        # happen before this callback runs since Future wakes waiters first
+        with self._media_lock:
+            if url in self.awaited_media and url not in self.prepared_media:
+                self.prepared_media[url] = self.image_pool.submit(prepare_image, content)
+
+    @tracked('image_prepare')
     def prepare_media_from_url(self, url, max_size_mb=5):
-        """ Download and prepare media from a URL for Claude API """
+        """ Download and prepare media from a URL for Claude API, returning (data, media type, dHash) """
         if not url or url in ["Not Available", ""]:
-            return None, None
-        
-        try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            
-            media_type = response.headers.get('Content-Type', '')
-            
-            if len(response.content) > max_size_mb * 1024 * 1024:
-                return self._compress_media(response.content, media_type, max_size_mb)
-            
-            base64_data = base64.b64encode(response.content).decode('utf-8')
-            return base64_data, media_type
-        
-        except requests.RequestException as e:
-            self.logger.debug(f"Error downloading media: {e}")
-            return None, None
-
+            return None, None, None
+
+        with self._media_lock:
+            self.awaited_media.discard(url)
+            prepared = self.prepared_media.pop(url, None)
+        if prepared is None:
+            content, _ = self.media.get(url)
+            if content is None:
+                return None, None, None
+            prepared = self.image_pool.submit(prepare_image, content, max_size_mb=max_size_mb)
+        return prepared.result()
+
+    @tracked('company_description')
     def get_company_description(self, company_name: str) -> str:
         """Get company description using OpenAI"""
         prompt = f"""
@@ -224,86 +322,48 @@ class AdsPipeline:
         Keep the response concise and limited to 100 words.
         """
         
-        response = self.openai.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        
-        return response.choices[0].message.content.strip()
+        def describe():
+            self.usage.throttle('company_description')
+            response = self.openai.chat.completions.create(
+                model="gpt-4",
+                messages=[{"role": "user", "content": prompt}]
+            )
+            self.usage.record("gpt-4", 'company_description', response.usage)
+            return response.choices[0].message.content.strip()
 
-    def enrich_ad_data(self, ad: Dict, ad_creative: base64, media_type: str, keyword_info: str) -> Dict:
-        """Enrich ad data with additional analysis, considering keyword metadata"""
-        
-        prompt = f"""
-        Analyze the following skincare advertisement and its creative content in relation to the search keyword: {keyword_info}. Provide a structured evaluation that includes:
-
-        - The main features of the product being advertised.
-        - Visual elements analysis (imagery, colors, layout, text overlays).
-        - How the visual content supports the marketing message.
-        - How well the ad's target audience aligns with the search intent implied by the keyword.
-        - The key benefits of the product as emphasized in both text and visuals.
-        - Pricing information, including its positioning (e.g., affordable, premium) if mentioned.
-        - The marketing strategy or angle employed to appeal to potential customers.
-        - The relevance of both the advertisement's content and visuals to the specified search keyword.
-        
-        Ad Content:
-        {ad}
+        try:
+            return self.llm_cache.get_or_call("gpt-4", prompt, describe)
+        except CacheMiss:
+            return None
+
+    @tracked('enrich')
+    def enrich_ad_data(self, ad: Dict, ad_creative, media_type: str, keyword_info: str) -> Dict:
+        """Enrich ad data with additional analysis, considering keyword metadata
 
-        Analyze both the text content above and the provided image/video (if available) to give a comprehensive evaluation.
-        Ensure your analysis is concise, actionable, and aligned with the perspective of enhancing advertising effectiveness.
-        Provide your answer within <answer> tags.
+        Returns the summary prose plus the facet fields (price tier, product type,
+        key benefits, target audience, marketing angle), or None on failure.
         """
 
-        try:
+        # IMAGE ads carry one creative, VIDEO ads a list of sampled keyframes
+        creatives = ad_creative if isinstance(ad_creative, list) else [ad_creative] if ad_creative else []
 
-            if media_type == "IMAGE" and ad_creative:
-                message = self.claude.messages.create(
-                    model="claude-3-5-sonnet-20240620",
-                    max_tokens=8192,
-                    temperature=0,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": prompt
-                                },
-                                {
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": "image/jpeg",
-                                        "data": ad_creative
-                                    }
-                                }
-                            ]
-                        }
-                    ],
-                    extra_headers={
-                        "anthropic-beta": "max-tokens-3-5-sonnet-2024-07-15"
-                    }
-                )
-            else:
-                message = self.claude.messages.create(
-                    model="claude-3-5-sonnet-20240620",
-                    max_tokens=8192,
-                    temperature=0,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": prompt
-                                }
-                            ]
-                        }
-                    ],
-                    extra_headers={
-                        "anthropic-beta": "max-tokens-3-5-sonnet-2024-07-15"
-                    }
-                )
+        request = build_enrichment_request(ad, keyword_info, creatives, media_type)
+        image_hash = hashlib.sha256("".join(creatives).encode('utf-8')).hexdigest() if creatives else None
+
+        def analyse():
+            self.usage.throttle('enrich')
+            message = self.claude.messages.create(**request)
+            self.usage.record(request['model'], 'enrich', message.usage)
+            return message.content[0].text
+
+        try:
+            res = self.llm_cache.get_or_call(
+                request['model'],
+                [request['system'], request['messages'][0]['content'][-1], request['max_tokens']],
+                analyse,
+                image_hash=image_hash,
+                validate=lambda response: parse_enrichment(response) is not None,
+            )
             
             # response = self.openai.chat.completions.create(
             #     model="gpt-4",
@@ -312,16 +372,16 @@ class AdsPipeline:
             
             # return response.choices[0].message.content.strip()
 
-            res = str(message.content[0])
-            pattern = r"<answer>(.*?)</answer>"
-            match = re.search(pattern, res, re.DOTALL)
-            res = match.group(1).strip()
+            return parse_enrichment(res)
 
+        except BudgetExceeded:
+            raise
         except Exception as e:
+            STAGE_ERRORS.inc(stage='enrich')
             self.logger.debug(f"Error enriching ad - {e}")
+            return None
 
-        return res
-
+    @tracked('embedding')
     def get_embedding(self, text: str) -> List[float]:
         """Get embedding for text"""
         try:
@@ -332,8 +392,10 @@ class AdsPipeline:
                 input=text
             )
         except Exception as e:
+            STAGE_ERRORS.inc(stage='embedding')
             self.logger.debug(f"Error getting embedding - {e}")
             return None
+        self.usage.record("text-embedding-ada-002", 'embedding', response.usage)
         
         # Claude Embedding
         # response = self.claude.messages.create(
@@ -348,135 +410,405 @@ class AdsPipeline:
         # return response.content[0].text
         return response.data[0].embedding
     
-    def process_and_store(self) -> List[Dict]:
-        """Helper method to process a single ad"""
+    def _image_url(self, page_data: Dict) -> str:
+        """Original image URL of an IMAGE ad's creative"""
         try:
-            all_embeddings = []
-            for page in tqdm(self.full_ads, desc='Processing ads'):
-                page_data = page['node']["collated_results"][0]
-                company_desc = self.get_company_description(page_data['page_name'])
+            return page_data.get('snapshot', {}).get('images', [{'original_image_url': "Not Available"}])[0]['original_image_url']
+        except:
+            return "Not Available"
+
+    def _video_url(self, page_data: Dict) -> Optional[str]:
+        """SD video URL of a VIDEO ad's creative"""
+        try:
+            return page_data.get('snapshot', {}).get('videos', [])[0].get('video_sd_url')
+        except (IndexError, AttributeError):
+            return None
+
+    def prefetch_creatives(self, ads: List[Dict]):
+        """Download image creatives and extract video keyframes ahead of process_ad"""
+        self._prefetch_media(
+            self._image_url(ad) for ad in ads
+            if ad.get('snapshot', {}).get('display_format') == "IMAGE"
+        )
+        self.keyframer.prefetch(
+            self._video_url(ad) for ad in ads
+            if ad.get('snapshot', {}).get('display_format') == "VIDEO"
+        )
+
+    def release_creatives(self, page_data: Dict):
+        """Drop whatever was prefetched or prepared for an ad's creative and not consumed"""
+        url = self._image_url(page_data)
+        with self._media_lock:
+            self.awaited_media.discard(url)
+            prepared = self.prepared_media.pop(url, None)
+        if prepared is not None:
+            prepared.cancel()
+        self.media.discard(url)
+        self.keyframer.discard(self._video_url(page_data))
+
+    def process_ad(self, page_data: Dict) -> Optional[Dict]:
+        """Analyse one collected ad and build its MongoDB document; None if it couldn't be analysed
+
+        Raises BudgetExceeded once the LLM budget is spent.
+        """
+        try:
+            company_desc = self.get_company_description(page_data['page_name'])
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            # Optional context (already counted as a stage error); the ad is still worth analysing without it
+            self.logger.warning(f"Error describing {page_data.get('page_name')}: {e}")
+            company_desc = None
+        try:
+            media_type = page_data.get('snapshot', {}).get('display_format', "")
+            if media_type == "IMAGE":
+                ad_creative, _, creative_hash = self.prepare_media_from_url(self._image_url(page_data))
+            elif media_type == "VIDEO":
+                ad_creative, creative_hash = self.keyframer.keyframes(self._video_url(page_data))
+            else:
+                ad_creative, creative_hash = None, None
+
+            # Cards render from a small thumbnail (image or first video keyframe)
+            thumbnail = None
+            if ad_creative:
+                poster = ad_creative[0] if isinstance(ad_creative, list) else ad_creative
+                thumbnail = self.thumbnails.save(page_data.get('ad_archive_id', ""), base64.b64decode(poster))
+
+            # Advertisers re-run the same creative under many ad IDs; reuse its analysis
+            copy_hash = text_hash(page_data.get('snapshot', {}).get('title', ""), page_data.get('snapshot', {}).get('body', {}).get('text', ""))
+            enriched_ad = self.creative_index.lookup(creative_hash, copy_hash)
+            if enriched_ad is None:
+                enriched_ad = self.enrich_ad_data(page_data.get('snapshot', {}), ad_creative, media_type, ", ".join(page_data.get('keywords', [])) or "skincare")
+                if enriched_ad is None:
+                    self.logger.debug(f"Skipping ad {page_data.get('ad_archive_id', '')}: no analysis")
+                    return None
+                self.creative_index.add(page_data.get('ad_archive_id', ""), creative_hash, copy_hash, enriched_ad)
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            self.logger.debug(f"Error processing ad: {str(e)}")
+            return None
+
+        ad_info = {
+            'ad_id': page_data.get('ad_archive_id', ""),
+            'title': page_data.get('snapshot', {}).get('title', ""),
+            'body': page_data.get('snapshot', {}).get('body', {}).get('text', ""),
+            'cta_text': page_data.get('snapshot', {}).get('cta_text', ""),
+            'cta_type': page_data.get('snapshot', {}).get('cta_type', ""),
+            'caption': page_data.get('snapshot', {}).get('caption', {}),
+            'display_format': page_data.get('snapshot', {}).get('display_format', ""),
+            'link_description': page_data.get('snapshot', {}).get('link_description', ""),
+            'link_url': page_data.get('snapshot', {}).get('link_url', ""),
+            'images': page_data.get('snapshot', {}).get('images', []),
+            'videos': page_data.get('snapshot', {}).get('videos', []),
+            'start_date': page_data.get('start_date', None),
+            'end_date': page_data.get('end_date', None),
+            'total_active_time': page_data.get('total_active_time', None),
+            'spend': page_data.get('spend', None),
+        }
+
+        advertiser_info = {
+            'page_id': page_data.get('snapshot', {}).get('page_id', ""),
+            'page_name': page_data.get('snapshot', {}).get('page_name', ""),
+            'page_profile_picture_url': page_data.get('snapshot', {}).get('page_profile_picture_url', ""),
+            'page_profile_uri': page_data.get('snapshot', {}).get('page_profile_uri', ""),
+            'page_categories': page_data.get('snapshot', {}).get('page_categories', []),
+            'page_like_count': page_data.get('snapshot', {}).get('page_like_count', 0),
+            'country_iso_code': page_data.get('snapshot', {}).get('country_iso_code', None),
+        }
+
+        return {
+            'ad_id': page_data.get('ad_archive_id', ""),
+            'keyword_info': page_data.get('keyword_info', []),
+            'keywords': page_data.get('keywords', []),
+            'categories': page_data.get('categories', []),
+            'ad_info': ad_info,
+            'advertiser_info': advertiser_info,
+            'company_description': company_desc,
+            'enriched_data': enriched_ad['summary'],
+            'thumbnail': thumbnail,
+            **{field: enriched_ad[field] for field in FACET_FIELDS},
+            'processed_at': datetime.now().isoformat()
+        }
+
+    @staticmethod
+    def ad_text(ad: Dict) -> str:
+        """Text embedded for an ad document: title, body and analysis summary"""
+        return f"{ad['ad_info'].get('title', '')} {ad['ad_info'].get('body', '')} {ad['enriched_data']}"
+
+    def add_embeddings(self, embeddings: List[List[float]], ad_ids: List[str]):
+        """Append vectors and their ad IDs to the FAISS index, logging them to the WAL first"""
+        if self.index_mode != 'write':
+            raise RuntimeError(f"The index was opened with index_mode='{self.index_mode}'; only a 'write' pipeline can add to it")
+        if len(embeddings):
+            vectors = np.array(embeddings).astype('float32')
+            self.vectors.append(ad_ids, vectors)
+            self.index.add(vectors)
+            self.ad_ids.extend(ad_ids)
+            if self.vectors.wal_rows >= self.compact_every:
+                self.save_index()
+
+    def save_index(self):
+        """Publish vectors added since the last save as a new index generation"""
+        if self.index_mode == 'write':
+            self.vectors.compact()
+
+    def process_ads(self, ads: List[Dict]):
+        """Yield a document for each raw ad that could be analysed, stopping at the LLM budget"""
+        # Download creatives a bounded window ahead of the enrichment loop that consumes them
+        ahead = self.prefetch_ahead
+        self.prefetch_creatives(ads[:ahead])
+        spent_before = self.usage.spent()
+        done = 0
+        try:
+            for done, page_data in enumerate(tqdm(ads, desc='Processing ads')):
+                self.prefetch_creatives(ads[done + ahead:done + ahead + 1])
+                if done and done % 50 == 0:
+                    projected = self.usage.projection(done, len(ads) - done, spent_before)
+                    self.logger.info(f"LLM spend ${self.usage.spent():.2f}; projected ${projected:.2f} for this run")
+
                 try:
-                    media_type = page_data.get('snapshot', {}).get('display_format', "")
-                    if media_type == "IMAGE":
-                        try:
-                            image_url = page_data.get('snapshot', {}).get('images', [{'original_image_url': "Not Available"}])[0]['original_image_url']
-                        except:
-                            image_url = "Not Available"
-                        ad_creative, _ = self.prepare_media_from_url(image_url)
-                    else:
-                        ad_creative = None
-                    enriched_ad = self.enrich_ad_data(page_data.get('snapshot', {}), ad_creative, media_type, page_data.get('keyword_info', "skincare"))
-                    ad_text = f"{page_data.get('snapshot', {}).get('title', "")} {page_data.get('snapshot', {}).get('body', {}).get('text', "")} {enriched_ad}"
-                    embedding = self.get_embedding(ad_text)
-                    if embedding:
-                        all_embeddings.append(embedding)
-                        self.ad_ids.append(page_data.get('ad_archive_id', ""))
-                except Exception as e:
-                    self.logger.debug(f"Error processing ad: {str(e)}")
-                    continue
-
-                ad_info = {
-                    'ad_id': page_data.get('ad_archive_id', ""),
-                    'title': page_data.get('snapshot', {}).get('title', ""),
-                    'body': page_data.get('snapshot', {}).get('body', {}).get('text', ""),
-                    'cta_text': page_data.get('snapshot', {}).get('cta_text', ""),
-                    'cta_type': page_data.get('snapshot', {}).get('cta_type', ""),
-                    'caption': page_data.get('snapshot', {}).get('caption', {}),
-                    'display_format': page_data.get('snapshot', {}).get('display_format', ""),
-                    'link_description': page_data.get('snapshot', {}).get('link_description', ""),
-                    'link_url': page_data.get('snapshot', {}).get('link_url', ""),
-                    'images': page_data.get('snapshot', {}).get('images', []),
-                    'videos': page_data.get('snapshot', {}).get('videos', []),
-                    'start_date': page_data.get('start_date', None),
-                    'end_date': page_data.get('end_date', None),
-                    'total_active_time': page_data.get('total_active_time', None),
-                    'spend': page_data.get('spend', None),
-                }
-
-                advertiser_info = {
-                    'page_id': page_data.get('snapshot', {}).get('page_id', ""),
-                    'page_name': page_data.get('snapshot', {}).get('page_name', ""),
-                    'page_profile_picture_url': page_data.get('snapshot', {}).get('page_profile_picture_url', ""),
-                    'page_profile_uri': page_data.get('snapshot', {}).get('page_profile_uri', ""),
-                    'page_categories': page_data.get('snapshot', {}).get('page_categories', []),
-                    'page_like_count': page_data.get('snapshot', {}).get('page_like_count', 0),
-                    'country_iso_code': page_data.get('snapshot', {}).get('country_iso_code', None),
-                }
-
-                res = {
-                    'ad_id': page_data.get('ad_archive_id', ""),
-                    'keyword_info': page_data.get('keyword_info', {}),
-                    'ad_info': ad_info,
-                    'advertiser_info': advertiser_info,
-                    'company_description': company_desc,
-                    'enriched_data': enriched_ad,
-                    'processed_at': datetime.now().isoformat()
-                }
-                
+                    res = self.process_ad(page_data)
+                except BudgetExceeded as e:
+                    self.logger.warning(f"Pausing enrichment with {len(ads) - done} ads left: {e}")
+                    return
+                finally:
+                    # Creatives an ad didn't use (reused analysis, skipped ad) aren't kept around
+                    self.release_creatives(page_data)
+                if res is not None:
+                    yield res
+        finally:
+            # Ads still in the window when the loop stops early
+            for page_data in ads[done:done + ahead + 1]:
+                self.release_creatives(page_data)
+
+    def log_enrichment_stats(self):
+        self.logger.info(f"LLM cache: {self.llm_cache.hits} hits, {self.llm_cache.misses} misses")
+        self.logger.info(f"LLM spend: ${self.usage.spent():.4f}" + (f" of ${self.usage.budget_usd:.2f} budget" if self.usage.budget_usd is not None else ""))
+        self.logger.info(f"Creative reuse: {self.creative_index.hits} hits, {self.creative_index.misses} misses ({self.creative_index.hit_rate:.1%} hit rate)")
+
+    @tracked('process')
+    def process_and_store(self) -> List[Dict]:
+        """Analyse, embed and store every collected ad, then save the index"""
+        try:
+            for res in self.process_ads([page['node']["collated_results"][0] for page in self.full_ads]):
+                embedding = self.get_embedding(self.ad_text(res))
+                if embedding:
+                    self.add_embeddings([embedding], [res['ad_id']])
                 self.processed_ads.append(res)
                 
             self.push_to_mongo()
-
-            if all_embeddings:
-                embeddings_array = np.array(all_embeddings).astype('float32')
-                self.index.add(embeddings_array)
-            
-            faiss.write_index(self.index, "skincare_ads.index")
-            with open("ad_ids.json", "w") as f:
-                json.dump(self.ad_ids, f)
+            self.log_enrichment_stats()
+            self.save_index()
                 
             self.logger.info("Data processing and storage complete")
             return self.processed_ads
         except Exception as e:
             self.logger.error(f"Error processing page: {str(e)}")
             return []
-        
-    def search_ads(self, query: str, k: int = 10) -> List[Dict]:
-        """Search for relevant ads using query"""
 
-        if self.index.ntotal == 0:
-            self.logger.warning("Index is empty. Please build the index first.")
-            return []
-    
-        query_embedding = self.get_embedding(query)
-        
-        search_k = k * 2
-        
-        D, I = self.index.search(np.array([query_embedding]), search_k)
-        
-        with open("ad_ids.json", "r") as f:
-            ad_ids = json.load(f)
-
-        seen = set()
-        retrieved_ad_ids = []
-        for idx in I[0]:
-            if idx >= 0 and idx < len(ad_ids):
-                ad_id = ad_ids[idx]
-                if ad_id not in seen:
-                    seen.add(ad_id)
-                    retrieved_ad_ids.append(ad_id)
-            if len(retrieved_ad_ids) == k:
-                break
+    @tracked('process')
+    def enrich_collected(self, artifacts: StageArtifacts) -> int:
+        """Analyse collected ads not yet enriched, appending each document to the artifacts and MongoDB"""
+        done = artifacts.enriched_ids()
+        pending = [edge['node']['collated_results'][0] for edge in artifacts.read_collected() if artifacts.ad_id(edge) not in done]
+        self.logger.info(f"Enriching {len(pending)} ads ({len(done)} already enriched)")
+
+        enriched = 0
+        for res in self.process_ads(pending):
+            # Appended one by one so an interrupted run keeps what it paid for
+            artifacts.append_enriched([res])
+            self.processed_ads.append(res)
+            enriched += 1
+            if len(self.processed_ads) >= 100:
+                self.push_to_mongo()
+                self.processed_ads = []
+        if self.processed_ads:
+            self.push_to_mongo()
+            self.processed_ads = []
+        self.log_enrichment_stats()
+        return enriched
+
+    def embed_enriched(self, artifacts: StageArtifacts, batch_size: int = 100) -> int:
+        """Embed enriched ads not yet embedded, appending the vectors to the artifacts"""
+        done = artifacts.embedded_ids()
+        pending = [doc for doc in artifacts.read_enriched() if doc['ad_id'] not in done]
+        self.logger.info(f"Embedding {len(pending)} ads ({len(done)} already embedded)")
+
+        embedded = 0
+        vectors, ad_ids = [], []
+        for doc in tqdm(pending, desc='Embedding ads'):
+            embedding = self.get_embedding(self.ad_text(doc))
+            if embedding:
+                vectors.append(embedding)
+                ad_ids.append(doc['ad_id'])
+            if len(ad_ids) >= batch_size:
+                artifacts.append_embeddings(ad_ids, vectors)
+                embedded += len(ad_ids)
+                vectors, ad_ids = [], []
+        artifacts.append_embeddings(ad_ids, vectors)
+        embedded += len(ad_ids)
+        if embedded < len(pending):
+            self.logger.warning(f"{len(pending) - embedded} ads could not be embedded; re-run embed to retry them")
+        return embedded
+
+    def build_index(self, artifacts: StageArtifacts, rebuild: bool = False) -> int:
+        """Add embedded ads missing from the FAISS index (or all of them with rebuild) and save it"""
+        ad_ids, vectors = artifacts.read_embeddings()
+        if rebuild:
+            self.index.reset()
+            self.ad_ids.clear()
+            self.vectors.reset()
+        known = set(self.ad_ids)
+        rows = [row for row, ad_id in enumerate(ad_ids) if ad_id not in known and not known.add(ad_id)]
+        self.add_embeddings(vectors[rows], [ad_ids[row] for row in rows])
+        self.save_index()
+        self.logger.info(f"Indexed {len(rows)} new ads ({self.index.ntotal} total)")
+        return len(rows)
+
+    def cluster_ads(self, radius: float = 0.04, representatives_dir: str = None) -> Dict:
+        """Group the indexed ads into near-duplicate clusters and store them on the ad documents
+
+        With ``representatives_dir``, also publish an index holding one ad per cluster there.
+        """
+        self.save_index()
+        clusterer = AdClusterer(self.collection, radius=radius)
+        return clusterer.run(list(self.ad_ids), index_vectors(self.index), representatives_dir)
+
+    def update_neighbors(self, n_neighbors: int = None, rebuild: bool = False) -> int:
+        """Add ads indexed since the last update to the neighbour graph (recompute it all with rebuild)"""
+        if n_neighbors:
+            self.neighbors.n_neighbors = n_neighbors
+        if rebuild:
+            added = self.neighbors.build(list(self.ad_ids), index_vectors(self.index))
+        else:
+            added = self.neighbors.update(self.index, self.ad_ids)
+        self.logger.info(f"Added {added} ads to the neighbour graph ({self.neighbors.n_neighbors} neighbours each)")
+        return added
 
-        mongo_results = list(self.collection.find({'ad_id': {'$in': retrieved_ad_ids}}))
-        
-        results = []
-        for ad in mongo_results:
-            ad_id = ad['ad_id']
-            try:
-                index = retrieved_ad_ids.index(ad_id)
-                relevance_score = float(D[0][index])
-                ad['relevance_score'] = relevance_score
-                results.append(ad)
-            except ValueError:
-                continue
-        
-        results.sort(key=lambda x: x['relevance_score'], reverse=True)
-        
-        return results
+    def more_like_this(self, ad_id: str, k: int = 10) -> List[Dict]:
+        """Ads most similar to an indexed ad, from the neighbour graph"""
+        return self.searcher.more_like_this(ad_id, k=k)
+
+    def search_ads(self, query: str, k: int = 10, collapse: bool = False) -> List[Dict]:
+        """Search for relevant ads using query, optionally one result per near-duplicate cluster"""
+        return self.searcher.search(query, k=k, collapse=collapse)
             
+def run_stage(pipeline: AdsPipeline, artifacts: StageArtifacts, stage: str, args, profiler: Optional[Profiler] = None) -> bool:
+    """Run one CLI stage; False if it had nothing to work with"""
+    if stage == 'collect':
+        with profile_stage(profiler, 'read_keywords'):
+            keywords_data = pipeline.read_keywords_from_csv()
+        if not keywords_data:
+            logging.error("No keywords found. Please check your CSV file.")
+            return False
+        with profile_stage(profiler, 'collect'):
+            # Already-collected ads are kept; only new ones are added
+            pipeline.full_ads = artifacts.read_collected()
+            pipeline.collect_ads(keywords_data=keywords_data)
+            artifacts.write_collected(pipeline.full_ads)
+        logging.info(f"Wrote {len(pipeline.full_ads)} collected ads to {artifacts.collected_path}")
+    elif stage == 'enrich':
+        with profile_stage(profiler, 'enrich'):
+            enriched = pipeline.enrich_collected(artifacts)
+        logging.info(f"Enriched {enriched} ads into {artifacts.enriched_path}")
+    elif stage == 'embed':
+        with profile_stage(profiler, 'embed'):
+            embedded = pipeline.embed_enriched(artifacts)
+        logging.info(f"Embedded {embedded} ads into {artifacts.vectors_path}")
+    elif stage == 'index':
+        with profile_stage(profiler, 'index'):
+            pipeline.build_index(artifacts, rebuild=getattr(args, 'rebuild', False))
+    elif stage == 'cluster':
+        with profile_stage(profiler, 'cluster'):
+            summary = pipeline.cluster_ads(radius=args.radius, representatives_dir=args.representatives_dir)
+        logging.info(f"Clustered {summary['ads']} ads into {summary['clusters']} clusters")
+        print(json.dumps(summary, indent=2))
+    elif stage == 'neighbors':
+        with profile_stage(profiler, 'neighbors'):
+            pipeline.update_neighbors(n_neighbors=getattr(args, 'neighbors', None), rebuild=getattr(args, 'rebuild', False))
+    elif stage == 'similar':
+        for rank, ad in enumerate(pipeline.more_like_this(args.ad_id, k=args.k), 1):
+            print(f"{rank:>3}. {ad['ad_id']}  {ad['relevance_score']:.4f}  {ad.get('advertiser_info', {}).get('page_name', '')}: {ad.get('ad_info', {}).get('title') or ''}")
+    elif stage == 'search':
+        for rank, ad in enumerate(pipeline.search_ads(args.query, k=args.k, collapse=args.collapse), 1):
+            variants = f"  (+{ad['cluster_size'] - 1} variants)" if args.collapse and ad.get('cluster_size', 1) > 1 else ''
+            print(f"{rank:>3}. {ad['ad_id']}  {ad['relevance_score']:.4f}  {ad.get('advertiser_info', {}).get('page_name', '')}: {ad.get('ad_info', {}).get('title') or ''}{variants}")
+    elif stage == 'dedupe':
+        removed = remove_duplicate_ads(pipeline.collection, dry_run=args.dry_run)
+        if removed and not args.dry_run:
+            pipeline.ensure_indexes()
+    elif stage == 'evict-cache':
+        pipeline.llm_cache.evict()
+    elif stage == 'stats':
+        print(json.dumps({
+            'artifacts': artifacts.summary(),
+            'mongo_documents': pipeline.collection.estimated_document_count(),
+            'index_vectors': pipeline.index.ntotal,
+            'lake_rows': pipeline.lake.counts() if pipeline.lake is not None else None,
+        }, indent=2))
+    return True
+
+
+# Index access each stage needs; the full run and `index` write it
+STAGE_INDEX_MODES = {
+    'collect': 'off',
+    'enrich': 'off',
+    'embed': 'off',
+    'dedupe': 'off',
+    'evict-cache': 'off',
+    'neighbors': 'read',
+    'cluster': 'read',
+    'similar': 'read',
+    'search': 'read',
+    'stats': 'read',
+}
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Collect, enrich and index Meta ads')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port while the run is in progress')
+    parser.add_argument('--metrics-summary', default='metrics_summary.json', help='Write a JSON metrics summary to this file at the end of the run')
+    parser.add_argument('--profile', action='store_true', help='Profile each stage (CPU, wall-clock samples, allocations)')
+    parser.add_argument('--profile-dir', help='Directory for profiling reports (defaults to profiles/<timestamp>)')
+    parser.add_argument('--budget-usd', type=float, help='LLM spend ceiling for the run; enrichment slows near it and pauses before exceeding it')
+    parser.add_argument('--usage-summary', default='usage_summary.json', help='Write token and cost accounting to this file at the end of the run')
+    parser.add_argument('--artifacts-dir', default='artifacts', help='Directory for the stages\' intermediate outputs')
+    parser.add_argument('--keywords', default='skincare_keywords.csv', help='Keywords CSV file')
+    parser.add_argument('--lake-dir', default='lake', help='Parquet dataset receiving raw and processed ads (empty to disable)')
+    parser.add_argument('--llm-cache', choices=['sqlite', 'mongo'], default='sqlite', help='LLM response cache: local SQLite file or the shared main.llm-cache collection')
+    parser.add_argument('--cache-only', action='store_true', help='Only replay cached LLM responses; ads whose responses are not cached are skipped')
+    subparsers = parser.add_subparsers(dest='stage', help='Stage to run (default: collect, enrich, embed, index and neighbors in turn)')
+    subparsers.add_parser('run', help='Run collect, enrich, embed, index and neighbors in turn')
+    subparsers.add_parser('collect', help='Search pages for each keyword and save their ads')
+    subparsers.add_parser('enrich', help='Analyse collected ads and store them in MongoDB')
+    subparsers.add_parser('embed', help='Embed enriched ads')
+    index_parser = subparsers.add_parser('index', help='Add embedded ads to the FAISS index')
+    index_parser.add_argument('--rebuild', action='store_true', help='Rebuild the index from all embeddings')
+    neighbors_parser = subparsers.add_parser('neighbors', help='Add newly indexed ads to the similar-ads graph')
+    neighbors_parser.add_argument('-n', '--neighbors', type=int, help='Neighbours stored per ad (changing it rebuilds the graph)')
+    neighbors_parser.add_argument('--rebuild', action='store_true', help='Recompute every ad\'s neighbours')
+    similar_parser = subparsers.add_parser('similar', help='Ads most similar to an indexed ad, from the neighbour graph')
+    similar_parser.add_argument('ad_id')
+    similar_parser.add_argument('-k', type=int, default=10, help='Number of results')
+    search_parser = subparsers.add_parser('search', help='Search the index')
+    search_parser.add_argument('query')
+    search_parser.add_argument('-k', type=int, default=10, help='Number of results')
+    search_parser.add_argument('--collapse', action='store_true', help='Return one result per near-duplicate cluster')
+    cluster_parser = subparsers.add_parser('cluster', help='Group indexed ads into near-duplicate clusters')
+    cluster_parser.add_argument('--radius', type=float, default=0.04, help='Squared L2 distance within which ads are near-duplicates (0.04 = cosine 0.98)')
+    cluster_parser.add_argument('--representatives-dir', help='Also publish an index of one ad per cluster to this directory')
+    subparsers.add_parser('stats', help='Print artifact, MongoDB and index counts')
+    dedupe_parser = subparsers.add_parser('dedupe', help='Remove duplicate ad documents so the unique ad_id index can be built')
+    dedupe_parser.add_argument('--dry-run', action='store_true', help='Only log which documents would be removed')
+    subparsers.add_parser('evict-cache', help='Drop expired LLM cache entries and the oldest ones over the size limit')
+    args = parser.parse_args()
+    profiler = Profiler(args.profile_dir) if args.profile else None
+
     load_dotenv()
+    if args.metrics_port:
+        REGISTRY.serve(args.metrics_port)
+        logging.info(f"Serving metrics on :{args.metrics_port}/metrics")
         
     mongo_uri = os.getenv("MONGO_URI")
     openai_api_key = os.getenv("OPENAI_API_KEY")
@@ -486,21 +818,31 @@ def main():
         openai_api_key=openai_api_key,
         anthropic_api_key=anthropic_api_key,
         mongo_uri=mongo_uri,
-        keywords_file='skincare_keywords.csv',
+        keywords_file=args.keywords,
         use_proxy=True,
-        verbose=False
+        verbose=False,
+        budget_usd=args.budget_usd,
+        llm_cache_backend=args.llm_cache,
+        cache_only=args.cache_only,
+        lake_dir=args.lake_dir or None,
+        index_mode=STAGE_INDEX_MODES.get(args.stage, 'write'),
     )
+    artifacts = StageArtifacts(args.artifacts_dir, dimension=pipeline.dimension)
 
-    keywords_data = pipeline.read_keywords_from_csv()
-    if not keywords_data:
-        logging.error("No keywords found. Please check your CSV file.")
-        return
-    
-    ads = pipeline.collect_ads(keywords_data=keywords_data)
-    processed_ads = pipeline.process_and_store()
+    stages = ['collect', 'enrich', 'embed', 'index', 'neighbors'] if args.stage in (None, 'run') else [args.stage]
+    try:
+        for stage in stages:
+            if not run_stage(pipeline, artifacts, stage, args, profiler):
+                break
+    finally:
+        if profiler is not None:
+            profiler.close()
+        pipeline.close()
 
-    # search_results = pipeline.search_ads(query="best skin care products")
-    # print(len(search_results))
+    if args.stage not in ('search', 'similar', 'stats', 'cluster', 'dedupe', 'evict-cache'):
+        REGISTRY.write_summary(args.metrics_summary)
+        pipeline.usage.write_summary(args.usage_summary)
+        logging.info(f"Wrote metrics summary to {args.metrics_summary} and usage summary to {args.usage_summary}")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
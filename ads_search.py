@@ -0,0 +1,415 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics import CACHE_REQUESTS, record_usage, retry_hook, tracked
+from prompts import FACET_FIELDS
+
+# Fields needed to render a result card; details are fetched with get_ad on demand
+CARD_PROJECTION = {
+    '_id': 0,
+    'ad_id': 1,
+    'ad_info.title': 1,
+    'ad_info.body': 1,
+    'ad_info.display_format': 1,
+    'ad_info.images.original_image_url': 1,
+    'ad_info.videos.video_sd_url': 1,
+    'ad_info.total_active_time': 1,
+    'thumbnail': 1,
+    'advertiser_info.page_name': 1,
+    'advertiser_info.page_like_count': 1,
+    'cluster_id': 1,
+    'cluster_size': 1,
+    **{field: 1 for field in FACET_FIELDS},
+}
+
+
+class QueryCache:
+    """Thread-safe LRU of query -> ranked (ad_id, score) pairs, with a TTL.
+
+    Entries remember the index generation they were computed against and are
+    treated as misses once the searcher serves a different generation.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[Tuple, Tuple[object, float, List[Tuple[str, float]]]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(query: str, k: int, filters: Optional[Dict] = None, collapse: bool = False) -> Tuple:
+        normalized = re.sub(r'\s+', ' ', query).strip().lower()
+        facets = tuple(sorted(
+            (field, tuple(sorted(value)) if isinstance(value, (list, tuple, set)) else value)
+            for field, value in (filters or {}).items()
+        ))
+        return normalized, k, facets, collapse
+
+    def get(self, key: Tuple, generation) -> Optional[List[Tuple[str, float]]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != generation or time.time() - entry[1] > self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                CACHE_REQUESTS.inc(cache='query', result='miss')
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            CACHE_REQUESTS.inc(cache='query', result='hit')
+            return entry[2]
+
+    def put(self, key: Tuple, generation, ranked: List[Tuple[str, float]]):
+        with self.lock:
+            self.entries[key] = (generation, time.time(), ranked)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+# Shared by every searcher in the process, i.e. by all dashboard sessions
+QUERY_CACHE = QueryCache()
+
+
+class AdsSearch:
+    """Read-only search over the FAISS index and the MongoDB ad collection.
+
+    Everything heavy (faiss, numpy, openai, pymongo, the index file) is loaded on
+    first use, so constructing a searcher is free and it can be held as a
+    long-lived singleton by the dashboard. ``watch()`` keeps such a singleton
+    on the latest published index generation and neighbour graph.
+    """
+
+    def __init__(self, openai_api_key: str = None, mongo_uri: str = None, index_dir: str = "vector_index", index_path: str = "skincare_ads.index", ids_path: str = "ad_ids.json", graph_dir: str = "neighbor_graph", index=None, ad_ids: List[str] = None, collection=None, embed: Callable[[str], Optional[List[float]]] = None):
+        """
+        Args:
+            openai_api_key (str): Key for query embeddings (defaults to OPENAI_API_KEY)
+            mongo_uri (str): MongoDB URI (defaults to MONGO_URI)
+            index_dir (str): VectorStore directory; its current generation is served
+            index_path (str): Single-file FAISS index, used when index_dir has no generation yet
+            ids_path (str): JSON list mapping index_path's rows to ad IDs
+            graph_dir (str): NeighborGraph directory answering more_like_this
+            index, ad_ids, collection, embed: Already-built components to reuse
+                instead of loading them (used by AdsPipeline)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.openai_api_key = openai_api_key or os.getenv("OPENAI_API_KEY")
+        self.mongo_uri = mongo_uri or os.getenv("MONGO_URI")
+        self.index_dir = index_dir
+        self.index_path = index_path
+        self.ids_path = ids_path
+        self.graph_dir = graph_dir
+
+        # (index, ad_ids, stamp) being served. Replaced as a whole when a new
+        # generation is loaded, so a query never pairs one generation's index
+        # with another's IDs, and queries already running finish on the old one.
+        self._serving = (index, ad_ids if ad_ids is not None else [], 0) if index is not None else None
+        # Components handed in by AdsPipeline are updated in place by their owner
+        self._owned = index is not None
+        # Published neighbour graph, replaced as a whole like _serving
+        self._graph = None
+        self._collection = collection
+        self._embed = embed
+        self._openai = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self._stop_watching = threading.Event()
+        self.query_cache = QUERY_CACHE
+
+    def _snapshot(self) -> Tuple[object, List[str], object]:
+        serving = self._serving
+        if serving is None:
+            with self._lock:
+                if self._serving is None:
+                    self._serving = self._load_initial()
+                serving = self._serving
+        return serving
+
+    @property
+    def index(self):
+        return self._snapshot()[0]
+
+    @property
+    def ad_ids(self) -> List[str]:
+        return self._snapshot()[1]
+
+    def _latest_stamp(self):
+        """The newest index on disk: the store's current manifest, else the index file's mtime"""
+        from vector_store import VectorStore
+
+        current = VectorStore(self.index_dir).current()
+        if current is not None:
+            return current
+        try:
+            return os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load_index(self, stamp) -> Tuple[object, List[str], object]:
+        import faiss
+        from vector_store import VectorStore
+
+        if isinstance(stamp, str):
+            index, ad_ids, _ = VectorStore(self.index_dir).load_generation(stamp)
+        else:
+            index = faiss.read_index(self.index_path)
+            with open(self.ids_path, "r") as f:
+                ad_ids = json.load(f)
+        self.logger.info(f"Loaded search index {stamp} with {index.ntotal} vectors")
+        return index, ad_ids, stamp
+
+    def _load_initial(self) -> Tuple[object, List[str], object]:
+        import faiss
+
+        try:
+            return self._load_index(self._latest_stamp())
+        except Exception as e:
+            self.logger.warning(f"Could not load search index: {e}")
+            return faiss.IndexFlatL2(1536), [], None
+
+    @tracked('index_reload')
+    def reload(self) -> bool:
+        """Switch to a newer index generation if one was published; True if it switched
+
+        The new generation is loaded while the current one keeps serving, and
+        the switch is a single reference swap, so no query waits on the load.
+        """
+        if self._owned:
+            return False
+        with self._reload_lock:
+            stamp = self._latest_stamp()
+            serving = self._serving
+            if stamp is None or (serving is not None and serving[2] == stamp):
+                return False
+            self._serving = self._load_index(stamp)
+        return True
+
+    def reload_graph(self) -> bool:
+        """Switch to a newer neighbour graph if one was published; True if it switched"""
+        from neighbors import NeighborGraph
+
+        graph = NeighborGraph(self.graph_dir)
+        with self._reload_lock:
+            current = graph.current()
+            if current is None or (self._graph is not None and self._graph.name == current):
+                return False
+            self._graph = graph.load(current)
+        self.logger.info(f"Loaded neighbour graph {current} with {len(self._graph.ad_ids)} ads")
+        return True
+
+    def watch(self, interval: float = 5.0):
+        """Check for new index generations and neighbour graphs every ``interval`` seconds from a daemon thread"""
+        if self._watcher is not None:
+            return
+        self._stop_watching.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True, name="index-watcher")
+        self._watcher.start()
+
+    def _watch(self, interval: float):
+        while not self._stop_watching.wait(interval):
+            try:
+                self.reload()
+                self.reload_graph()
+            except Exception as e:
+                # e.g. the generation was garbage-collected mid-load; keep serving and retry
+                self.logger.warning(f"Index reload failed: {e}")
+
+    def stop_watching(self):
+        self._stop_watching.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    @staticmethod
+    def _generation(serving) -> Tuple[object, int]:
+        return serving[2], serving[0].ntotal
+
+    @property
+    def generation(self) -> Tuple[object, int]:
+        """Identifies the index contents currently being served"""
+        return self._generation(self._snapshot())
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            with self._lock:
+                if self._collection is None:
+                    from pymongo import MongoClient
+
+                    if not self.mongo_uri:
+                        raise ValueError("Mongo URI must be provided either through constructor or MONGO_URI environment variable")
+                    self._collection = MongoClient(self.mongo_uri)["main"]["meta-ads-backup"]
+        return self._collection
+
+    def get_embedding(self, text: str) -> Optional[List[float]]:
+        """Get embedding for a search query"""
+        if self._embed is not None:
+            return self._embed(text)
+
+        if self._openai is None:
+            import openai
+
+            self._openai = openai.OpenAI(
+                api_key=self.openai_api_key,
+                http_client=openai.DefaultHttpxClient(event_hooks={'response': [retry_hook('openai')]})
+            )
+        try:
+            response = self._openai.embeddings.create(
+                model="text-embedding-ada-002",
+                input=text
+            )
+        except Exception as e:
+            self.logger.debug(f"Error getting embedding - {e}")
+            return None
+        record_usage("text-embedding-ada-002", 'search_embedding', response.usage)
+        return response.data[0].embedding
+
+    @staticmethod
+    def facet_query(filters: Optional[Dict] = None) -> Dict:
+        """MongoDB filter for {facet field: value or list of accepted values}"""
+        query = {}
+        for field, value in (filters or {}).items():
+            if field not in FACET_FIELDS:
+                raise ValueError(f"Unknown facet field: {field}")
+            if isinstance(value, (list, tuple, set)):
+                if value:
+                    query[field] = {'$in': list(value)}
+            elif value is not None:
+                query[field] = value
+        return query
+
+    def facet_counts(self, field: str, filters: Optional[Dict] = None) -> List[Tuple[str, int]]:
+        """Number of ads per value of a facet field, most common first"""
+        if field not in FACET_FIELDS:
+            raise ValueError(f"Unknown facet field: {field}")
+        pipeline = [{'$match': self.facet_query(filters)}]
+        if field == 'key_benefits':
+            pipeline.append({'$unwind': '$key_benefits'})
+        pipeline += [
+            {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1}},
+        ]
+        return [(doc['_id'], doc['count']) for doc in self.collection.aggregate(pipeline) if doc['_id'] is not None]
+
+    def filter_ads(self, filters: Dict, limit: int = 30) -> List[Dict]:
+        """Ads matching facet filters, answered from the MongoDB indexes alone"""
+        return list(self.collection.find(self.facet_query(filters), CARD_PROJECTION).limit(limit))
+
+    def thumbnail(self, ref: Optional[str]) -> Optional[bytes]:
+        """Thumbnail bytes for a card's 'thumbnail' reference"""
+        from thumbnails import GRIDFS_PREFIX, load_thumbnail
+
+        if ref and ref.startswith(GRIDFS_PREFIX):
+            return load_thumbnail(ref, self.collection.database)
+        return load_thumbnail(ref)
+
+    def get_ad(self, ad_id: str) -> Optional[Dict]:
+        """Full stored document for one ad, for an expanded card"""
+        return self.collection.find_one({'ad_id': ad_id}, {'_id': 0})
+
+    def cluster_members(self, cluster_id: str, limit: int = 30) -> List[Dict]:
+        """Cards of the near-duplicate ads grouped under a cluster, representative first"""
+        members = list(self.collection.find({'cluster_id': cluster_id}, CARD_PROJECTION).limit(limit))
+        return sorted(members, key=lambda ad: ad['ad_id'] != cluster_id)
+
+    @tracked('more_like_this')
+    def more_like_this(self, ad_id: str, k: int = 10) -> List[Dict]:
+        """Cards of the ads most similar to ``ad_id``, closest first, from the materialized neighbour graph
+
+        A row lookup plus one MongoDB fetch: no embedding call and no index
+        search. Ads added since the graph was last updated have no neighbours yet.
+        """
+        if self._graph is None:
+            try:
+                self.reload_graph()
+            except Exception as e:
+                self.logger.warning(f"Could not load neighbour graph: {e}")
+        graph = self._graph
+        if graph is None:
+            return []
+        return self._cards(graph.similar(ad_id, k))
+
+    @tracked('search')
+    def search(self, query: str, k: int = 10, filters: Optional[Dict] = None, collapse: bool = False) -> List[Dict]:
+        """Search for relevant ads using query, closest (lowest L2 distance) first
+
+        With ``collapse``, near-duplicate ads (same ``cluster_id``) are returned
+        once, as their best-ranked member; its ``cluster_size`` tells how many
+        variants it stands for. Rankings are served from the process-wide query
+        cache when the same query was answered recently against the same index
+        generation.
+        """
+        serving = self._snapshot()
+        generation = self._generation(serving)
+        key = self.query_cache.key(query, k, filters, collapse)
+        ranked = self.query_cache.get(key, generation)
+        if ranked is not None:
+            return self._cards(ranked)
+
+        results = self._search(query, k, filters, serving, collapse)
+        if results is None:
+            return []
+        self.query_cache.put(key, generation, [(ad['ad_id'], ad['relevance_score']) for ad in results])
+        return results
+
+    def _cards(self, ranked: List[Tuple[str, float]]) -> List[Dict]:
+        """Card documents for a cached ranking, in ranked order"""
+        scores = dict(ranked)
+        cards = {}
+        for ad in self.collection.find({'ad_id': {'$in': list(scores)}}, CARD_PROJECTION):
+            ad['relevance_score'] = scores[ad['ad_id']]
+            cards[ad['ad_id']] = ad
+        return [cards[ad_id] for ad_id, _ in ranked if ad_id in cards]
+
+    def _search(self, query: str, k: int, filters: Optional[Dict], serving, collapse: bool = False) -> Optional[List[Dict]]:
+        """Embed, search FAISS and fetch cards; None if the query couldn't be embedded
+
+        Facet filters are applied in MongoDB and clusters are collapsed after
+        the cards are fetched, so a wider candidate set is pulled from FAISS
+        for either.
+        """
+        import numpy as np
+
+        index, ad_ids, _ = serving
+        if index.ntotal == 0:
+            self.logger.warning("Index is empty. Please build the index first.")
+            return []
+
+        query_embedding = self.get_embedding(query)
+        if query_embedding is None:
+            return None
+
+        facets = self.facet_query(filters)
+        candidates = k * 10 if facets else k
+        if collapse:
+            candidates *= 5
+        D, I = index.search(np.array([query_embedding], dtype='float32'), candidates * 2)
+
+        scores = {}
+        for distance, idx in zip(D[0], I[0]):
+            if 0 <= idx < len(ad_ids) and ad_ids[idx] not in scores:
+                scores[ad_ids[idx]] = float(distance)
+            if len(scores) == candidates:
+                break
+
+        results = {}
+        for ad in self.collection.find({'ad_id': {'$in': list(scores)}, **facets}, CARD_PROJECTION):
+            if ad['ad_id'] not in results:
+                ad['relevance_score'] = scores[ad['ad_id']]
+                results[ad['ad_id']] = ad
+
+        ranked = sorted(results.values(), key=lambda x: x['relevance_score'])
+        if collapse:
+            # Ads indexed since the last clustering run count as their own cluster
+            clusters = set()
+            ranked = [ad for ad in ranked if (ad.get('cluster_id') or ad['ad_id']) not in clusters and not clusters.add(ad.get('cluster_id') or ad['ad_id'])]
+        return ranked[:k]
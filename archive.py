@@ -0,0 +1,156 @@
+import gzip
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
+
+
+class ResponseArchive:
+    """Append-only archive of raw GraphQL responses in rotating gzip JSONL segments"""
+
+    SEGMENT_PREFIX = "segment-"
+    SEGMENT_SUFFIX = ".jsonl.gz"
+
+    def __init__(self, archive_dir: str = "data/archive", max_segment_mb: int = 64):
+        """
+        Open (or create) a response archive.
+
+        Every record is written as its own gzip member, so a record can be read back
+        by seeking straight to its offset without decompressing the whole segment.
+        The index (``index.jsonl``) maps (kind, key, cursor) to (segment, offset).
+        Appends take an exclusive lock on ``LOCK``, so several processes (e.g.
+        distributed workers) can share one archive directory. The index is
+        loaded on the first lookup, so scrapers that never replay don't read it.
+
+        Args:
+            archive_dir (str): Directory holding the segments and the index
+            max_segment_mb (int): Segment size after which a new segment is started
+        """
+        self.archive_dir = archive_dir
+        self.max_segment_bytes = max_segment_mb * 1024 * 1024
+        self.index_path = os.path.join(archive_dir, "index.jsonl")
+        self.lock_path = os.path.join(archive_dir, "LOCK")
+        self.lock = threading.Lock()
+        self._index: Optional[Dict[Tuple[str, str, Optional[str]], Tuple[str, int]]] = None
+
+        os.makedirs(archive_dir, exist_ok=True)
+        self.segment = self._latest_segment()
+
+    @property
+    def index(self) -> Dict[Tuple[str, str, Optional[str]], Tuple[str, int]]:
+        """(kind, key, cursor) -> (segment, offset), loaded on first use"""
+        with self.lock:
+            if self._index is None:
+                self._index = self._load_index()
+            return self._index
+
+    def _load_index(self) -> Dict[Tuple[str, str, Optional[str]], Tuple[str, int]]:
+        """Read the on-disk index, keeping the latest record for every key"""
+        index = {}
+        if not os.path.exists(self.index_path):
+            return index
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from an interrupted write
+                    continue
+                key = (entry['kind'], entry['key'], entry.get('cursor'))
+                index[key] = (entry['segment'], entry['offset'])
+        logging.info(f"Loaded response archive index with {len(index)} entries")
+        return index
+
+    def _segments(self):
+        return sorted(
+            name for name in os.listdir(self.archive_dir)
+            if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX)
+        )
+
+    def _latest_segment(self) -> str:
+        segments = self._segments()
+        if segments:
+            return segments[-1]
+        return f"{self.SEGMENT_PREFIX}00001{self.SEGMENT_SUFFIX}"
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock on the archive directory across processes"""
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _rotate_if_needed(self):
+        path = os.path.join(self.archive_dir, self.segment)
+        if os.path.exists(path) and os.path.getsize(path) >= self.max_segment_bytes:
+            number = int(self.segment[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]) + 1
+            self.segment = f"{self.SEGMENT_PREFIX}{number:05d}{self.SEGMENT_SUFFIX}"
+            logging.info(f"Rotated response archive to {self.segment}")
+
+    def append(self, kind: str, key: str, response_text: str, cursor: Optional[str] = None):
+        """Archive a raw response under (kind, key, cursor)"""
+        record = {
+            'kind': kind,
+            'key': str(key),
+            'cursor': cursor,
+            'fetched_at': datetime.now().isoformat(),
+            'response': response_text,
+        }
+        payload = gzip.compress((json.dumps(record) + "\n").encode('utf-8'))
+
+        with self.lock, self._locked():
+            # Other processes may have appended to or rotated the segment since our last write
+            self.segment = max(self.segment, self._latest_segment())
+            self._rotate_if_needed()
+            path = os.path.join(self.archive_dir, self.segment)
+            with open(path, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(payload)
+
+            entry = {'kind': kind, 'key': str(key), 'cursor': cursor, 'segment': self.segment, 'offset': offset}
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+            # Not loaded yet: the entry is picked up from index.jsonl on first lookup
+            if self._index is not None:
+                self._index[(kind, str(key), cursor)] = (self.segment, offset)
+
+    def _read_record(self, segment: str, offset: int) -> Dict:
+        with open(os.path.join(self.archive_dir, segment), 'rb') as f:
+            f.seek(offset)
+            with gzip.GzipFile(fileobj=f) as member:
+                return json.loads(member.readline())
+
+    def lookup(self, kind: str, key: str, cursor: Optional[str] = None) -> Optional[str]:
+        """Return the latest archived response text for (kind, key, cursor), or None"""
+        location = self.index.get((kind, str(key), cursor))
+        if location is None:
+            return None
+        try:
+            return self._read_record(*location)['response']
+        except (OSError, EOFError, json.JSONDecodeError) as e:
+            logging.error(f"Corrupt archive record for {kind}/{key}: {str(e)}")
+            return None
+
+    def records(self, kind: Optional[str] = None) -> Iterator[Dict]:
+        """Iterate over every archived record in write order, optionally filtered by kind"""
+        for segment in self._segments():
+            with gzip.open(os.path.join(self.archive_dir, segment), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if kind is None or record['kind'] == kind:
+                        yield record
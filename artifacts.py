@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+
+
+class VectorLog:
+    """Append-only float32 vectors (``<path>.f32``) and their ad IDs (``<path>.ids``), row by row.
+
+    Vectors are written before their IDs and a row only counts once its ID line
+    is complete, so an interrupted append is cut back on the next write. With
+    ``durable`` every append is fsync'd before it returns.
+    """
+
+    def __init__(self, path: str, dimension: int = 1536, durable: bool = False):
+        self.vectors_path = f"{path}.f32"
+        self.ids_path = f"{path}.ids"
+        self.dimension = dimension
+        self.durable = durable
+        self.rows = None
+
+    def append(self, ad_ids: List[str], vectors: List[List[float]]):
+        """Append vectors, then their IDs"""
+        if not len(ad_ids):
+            return
+        if self.rows is None:
+            self._repair()
+        for path, data in ((self.vectors_path, np.asarray(vectors, dtype='float32').tobytes()),
+                           (self.ids_path, "".join(f"{ad_id}\n" for ad_id in ad_ids).encode('utf-8'))):
+            with open(path, "ab") as f:
+                f.write(data)
+                if self.durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+        self.rows += len(ad_ids)
+
+    def _repair(self):
+        """Cut both files back to their last complete row after an interrupted append"""
+        ad_ids, _ = self.read()
+        self.rows = len(ad_ids)
+        if os.path.exists(self.vectors_path):
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(self.rows * self.dimension * 4)
+        if os.path.exists(self.ids_path) and os.path.getsize(self.ids_path) != sum(len(ad_id.encode('utf-8')) + 1 for ad_id in ad_ids):
+            with open(self.ids_path, "w", encoding="utf-8") as f:
+                f.write("".join(f"{ad_id}\n" for ad_id in ad_ids))
+
+    def read(self) -> Tuple[List[str], np.ndarray]:
+        """Ad IDs and their vectors (an (n, dimension) float32 array)"""
+        if not os.path.exists(self.ids_path):
+            return [], np.zeros((0, self.dimension), dtype='float32')
+        with open(self.ids_path, "r", encoding="utf-8") as f:
+            ad_ids = [line.rstrip("\n") for line in f if line.endswith("\n")]
+        vectors = np.fromfile(self.vectors_path, dtype='float32') if os.path.exists(self.vectors_path) else np.zeros(0, dtype='float32')
+        rows = min(len(ad_ids), len(vectors) // self.dimension)
+        if rows < len(ad_ids):
+            logging.warning(f"{len(ad_ids) - rows} vector IDs in {self.ids_path} have no vector; ignoring them")
+        return ad_ids[:rows], vectors[:rows * self.dimension].reshape(rows, self.dimension)
+
+    def remove(self):
+        for path in (self.vectors_path, self.ids_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.rows = 0
+
+
+class StageArtifacts:
+    """Durable outputs of each pipeline stage, so a stage can be re-run without repeating the ones before it.
+
+    - ``collected.jsonl``: raw ads from ``collect``, one GraphQL edge per line
+    - ``enriched.jsonl``: ad documents from ``enrich`` (also stored in MongoDB)
+    - ``embeddings.f32`` / ``embeddings.ids``: float32 vectors from ``embed`` and their ad IDs, row by row
+
+    ``enrich`` and ``embed`` append as they go and skip ads already in their
+    output, so an interrupted stage resumes where it stopped.
+    """
+
+    def __init__(self, directory: str = "artifacts", dimension: int = 1536):
+        self.directory = directory
+        self.dimension = dimension
+        os.makedirs(directory, exist_ok=True)
+        self.collected_path = os.path.join(directory, "collected.jsonl")
+        self.enriched_path = os.path.join(directory, "enriched.jsonl")
+        self.embeddings = VectorLog(os.path.join(directory, "embeddings"), dimension)
+        self.vectors_path = self.embeddings.vectors_path
+        self.vector_ids_path = self.embeddings.ids_path
+
+    @staticmethod
+    def _read_jsonl(path: str) -> Iterable[Dict]:
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A run killed mid-write leaves a truncated last line
+                    logging.warning(f"Skipping unreadable line {number} of {path}")
+
+    @staticmethod
+    def ad_id(edge: Dict) -> str:
+        return edge['node']['collated_results'][0].get('ad_archive_id')
+
+    def write_collected(self, edges: List[Dict]):
+        """Replace the collected ads atomically"""
+        temp_path = f"{self.collected_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for edge in edges:
+                f.write(json.dumps(edge, default=str) + "\n")
+        os.replace(temp_path, self.collected_path)
+
+    def read_collected(self) -> List[Dict]:
+        return list(self._read_jsonl(self.collected_path))
+
+    def append_enriched(self, docs: List[Dict]):
+        with open(self.enriched_path, "a", encoding="utf-8") as f:
+            for doc in docs:
+                f.write(json.dumps({k: v for k, v in doc.items() if k != '_id'}, default=str) + "\n")
+
+    def read_enriched(self) -> List[Dict]:
+        """Enriched documents, the latest one per ad"""
+        docs = {}
+        for doc in self._read_jsonl(self.enriched_path):
+            docs[doc['ad_id']] = doc
+        return list(docs.values())
+
+    def enriched_ids(self) -> Set[str]:
+        return {doc['ad_id'] for doc in self._read_jsonl(self.enriched_path)}
+
+    def append_embeddings(self, ad_ids: List[str], vectors: List[List[float]]):
+        self.embeddings.append(ad_ids, vectors)
+
+    def read_embeddings(self) -> Tuple[List[str], np.ndarray]:
+        """Ad IDs and their vectors (an (n, dimension) float32 array)"""
+        return self.embeddings.read()
+
+    def embedded_ids(self) -> Set[str]:
+        return set(self.read_embeddings()[0])
+
+    def summary(self) -> Dict:
+        def size(path):
+            return os.path.getsize(path) if os.path.exists(path) else 0
+
+        return {
+            'collected': sum(1 for _ in self._read_jsonl(self.collected_path)),
+            'enriched': len(self.enriched_ids()),
+            'embedded': len(self.embedded_ids()),
+            'bytes': {os.path.basename(path): size(path) for path in
+                      (self.collected_path, self.enriched_path, self.vectors_path, self.vector_ids_path)},
+        }
@@ -0,0 +1,271 @@
+"""End-to-end AdsPipeline benchmark against local stand-ins
+
+Runs the CLI's collect, enrich, embed and index stages (``run_stage``) with
+their artifacts and WAL appends. The crawl is a synthetic GraphQL corpus
+replayed from a ResponseArchive, the OpenAI/Anthropic APIs and the media CDN
+are served by benchmarks/stubs.py, and MongoDB is mongomock unless
+--mongo-uri points at a local server.
+
+    python benchmarks/bench_pipeline.py --sizes 50,200,1000
+    python benchmarks/bench_pipeline.py --sizes 50,200,1000 --save-baseline
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# The ingest path the CLI runs, minus the neighbour graph
+INGEST_STAGES = ['collect', 'enrich', 'embed', 'index']
+
+SEARCH_QUERIES = [
+    "vitamin c serum", "sunscreen for oily skin", "anti aging night cream", "hydrating moisturizer",
+    "acne face wash", "retinol", "brightening", "luxury skincare", "budget moisturizer", "eye cream",
+]
+
+
+def instrument(obj, name: str, stage: str, timings):
+    """Replace obj.name with a wrapper recording each call's duration under stage"""
+    original = getattr(obj, name)
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            timings[stage].append(time.perf_counter() - start)
+
+    setattr(obj, name, timed)
+
+
+def summarize(samples):
+    return {
+        'calls': len(samples),
+        'total_s': round(float(np.sum(samples)), 4),
+        'p50_ms': round(float(np.percentile(samples, 50)) * 1000, 2),
+        'p95_ms': round(float(np.percentile(samples, 95)) * 1000, 2),
+    }
+
+
+def run_size(n_ads: int, args) -> dict:
+    """Run one ingest + search pass over a fresh corpus of n_ads ads in a scratch directory"""
+    from stubs import StubServer, build_corpus
+
+    workdir = tempfile.mkdtemp(prefix=f"ads-bench-{n_ads}-")
+    os.chdir(workdir)
+
+    stub = StubServer(latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    base_url = stub.start()
+    build_corpus("data", "keywords.csv", n_ads, base_url, seed=args.seed)
+
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ["ANTHROPIC_BASE_URL"] = base_url
+    os.environ["TQDM_DISABLE"] = "1"
+
+    import ads_pipeline
+    from artifacts import StageArtifacts
+
+    if not args.mongo_uri:
+        import mongomock
+
+        ads_pipeline.MongoClient = mongomock.MongoClient
+    pipeline = ads_pipeline.AdsPipeline(
+        openai_api_key="bench",
+        anthropic_api_key="bench",
+        mongo_uri=args.mongo_uri or "mongodb://localhost/bench",
+        keywords_file="keywords.csv",
+        use_proxy=False,
+        replay=True,
+    )
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.mongo_uri:
+        pipeline.collection.delete_many({})
+        pipeline.db["creative-hashes"].delete_many({})
+
+    artifacts = StageArtifacts("artifacts", dimension=pipeline.dimension)
+    timings = defaultdict(list)
+    for obj, name, stage in [
+        (pipeline.scraper, 'search_pages', 'search_pages'),
+        (pipeline.scraper, 'get_page_ads', 'get_page_ads'),
+        (pipeline, 'get_company_description', 'company_description'),
+        (pipeline, 'prepare_media_from_url', 'image'),
+        (pipeline.keyframer, 'keyframes', 'video_keyframes'),
+        (pipeline, 'enrich_ad_data', 'enrich'),
+        (pipeline, 'get_embedding', 'embedding'),
+        (pipeline, 'push_to_mongo', 'mongo_write'),
+    ]:
+        instrument(obj, name, stage, timings)
+
+    start = time.perf_counter()
+    for stage in INGEST_STAGES:
+        stage_start = time.perf_counter()
+        ran = ads_pipeline.run_stage(pipeline, artifacts, stage, args)
+        timings[f"stage.{stage}"].append(time.perf_counter() - stage_start)
+        if not ran:
+            break
+    finished = time.perf_counter()
+    processed = len(artifacts.enriched_ids())
+
+    for query in SEARCH_QUERIES:
+        search_start = time.perf_counter()
+        pipeline.search_ads(query, k=10)
+        timings['search'].append(time.perf_counter() - search_start)
+
+    pipeline.close()
+    stub.stop()
+
+    wall = finished - start
+    return {
+        'ads': n_ads,
+        'collected': len(pipeline.full_ads),
+        'processed': processed,
+        'embedded': len(artifacts.embedded_ids()),
+        'indexed': pipeline.index.ntotal,
+        'wall_s': round(wall, 3),
+        'ads_per_sec': round(processed / wall, 3) if wall else 0.0,
+        # ru_maxrss is in kilobytes on Linux; image workers are reported separately
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_rss_children_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'llm_cache_hits': pipeline.llm_cache.hits,
+        'creative_reuse_hits': pipeline.creative_index.hits,
+        'requests': dict(stub.requests),
+        'throttled': dict(stub.throttled),
+        'stages': {stage: summarize(samples) for stage, samples in timings.items()},
+    }
+
+
+def run_isolated(n_ads: int, args) -> dict:
+    """Run one corpus size in a child process so peak RSS is measured per size"""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        output = f.name
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        "--run-size", str(n_ads), "--output", output,
+        "--latency", str(args.latency), "--error-rate", str(args.error_rate), "--seed", str(args.seed),
+    ]
+    if args.mongo_uri:
+        command += ["--mongo-uri", args.mongo_uri]
+    subprocess.run(command, check=True)
+    with open(output) as f:
+        result = json.load(f)
+    os.remove(output)
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> list:
+    """Print each metric next to its baseline and return the regressions beyond tolerance
+
+    Stage latencies must also move by at least min_delta_ms, so sub-millisecond
+    stages don't flag noise as regressions.
+    """
+    regressions = []
+    for size, result in results.items():
+        base = baseline.get('sizes', {}).get(size)
+        if not base:
+            print(f"\n{size} ads: no baseline")
+            continue
+        print(f"\n{size} ads vs baseline")
+        metrics = [('ads_per_sec', result['ads_per_sec'], base['ads_per_sec'], True),
+                   ('peak_rss_mb', result['peak_rss_mb'], base['peak_rss_mb'], False)]
+        metrics += [(f"{stage}.p95_ms", stats['p95_ms'], base['stages'][stage]['p95_ms'], False)
+                    for stage, stats in result['stages'].items() if stage in base.get('stages', {})]
+        for name, value, reference, higher_is_better in metrics:
+            change = (value - reference) / reference if reference else 0.0
+            regressed = -change > tolerance if higher_is_better else change > tolerance
+            if name.endswith('_ms') and value - reference < min_delta_ms:
+                regressed = False
+            if regressed:
+                regressions.append(f"{size} ads {name}: {reference} -> {value}")
+            print(f"  {name:32s} {reference:>10} -> {value:>10} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def report(results: dict):
+    for size, result in results.items():
+        print(f"\n{size} ads: {result['processed']} processed in {result['wall_s']}s "
+              f"({result['ads_per_sec']} ads/s), peak RSS {result['peak_rss_mb']} MB "
+              f"(+{result['peak_rss_children_mb']} MB in workers)")
+        for stage, stats in result['stages'].items():
+            print(f"  {stage:20s} calls={stats['calls']:<6} p50={stats['p50_ms']:>9} ms  p95={stats['p95_ms']:>9} ms")
+        if result['throttled']:
+            print(f"  throttled (429): {result['throttled']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline AdsPipeline benchmark')
+    parser.add_argument('--sizes', default="50,200,1000", help='Comma-separated corpus sizes (ads)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Simulated API latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of API calls answered with 429')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongo-uri', help='Use a local MongoDB server instead of mongomock')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline results file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression before failing')
+    parser.add_argument('--min-delta-ms', type=float, default=5.0, help='Ignore stage p95 changes smaller than this')
+    parser.add_argument('--output', help='Write results JSON to this file')
+    parser.add_argument('--run-size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size:
+        result = run_size(args.run_size, args)
+        with open(args.output, 'w') as f:
+            json.dump(result, f)
+        return
+
+    results = {size: run_isolated(int(size), args) for size in args.sizes.split(',')}
+    report(results)
+
+    # A broken stub or SDK upgrade that fails every enrichment must not pass as a result
+    empty = [size for size, result in results.items() if not result['processed'] or not result['indexed']]
+    if empty:
+        print(f"\nNo ads were enriched and indexed for size(s) {', '.join(empty)}; not recording results")
+        sys.exit(1)
+
+    run = {
+        'created_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'settings': {'latency': args.latency, 'error_rate': args.error_rate, 'seed': args.seed, 'mongo': 'server' if args.mongo_uri else 'mongomock'},
+        'sizes': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"\nSaved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to record one")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('settings') != run['settings']:
+        print(f"\nWarning: baseline was recorded with {baseline.get('settings')}")
+    regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import io
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from archive import ResponseArchive
+
+ADS_PER_PAGE = 30
+PAGES_PER_KEYWORD = 3
+
+
+class StubServer:
+    """Local stand-in for the OpenAI, Anthropic and Facebook CDN endpoints.
+
+    Every API call sleeps for ``latency`` seconds and fails with a 429 (with a
+    retry-after-ms hint the SDKs honour) with probability ``error_rate``.
+    """
+
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.throttled = Counter()
+        self.lock = threading.Lock()
+        self.images = [self._make_image(i) for i in range(8)]
+        self.video = self._make_video()
+        self.server = None
+
+    def _make_image(self, seed: int) -> bytes:
+        rng = np.random.default_rng(seed)
+        y, x = np.mgrid[0:1200, 0:1200]
+        pixels = np.stack([(x * (seed + 1) * 0.2) % 255, (y * 0.3 + seed * 40) % 255, ((x + y) * 0.1) % 255], -1)
+        pixels += rng.normal(0, 8, pixels.shape)
+        buffer = io.BytesIO()
+        Image.fromarray(np.clip(pixels, 0, 255).astype('uint8')).save(buffer, format='JPEG', quality=92)
+        return buffer.getvalue()
+
+    def _make_video(self) -> bytes:
+        fd, path = tempfile.mkstemp(suffix=".mp4")
+        os.close(fd)
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 25, (640, 360))
+        for i in range(250):
+            frame = np.full((360, 640, 3), (i // 60) * 50, np.uint8)
+            cv2.putText(frame, str(i), (60, 200), cv2.FONT_HERSHEY_SIMPLEX, 3, (0, 0, 255), 5)
+            writer.write(frame)
+        writer.release()
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.remove(path)
+        return data
+
+    def _count(self, endpoint: str):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def _should_throttle(self, endpoint: str) -> bool:
+        with self.lock:
+            self.requests[endpoint] += 1
+            throttle = self.random.random() < self.error_rate
+            if throttle:
+                self.throttled[endpoint] += 1
+        return throttle
+
+    def _anthropic_message(self, request: dict) -> dict:
+        text = request['messages'][0]['content'][-1]['text']
+        # Handler threads share the seeded generator, so draw under the lock
+        with self.lock:
+            answer = {
+                'summary': f"Synthetic analysis of an ad ({len(text)} chars of copy).",
+                'price_tier': self.random.choice(["budget", "mid-range", "premium"]),
+                'product_type': self.random.choice(["serum", "moisturizer", "sunscreen", "cleanser"]),
+                'key_benefits': self.random.sample(["hydration", "brightening", "anti-aging", "acne care", "glow"], 2),
+                'target_audience': "adults 25-40",
+                'marketing_angle': self.random.choice(["ingredient-led", "results", "clinical"]),
+            }
+            message_id = f"msg_{self.random.getrandbits(32):08x}"
+        return {
+            'id': message_id,
+            'type': 'message',
+            'role': 'assistant',
+            'model': request.get('model'),
+            'content': [{'type': 'text', 'text': f"<answer>{json.dumps(answer)}</answer>"}],
+            'stop_reason': 'end_turn',
+            'stop_sequence': None,
+            'usage': {'input_tokens': len(text) // 4 + 1600 * len(request['messages'][0]['content'][:-1]), 'output_tokens': 180},
+        }
+
+    def _chat_completion(self, request: dict) -> dict:
+        with self.lock:
+            completion_id = f"chatcmpl-{self.random.getrandbits(32):08x}"
+        return {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': "A synthetic skincare brand."}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 120, 'completion_tokens': 40, 'total_tokens': 160},
+        }
+
+    def _embedding(self, request: dict) -> dict:
+        text = request['input'] if isinstance(request['input'], str) else json.dumps(request['input'])
+        vector = np.random.default_rng(zlib.crc32(text.encode('utf-8'))).normal(size=1536).astype('float32')
+        vector /= np.linalg.norm(vector)
+        return {
+            'object': 'list',
+            'data': [{'object': 'embedding', 'index': 0, 'embedding': vector.tolist()}],
+            'model': request.get('model'),
+            'usage': {'prompt_tokens': len(text) // 4, 'total_tokens': len(text) // 4},
+        }
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, content_type: str = 'application/json', headers: dict = None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith('/media/img/'):
+                    stub._count('media')
+                    index = int(self.path.rsplit('/', 1)[-1].split('.')[0]) % len(stub.images)
+                    self._send(200, stub.images[index], 'image/jpeg', {'ETag': f'"img-{index}"'})
+                elif self.path.startswith('/media/video/'):
+                    stub._count('video')
+                    self._send(200, stub.video, 'video/mp4')
+                else:
+                    self._send(404, b'{}')
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                routes = {
+                    '/v1/messages': ('anthropic', stub._anthropic_message),
+                    '/v1/chat/completions': ('openai_chat', stub._chat_completion),
+                    '/v1/embeddings': ('openai_embedding', stub._embedding),
+                }
+                if self.path not in routes:
+                    self._send(404, b'{}')
+                    return
+                endpoint, respond = routes[self.path]
+                time.sleep(stub.latency)
+                if stub._should_throttle(endpoint):
+                    error = {'type': 'error', 'error': {'type': 'rate_limit_error', 'message': 'Synthetic 429'}}
+                    self._send(429, json.dumps(error).encode('utf-8'), headers={'retry-after-ms': '100'})
+                    return
+                self._send(200, json.dumps(respond(request)).encode('utf-8'))
+
+        return Handler
+
+    def start(self) -> str:
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def build_corpus(data_dir: str, keywords_file: str, n_ads: int, media_base: str, video_share: float = 0.2, duplicate_share: float = 0.2, seed: int = 0):
+    """Write a synthetic crawl into a ResponseArchive for replay, plus a matching keywords CSV
+
+    Each keyword returns PAGES_PER_KEYWORD overlapping pages, every page carries up
+    to ADS_PER_PAGE ads, and a share of ads re-run an earlier ad's creative and copy.
+    """
+    rng = random.Random(seed)
+    archive = ResponseArchive(os.path.join(data_dir, 'archive'))
+    n_pages = max(1, math.ceil(n_ads / ADS_PER_PAGE))
+    page_ids = [str(100000 + p) for p in range(n_pages)]
+
+    ads = []
+    for i in range(n_ads):
+        if ads and rng.random() < duplicate_share:
+            source = rng.choice(ads)
+            snapshot = dict(source['snapshot'])
+        else:
+            is_video = rng.random() < video_share
+            snapshot = {
+                'title': f"Serum {i}",
+                'body': {'text': f"Brightening vitamin C serum number {i} for radiant skin."},
+                'caption': "example.com",
+                'cta_text': "Shop now",
+                'cta_type': "SHOP_NOW",
+                'link_description': "Free shipping",
+                'display_format': "VIDEO" if is_video else "IMAGE",
+                'images': [] if is_video else [{'original_image_url': f"{media_base}/media/img/{i}.jpg"}],
+                'videos': [{'video_sd_url': f"{media_base}/media/video/{i}.mp4"}] if is_video else [],
+                'page_categories': ["Beauty"],
+                'page_like_count': rng.randint(100, 100000),
+            }
+        page = i // ADS_PER_PAGE
+        snapshot = {**snapshot, 'page_id': page_ids[page], 'page_name': f"Brand {page}"}
+        ads.append({
+            'ad_archive_id': str(9000000000 + i),
+            'page_id': page_ids[page],
+            'page_name': f"Brand {page}",
+            'start_date': 1700000000 + i,
+            'end_date': 1700900000 + i,
+            'total_active_time': rng.randint(3600, 900000),
+            'snapshot': snapshot,
+        })
+
+    for p, page_id in enumerate(page_ids):
+        edges = [{'node': {'collated_results': [ad]}} for ad in ads[p * ADS_PER_PAGE:(p + 1) * ADS_PER_PAGE]]
+        response = {'data': {'ad_library_main': {'search_results_connection': {
+            'page_info': {'end_cursor': None, 'has_next_page': False},
+            'edges': edges,
+        }}}}
+        archive.append('page_ads', page_id, json.dumps(response))
+
+    with open(keywords_file, 'w', encoding='utf-8') as f:
+        f.write("Keyword,Category,Search Intent\n")
+        for k in range(n_pages):
+            keyword = f"keyword {k}"
+            f.write(f"{keyword},Category {k % 4},High\n")
+            results = [{'page_id': page_ids[(k + j) % n_pages], 'name': f"Brand {(k + j) % n_pages}"} for j in range(PAGES_PER_KEYWORD)]
+            response = {'data': {'ad_library_main': {'typeahead_suggestions': {'page_results': results}}}}
+            archive.append('page_search', keyword, json.dumps(response))
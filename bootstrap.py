@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
+
+
+class BootstrapCache:
+    """On-disk cache of Ad Library bootstrap tokens shared by every scraper process"""
+
+    # Serializes refreshes between threads; the file lock does the same across processes
+    _thread_lock = threading.Lock()
+
+    def __init__(self, path: str = "data/bootstrap.json", ttl: int = 3600):
+        """
+        Args:
+            path (str): JSON file holding the cached tokens
+            ttl (int): Seconds after which cached tokens are considered stale
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lock_path = f"{path}.lock"
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def is_fresh(self, tokens: Optional[Dict]) -> bool:
+        return bool(tokens) and time.time() - tokens.get('fetched_at', 0) < self.ttl
+
+    def load(self) -> Optional[Dict]:
+        """Return the cached tokens if present and within the TTL"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                tokens = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return tokens if self.is_fresh(tokens) else None
+
+    def _save(self, tokens: Dict):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(tokens, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, fetch: Callable[[], Optional[Dict]], stale: Optional[Dict] = None) -> Optional[Dict]:
+        """
+        Return fresh tokens, calling ``fetch`` only if no usable tokens are cached.
+
+        Pass the tokens that just failed as ``stale`` to force a refresh. If another
+        worker already replaced them while we waited for the lock, its tokens are
+        reused instead of bootstrapping a second time.
+        """
+        with self._locked():
+            cached = self.load()
+            if cached and (stale is None or cached.get('fetched_at') != stale.get('fetched_at')):
+                return cached
+
+            tokens = fetch()
+            if not tokens:
+                return None
+
+            tokens['fetched_at'] = time.time()
+            self._save(tokens)
+            logging.info(f"Refreshed bootstrap tokens (cached to {self.path})")
+            return tokens
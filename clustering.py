@@ -0,0 +1,145 @@
+import logging
+from typing import Dict, List, Tuple
+
+import faiss
+import numpy as np
+from pymongo import UpdateOne
+
+from metrics import tracked
+from vector_store import VectorStore
+
+
+def index_vectors(index: faiss.Index) -> np.ndarray:
+    """All vectors of a flat index, as an (ntotal, d) float32 array
+
+    For IndexFlat this is a view of the index's own storage rather than a
+    copy; it is only valid until vectors are added to or removed from the index.
+    """
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype='float32')
+    if hasattr(index, 'get_xb'):
+        return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+@tracked('cluster')
+def near_duplicate_clusters(vectors: np.ndarray, radius: float = 0.04, batch_size: int = 1024) -> np.ndarray:
+    """Group rows lying within ``radius`` of each other; returns each row's representative row
+
+    Neighbours come from batched FAISS range searches, so every row is
+    compared against the whole set without a Python-level pairwise loop.
+    Rows with the most neighbours become representatives first and claim
+    their unassigned neighbours. Every member is therefore within ``radius``
+    of its representative, and variants of a campaign don't chain into one
+    huge cluster the way connected components would.
+
+    Args:
+        vectors (np.ndarray): (n, d) float32 vectors
+        radius (float): Squared L2 distance, as reported by IndexFlatL2. For the
+            unit-length ada-002 embeddings this is 2 - 2 * cosine, so 0.04 groups
+            ads with a cosine similarity of at least 0.98
+        batch_size (int): Query rows per range search
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+
+    neighbours: List[np.ndarray] = []
+    for start in range(0, len(vectors), batch_size):
+        lims, _, ids = index.range_search(vectors[start:start + batch_size], radius)
+        neighbours.extend(ids[lims[row]:lims[row + 1]] for row in range(len(lims) - 1))
+
+    representative = np.full(len(vectors), -1, dtype='int64')
+    degrees = np.array([len(rows) for rows in neighbours], dtype='int64')
+    for row in np.argsort(-degrees, kind='stable'):
+        if representative[row] >= 0:
+            continue
+        members = neighbours[row]
+        members = members[representative[members] < 0]
+        representative[members] = row
+        representative[row] = row
+    return representative
+
+
+class AdClusterer:
+    """Offline near-duplicate clustering of the indexed ads.
+
+    Each ad document gets a ``cluster_id`` (the ad ID of its cluster's
+    representative) and a ``cluster_size``, which search uses to collapse
+    variants of one campaign into a single result. ``write_representatives``
+    publishes an index holding one vector per cluster.
+    """
+
+    def __init__(self, collection, radius: float = 0.04, batch_size: int = 1024):
+        """
+        Args:
+            collection: MongoDB ads collection receiving the cluster fields
+            radius (float): Squared L2 distance within which ads are near-duplicates
+            batch_size (int): Query rows per FAISS range search
+        """
+        self.logger = logging.getLogger(__name__)
+        self.collection = collection
+        self.radius = radius
+        self.batch_size = batch_size
+
+    def cluster(self, ad_ids: List[str], vectors: np.ndarray) -> Tuple[Dict[str, str], Dict[str, int]]:
+        """Cluster the given vectors; returns ({ad_id: cluster_id}, {cluster_id: size})"""
+        # An ad indexed more than once is clustered by its first vector
+        rows, seen = [], set()
+        for row, ad_id in enumerate(ad_ids):
+            if ad_id not in seen:
+                seen.add(ad_id)
+                rows.append(row)
+        ad_ids = [ad_ids[row] for row in rows]
+        if not ad_ids:
+            return {}, {}
+
+        representative = near_duplicate_clusters(np.asarray(vectors)[rows], self.radius, self.batch_size)
+        assignments = {ad_id: ad_ids[rep] for ad_id, rep in zip(ad_ids, representative)}
+        sizes: Dict[str, int] = {}
+        for cluster_id in assignments.values():
+            sizes[cluster_id] = sizes.get(cluster_id, 0) + 1
+        self.logger.info(f"Grouped {len(ad_ids)} ads into {len(sizes)} clusters "
+                         f"({sum(1 for size in sizes.values() if size > 1)} with near-duplicates, largest {max(sizes.values())})")
+        return assignments, sizes
+
+    def store(self, assignments: Dict[str, str], sizes: Dict[str, int], batch_size: int = 1000) -> int:
+        """Write cluster_id and cluster_size onto the ad documents; returns the number updated"""
+        updated = 0
+        operations = []
+        for ad_id, cluster_id in assignments.items():
+            operations.append(UpdateOne({'ad_id': ad_id}, {'$set': {'cluster_id': cluster_id, 'cluster_size': sizes[cluster_id]}}))
+            if len(operations) >= batch_size:
+                updated += self.collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            updated += self.collection.bulk_write(operations, ordered=False).modified_count
+        return updated
+
+    def write_representatives(self, index_dir: str, ad_ids: List[str], vectors: np.ndarray, assignments: Dict[str, str]) -> int:
+        """Publish a generation holding only each cluster's representative to the store at ``index_dir``"""
+        rows, seen = [], set()
+        for row, ad_id in enumerate(ad_ids):
+            if assignments.get(ad_id) == ad_id and ad_id not in seen:
+                seen.add(ad_id)
+                rows.append(row)
+
+        store = VectorStore(index_dir, vectors.shape[1], legacy_index="", legacy_ids="")
+        store.open()
+        try:
+            store.reset()
+            store.append([ad_ids[row] for row in rows], np.asarray(vectors, dtype='float32')[rows])
+            store.compact()
+        finally:
+            store.close()
+        self.logger.info(f"Published {len(rows)} representatives of {len(assignments)} ads to {index_dir}")
+        return len(rows)
+
+    def run(self, ad_ids: List[str], vectors: np.ndarray, representatives_dir: str = None) -> Dict:
+        """Cluster, store the assignments and optionally publish the representatives index"""
+        assignments, sizes = self.cluster(ad_ids, vectors)
+        updated = self.store(assignments, sizes)
+        summary = {'ads': len(assignments), 'clusters': len(sizes), 'updated': updated}
+        if representatives_dir:
+            summary['representatives_indexed'] = self.write_representatives(representatives_dir, ad_ids, vectors, assignments)
+        return summary
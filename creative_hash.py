@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from metrics import CACHE_REQUESTS
+
+
+def dhash(gray: np.ndarray, hash_size: int = 8) -> str:
+    """Difference hash of a grayscale image as a 16-character hex string"""
+    resized = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (resized[:, 1:] > resized[:, :-1]).flatten()
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):0{hash_size * hash_size // 4}x}"
+
+
+def hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def text_hash(*parts: Optional[str]) -> str:
+    """Hash of the ad copy, insensitive to case and whitespace"""
+    text = " ".join(re.sub(r'\s+', ' ', part or '').strip().lower() for part in parts)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class CreativeIndex:
+    """Index of already-analysed creatives, used to reuse enrichment for repeated ads"""
+
+    def __init__(self, collection, threshold: int = 6):
+        """
+        Args:
+            collection: MongoDB collection holding {ad_id, dhash, text_hash, enrichment}
+            threshold (int): Maximum dHash Hamming distance for two creatives to match
+        """
+        self.collection = collection
+        self.threshold = threshold
+        self.entries: Optional[Dict[str, List[Tuple[Optional[str], Dict]]]] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        self.entries = {}
+        try:
+            # Entries from before structured enrichment have no 'enrichment' and are re-analysed
+            for doc in self.collection.find({'enrichment': {'$exists': True}}, {'_id': 0, 'dhash': 1, 'text_hash': 1, 'enrichment': 1}):
+                self.entries.setdefault(doc['text_hash'], []).append((doc.get('dhash'), doc['enrichment']))
+        except Exception as e:
+            logging.error(f"Error loading creative hash index: {e}")
+        logging.info(f"Loaded {sum(len(v) for v in self.entries.values())} creative hashes")
+
+    def lookup(self, creative_hash: Optional[str], copy_hash: str) -> Optional[Dict]:
+        """Return a stored analysis for a matching creative and copy, or None"""
+        if self.entries is None:
+            self._load()
+
+        for stored_hash, enrichment in self.entries.get(copy_hash, []):
+            if stored_hash is None or creative_hash is None:
+                if stored_hash == creative_hash:
+                    self.hits += 1
+                    CACHE_REQUESTS.inc(cache='creative', result='hit')
+                    return enrichment
+            elif hamming(stored_hash, creative_hash) <= self.threshold:
+                self.hits += 1
+                CACHE_REQUESTS.inc(cache='creative', result='hit')
+                return enrichment
+
+        self.misses += 1
+        CACHE_REQUESTS.inc(cache='creative', result='miss')
+        return None
+
+    def add(self, ad_id: str, creative_hash: Optional[str], copy_hash: str, enrichment: Dict):
+        if self.entries is None:
+            self._load()
+        self.entries.setdefault(copy_hash, []).append((creative_hash, enrichment))
+        try:
+            self.collection.insert_one({'ad_id': ad_id, 'dhash': creative_hash, 'text_hash': copy_hash, 'enrichment': dict(enrichment)})
+        except Exception as e:
+            logging.error(f"Error storing creative hash: {e}")
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
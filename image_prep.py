@@ -0,0 +1,65 @@
+import base64
+import io
+import logging
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from creative_hash import dhash
+
+# Claude downscales anything with a longer edge than this, so larger images only cost bandwidth
+MAX_EDGE = 1568
+
+# Approximate JPEG bytes per pixel at each quality for photographic ad creatives
+BYTES_PER_PIXEL = [(85, 0.9), (75, 0.6), (65, 0.45), (50, 0.35), (35, 0.25)]
+
+
+def estimate_quality(pixels: int, max_bytes: int) -> int:
+    """Pick the highest JPEG quality whose estimated size fits within max_bytes"""
+    for quality, bytes_per_pixel in BYTES_PER_PIXEL:
+        if pixels * bytes_per_pixel <= max_bytes:
+            return quality
+    return BYTES_PER_PIXEL[-1][0]
+
+
+def prepare_image(content: bytes, max_edge: int = MAX_EDGE, max_size_mb: float = 5) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Decode, downscale and re-encode an image for the vision model in a single pass.
+
+    Runs in a worker process, so it must stay a module-level function.
+
+    Returns:
+        tuple: (base64 JPEG data, 'image/jpeg', perceptual dHash), or (None, None, None)
+        if the image can't be decoded
+    """
+    # base64 inflates by 4/3 and the API limit applies to the encoded payload
+    max_bytes = int(max_size_mb * 1024 * 1024 * 3 / 4)
+    try:
+        image = Image.open(io.BytesIO(content))
+        if image.format == 'JPEG':
+            # Let the decoder skip DCT coefficients instead of decoding at full resolution
+            image.draft('RGB', (max_edge, max_edge))
+        image = image.convert('RGB')
+
+        if max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        creative_hash = dhash(np.asarray(image.convert('L')))
+
+        quality = estimate_quality(image.width * image.height, max_bytes)
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+
+        if buffer.tell() > max_bytes:
+            # Estimate was too optimistic (very noisy image); scale quality by the overshoot once
+            quality = max(20, int(quality * max_bytes / buffer.tell()))
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=quality, optimize=True)
+            if buffer.tell() > max_bytes:
+                return None, None, creative_hash
+
+        return base64.b64encode(buffer.getvalue()).decode('utf-8'), 'image/jpeg', creative_hash
+
+    except Exception as e:
+        logging.debug(f"Error preparing image: {e}")
+        return None, None, None
@@ -0,0 +1,206 @@
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Union
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from metrics import REGISTRY
+
+JOBS = REGISTRY.counter('ads_jobs_total', 'Queue jobs by kind and outcome', ['kind', 'outcome'])
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+class JobQueue:
+    """Work queue in a MongoDB collection, shared by any number of worker processes.
+
+    Each job is keyed by (kind, key), so enqueueing the same keyword, page or
+    ad twice is a no-op. Workers lease a job for ``lease_seconds``, renew the
+    lease with heartbeats while working on it, and complete or fail it.
+    Completion only counts while the lease is still held, so a worker that
+    stalled past its lease can't overwrite a job another worker picked up.
+    Jobs whose lease expires become available again; failed jobs are retried
+    with exponential backoff until ``max_attempts``. Timestamps are UTC, so
+    workers in different time zones agree on when a lease expires.
+    """
+
+    def __init__(self, collection, lease_seconds: float = 300, max_attempts: int = 5, retry_delay: float = 30):
+        """
+        Args:
+            collection: MongoDB collection holding the jobs
+            lease_seconds (float): How long a worker owns a job without a heartbeat
+            max_attempts (int): Leases before a failing job is marked failed
+            retry_delay (float): Seconds before the first retry; doubles with each attempt
+        """
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def ensure_indexes(self):
+        self.collection.create_index([('kind', ASCENDING), ('key', ASCENDING)], unique=True)
+        self.collection.create_index([('kind', ASCENDING), ('status', ASCENDING), ('available_at', ASCENDING)])
+
+    def _new_job(self, kind: str, key: str, payload: Optional[Dict]) -> Dict:
+        now = datetime.now(timezone.utc)
+        return {
+            'kind': kind,
+            'key': key,
+            'payload': payload or {},
+            'status': PENDING,
+            'attempts': 0,
+            'available_at': now,
+            'created_at': now,
+        }
+
+    def enqueue(self, kind: str, key: str, payload: Dict = None, add_to_set: Dict = None) -> bool:
+        """Add a job unless one with the same kind and key exists; returns True if it was new
+
+        ``add_to_set`` maps payload fields to values merged into an existing job's
+        payload, e.g. another keyword that matched an already-queued page.
+        """
+        update = {'$setOnInsert': self._new_job(kind, key, payload)}
+        if add_to_set:
+            # Set payload fields individually so they don't conflict with $addToSet on payload.<field>
+            del update['$setOnInsert']['payload']
+            update['$setOnInsert'].update({f"payload.{k}": v for k, v in (payload or {}).items() if k not in add_to_set})
+            update['$addToSet'] = {f"payload.{field}": value for field, value in add_to_set.items()}
+        result = self.collection.update_one({'kind': kind, 'key': key}, update, upsert=True)
+        if result.upserted_id is not None:
+            JOBS.inc(kind=kind, outcome='enqueued')
+            return True
+        return False
+
+    def get(self, kind: str, key: str) -> Optional[Dict]:
+        """The job with this kind and key, or None"""
+        return self.collection.find_one({'kind': kind, 'key': key})
+
+    def enqueue_many(self, kind: str, jobs: Iterable[tuple]) -> int:
+        """Enqueue (key, payload) pairs in one round trip; returns how many were new"""
+        operations = [UpdateOne({'kind': kind, 'key': key}, {'$setOnInsert': self._new_job(kind, key, payload)}, upsert=True)
+                      for key, payload in jobs]
+        if not operations:
+            return 0
+        added = self.collection.bulk_write(operations, ordered=False).upserted_count
+        JOBS.inc(added, kind=kind, outcome='enqueued')
+        return added
+
+    def lease(self, kinds: Union[str, List[str]], worker_id: str) -> Optional[Dict]:
+        """Claim the oldest available job of the first of ``kinds`` that has one, or None
+
+        Available means pending and due, or leased by a worker whose lease
+        expired with attempts to spare. A job whose leases keep expiring (its
+        worker crashed or was killed on it every time) is marked failed once
+        it has used up max_attempts, instead of being handed out forever.
+        """
+        kinds = [kinds] if isinstance(kinds, str) else list(kinds)
+        now = datetime.now(timezone.utc)
+        self._fail_abandoned(kinds, now)
+        for kind in kinds:
+            job = self.collection.find_one_and_update(
+                {
+                    'kind': kind,
+                    '$or': [
+                        {'status': PENDING, 'available_at': {'$lte': now}},
+                        {'status': LEASED, 'lease_expires': {'$lte': now}, 'attempts': {'$lt': self.max_attempts}},
+                    ],
+                },
+                {
+                    '$set': {'status': LEASED, 'worker': worker_id, 'leased_at': now,
+                             'lease_expires': now + timedelta(seconds=self.lease_seconds)},
+                    '$inc': {'attempts': 1},
+                },
+                sort=[('available_at', ASCENDING)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if job is not None:
+                JOBS.inc(kind=job['kind'], outcome='leased')
+                return job
+        return None
+
+    def _fail_abandoned(self, kinds: List[str], now: datetime):
+        """Mark failed the expired leases of jobs that have no attempts left"""
+        for kind in kinds:
+            failed = self.collection.update_many(
+                {'kind': kind, 'status': LEASED, 'lease_expires': {'$lte': now}, 'attempts': {'$gte': self.max_attempts}},
+                {'$set': {'status': FAILED, 'error': 'lease expired on the last attempt', 'failed_at': now}},
+            ).modified_count
+            if failed:
+                logging.warning(f"Marked {failed} {kind} jobs failed after their last lease expired")
+                JOBS.inc(failed, kind=kind, outcome='failed')
+
+    def _owned(self, job: Dict) -> Dict:
+        return {'_id': job['_id'], 'status': LEASED, 'worker': job['worker']}
+
+    def heartbeat(self, job: Dict) -> bool:
+        """Extend a job's lease; False if the lease was lost to another worker"""
+        result = self.collection.update_one(
+            self._owned(job),
+            {'$set': {'lease_expires': datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)}},
+        )
+        return result.matched_count == 1
+
+    @contextmanager
+    def keepalive(self, job: Dict):
+        """Heartbeat a job from a background thread while the block runs"""
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(self.lease_seconds / 3):
+                if not self.heartbeat(job):
+                    logging.warning(f"Lost the lease on {job['kind']} job {job['key']}")
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True, name=f"heartbeat-{job['key']}")
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def complete(self, job: Dict, result: Dict = None) -> bool:
+        """Mark a leased job done; False if the lease had already been lost"""
+        update = {'status': DONE, 'completed_at': datetime.now(timezone.utc)}
+        if result:
+            update['result'] = result
+        completed = self.collection.update_one(self._owned(job), {'$set': update}).matched_count == 1
+        JOBS.inc(kind=job['kind'], outcome='completed' if completed else 'lease_lost')
+        return completed
+
+    def fail(self, job: Dict, error: str) -> bool:
+        """Record a failed attempt: retry later with backoff, or give up after max_attempts"""
+        if job['attempts'] >= self.max_attempts:
+            update = {'status': FAILED, 'error': error, 'failed_at': datetime.now(timezone.utc)}
+            outcome = 'failed'
+        else:
+            delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+            update = {'status': PENDING, 'error': error, 'available_at': datetime.now(timezone.utc) + timedelta(seconds=delay)}
+            outcome = 'retried'
+        JOBS.inc(kind=job['kind'], outcome=outcome)
+        return self.collection.update_one(self._owned(job), {'$set': update}).matched_count == 1
+
+    def release(self, job: Dict):
+        """Hand a job back untouched, without counting the attempt"""
+        self.collection.update_one(
+            self._owned(job),
+            {'$set': {'status': PENDING, 'available_at': datetime.now(timezone.utc)}, '$inc': {'attempts': -1}},
+        )
+
+    def retry_failed(self, kind: str = None) -> int:
+        """Requeue jobs that ran out of attempts, resetting their attempt count"""
+        query = {'status': FAILED}
+        if kind:
+            query['kind'] = kind
+        return self.collection.update_many(
+            query, {'$set': {'status': PENDING, 'attempts': 0, 'available_at': datetime.now(timezone.utc)}}
+        ).modified_count
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """Number of jobs per kind and status"""
+        counts: Dict[str, Dict[str, int]] = {}
+        for group in self.collection.aggregate([{'$group': {'_id': {'kind': '$kind', 'status': '$status'}, 'count': {'$sum': 1}}}]):
+            counts.setdefault(group['_id']['kind'], {})[group['_id']['status']] = group['count']
+        return counts
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+from metrics import CACHE_REQUESTS
+
+
+class CacheMiss(Exception):
+    """Raised in cache-only mode when a response is not cached"""
+
+
+class SQLiteCacheBackend:
+    """LLM response cache stored in a local SQLite file"""
+
+    def __init__(self, path: str = "llm_cache.sqlite"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+        self.conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, model: str, response: str):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode('utf-8')), time.time())
+            )
+            self.conn.commit()
+
+    def evict(self, max_age: Optional[float] = None, max_bytes: Optional[int] = None) -> int:
+        """Drop entries older than max_age, then the oldest entries until under max_bytes"""
+        removed = 0
+        with self.lock:
+            if max_age is not None:
+                removed += self.conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - max_age,)).rowcount
+            if max_bytes is not None:
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY created_at").fetchall():
+                    if total <= max_bytes:
+                        break
+                    self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    total -= size
+                    removed += 1
+            self.conn.commit()
+        return removed
+
+
+class MongoCacheBackend:
+    """LLM response cache stored in a MongoDB collection"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index('created_at')
+
+    def get(self, key: str) -> Optional[str]:
+        doc = self.collection.find_one({'_id': key}, {'response': 1})
+        return doc['response'] if doc else None
+
+    def set(self, key: str, model: str, response: str):
+        self.collection.replace_one(
+            {'_id': key},
+            {'model': model, 'response': response, 'size': len(response.encode('utf-8')), 'created_at': time.time()},
+            upsert=True
+        )
+
+    def evict(self, max_age: Optional[float] = None, max_bytes: Optional[int] = None) -> int:
+        """Drop entries older than max_age, then the oldest entries until under max_bytes"""
+        removed = 0
+        if max_age is not None:
+            removed += self.collection.delete_many({'created_at': {'$lt': time.time() - max_age}}).deleted_count
+        if max_bytes is not None:
+            totals = list(self.collection.aggregate([{'$group': {'_id': None, 'total': {'$sum': '$size'}}}]))
+            total = totals[0]['total'] if totals else 0
+            stale = []
+            for doc in self.collection.find({}, {'size': 1}).sort('created_at', 1):
+                if total <= max_bytes:
+                    break
+                stale.append(doc['_id'])
+                total -= doc['size']
+            if stale:
+                removed += self.collection.delete_many({'_id': {'$in': stale}}).deleted_count
+        return removed
+
+
+class LLMCache:
+    """Deterministic response cache for temperature-0 LLM calls"""
+
+    def __init__(self, backend, cache_only: bool = False, max_age: Optional[float] = 90 * 24 * 3600, max_bytes: Optional[int] = 512 * 1024 * 1024):
+        """
+        Args:
+            backend: SQLiteCacheBackend or MongoCacheBackend
+            cache_only (bool): Never call the model; misses raise CacheMiss
+            max_age (float): Seconds after which ``evict`` drops entries
+            max_bytes (int): Total response size above which ``evict`` drops the oldest entries
+        """
+        self.backend = backend
+        self.cache_only = cache_only
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def evict(self) -> int:
+        """Drop expired entries and the oldest ones over the size limit; returns the number removed
+
+        A maintenance call, not run on startup: the Mongo backend is shared by
+        every worker. Cache-only runs replay the cache and never evict from it.
+        """
+        if self.cache_only:
+            logging.warning("Not evicting LLM cache entries in cache-only mode")
+            return 0
+        removed = self.backend.evict(max_age=self.max_age, max_bytes=self.max_bytes)
+        logging.info(f"Evicted {removed} LLM cache entries")
+        return removed
+
+    @staticmethod
+    def key(model: str, prompt, image_hash: Optional[str] = None) -> str:
+        """Cache key from the model, the whitespace-normalized prompt and the image hash"""
+        if not isinstance(prompt, str):
+            prompt = json.dumps(prompt, sort_keys=True)
+        normalized = re.sub(r'\s+', ' ', prompt).strip()
+        return hashlib.sha256(f"{model}\x00{normalized}\x00{image_hash or ''}".encode('utf-8')).hexdigest()
+
+    def get_or_call(self, model: str, prompt, call: Callable[[], str], image_hash: Optional[str] = None,
+                    validate: Optional[Callable[[str], bool]] = None) -> str:
+        """Return the cached response for this request, calling the model only on a miss
+
+        With ``validate``, only responses it accepts are cached, and a cached
+        response it rejects (e.g. stored before validation existed) counts as
+        a miss, so a truncated or unparseable answer is retried instead of
+        being replayed forever.
+        """
+        key = self.key(model, prompt, image_hash)
+        cached = self.backend.get(key)
+        if cached is not None and (validate is None or validate(cached)):
+            self.hits += 1
+            CACHE_REQUESTS.inc(cache='llm', result='hit')
+            return cached
+
+        self.misses += 1
+        CACHE_REQUESTS.inc(cache='llm', result='miss')
+        if self.cache_only:
+            raise CacheMiss(f"No cached {model} response (cache-only mode)")
+
+        response = call()
+        if validate is None or validate(response):
+            self.backend.set(key, model, response)
+        else:
+            logging.warning(f"Not caching an invalid {model} response")
+        return response
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import CACHE_REQUESTS, STAGE_ERRORS, tracked
+
+
+class MediaFetcher:
+    """Pooled, concurrent media downloader backed by a content-addressed disk cache"""
+
+    def __init__(self, cache_dir: str = "media_cache", max_workers: int = 8, max_age: int = 7 * 24 * 3600, timeout: int = 10, proxies: Optional[Dict] = None):
+        """
+        Args:
+            cache_dir (str): Cache root; ``urls/`` holds per-URL metadata, ``blobs/`` the content
+            max_workers (int): Maximum concurrent downloads
+            max_age (int): Seconds a cached URL is served without revalidation
+            timeout (int): Per-request timeout in seconds
+            proxies (dict): Optional requests proxy configuration
+        """
+        self.cache_dir = cache_dir
+        self.urls_dir = os.path.join(cache_dir, "urls")
+        self.blobs_dir = os.path.join(cache_dir, "blobs")
+        self.max_age = max_age
+        self.timeout = timeout
+        os.makedirs(self.urls_dir, exist_ok=True)
+        os.makedirs(self.blobs_dir, exist_ok=True)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if proxies:
+            self.session.proxies.update(proxies)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="media")
+        self.pending: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+    def _meta_path(self, url: str) -> str:
+        return os.path.join(self.urls_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + ".json")
+
+    def _blob_path(self, content_hash: str) -> str:
+        return os.path.join(self.blobs_dir, content_hash)
+
+    def _load_meta(self, url: str) -> Optional[Dict]:
+        try:
+            with open(self._meta_path(url), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return meta if os.path.exists(self._blob_path(meta['content_hash'])) else None
+
+    def _write_atomic(self, path: str, data: bytes):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _store(self, url: str, content: bytes, headers) -> Dict:
+        content_hash = hashlib.sha256(content).hexdigest()
+        if not os.path.exists(self._blob_path(content_hash)):
+            self._write_atomic(self._blob_path(content_hash), content)
+        meta = {
+            'url': url,
+            'content_hash': content_hash,
+            'content_type': headers.get('Content-Type', ''),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'checked_at': time.time(),
+        }
+        self._write_atomic(self._meta_path(url), json.dumps(meta).encode('utf-8'))
+        return meta
+
+    @tracked('media_fetch')
+    def _fetch(self, url: str) -> Tuple[Optional[bytes], Optional[str]]:
+        """Return (content, content type), downloading or revalidating only when needed"""
+        meta = self._load_meta(url)
+        if meta and time.time() - meta['checked_at'] < self.max_age:
+            CACHE_REQUESTS.inc(cache='media', result='hit')
+            return self._read_blob(meta)
+
+        headers = {}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and meta:
+                CACHE_REQUESTS.inc(cache='media', result='revalidated')
+                meta['checked_at'] = time.time()
+                self._write_atomic(self._meta_path(url), json.dumps(meta).encode('utf-8'))
+                return self._read_blob(meta)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.debug(f"Error downloading media: {e}")
+            STAGE_ERRORS.inc(stage='media_fetch')
+            # A stale copy is better than nothing if the CDN is unreachable
+            return self._read_blob(meta) if meta else (None, None)
+
+        CACHE_REQUESTS.inc(cache='media', result='miss')
+        return self._read_blob(self._store(url, response.content, response.headers), response.content)
+
+    def _read_blob(self, meta: Dict, content: bytes = None) -> Tuple[Optional[bytes], Optional[str]]:
+        if content is None:
+            with open(self._blob_path(meta['content_hash']), 'rb') as f:
+                content = f.read()
+        return content, meta['content_type']
+
+    def prefetch(self, urls: Iterable[str]) -> Dict[str, Future]:
+        """Start downloading URLs in the background; later ``get`` calls reuse the results
+
+        Returns the downloads started by this call, not ones already pending.
+        """
+        started = {}
+        with self.lock:
+            for url in urls:
+                if url and url.startswith('http') and url not in self.pending:
+                    self.pending[url] = started[url] = self.executor.submit(self._fetch, url)
+        return started
+
+    def discard(self, url: str):
+        """Forget a prefetch nobody will ``get``, cancelling it if it hasn't started"""
+        with self.lock:
+            future = self.pending.pop(url, None)
+        if future is not None:
+            future.cancel()
+
+    def get(self, url: str) -> Tuple[Optional[bytes], Optional[str]]:
+        """Return (content, content type) for a URL, waiting on a prefetch if one is running"""
+        with self.lock:
+            future = self.pending.pop(url, None)
+        if future is not None:
+            return future.result()
+        return self._fetch(url)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
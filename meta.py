@@ -15,6 +15,10 @@ import re
 import time
 from RateLimiter import RateLimiter
 from proxies import ProxyPool
+from archive import ResponseArchive
+from bootstrap import BootstrapCache
+from metrics import RATE_LIMIT_SLEEP, RETRIES, STAGE_ERRORS, STAGE_ITEMS, tracked
+from profiling import Profiler, profile_stage
 
 # Configure logging
 logging.basicConfig(
@@ -72,9 +76,14 @@ class FacebookAd:
 
 class FacebookScraper:
     """Scraper for Facebook Ad Library"""
-    def __init__(self, data_dir: str = "data", use_proxy: bool = True):
+
+    # GraphQL error codes returned when fb_dtsg/lsd are expired or invalid
+    AUTH_ERROR_CODES = {1357001, 1357004}
+
+    def __init__(self, data_dir: str = "data", use_proxy: bool = True, replay: bool = False):
         load_dotenv()
         self.data_dir = data_dir
+        self.replay = replay
         self.session = requests.Session()
         self.proxy_pool = ProxyPool(
             username=os.getenv("PROXY_USERNAME"),
@@ -85,6 +94,7 @@ class FacebookScraper:
         self.use_proxy = use_proxy
 
         os.makedirs(data_dir, exist_ok=True)
+        self.archive = ResponseArchive(os.path.join(data_dir, 'archive'))
         
         # GraphQL doc_ids for different operations
         self.doc_ids = {
@@ -105,8 +115,11 @@ class FacebookScraper:
             'xs': '16:Ml14BMs_UQ3cjg:2:1699733852:-1:13648::AcX5IqEhPKWT3rrzLrJPdrbhy8FaZOiJrDdIWgzqR7C4vA'
         }
         
+        # Bootstrap tokens are fetched lazily on the first request and shared on disk
+        self.bootstrap = BootstrapCache(os.path.join(data_dir, 'bootstrap.json'))
+        self.tokens = None
+
         self._setup_session()
-        self._extract_page_params()  # Extract parameters from Ad Library page
 
     def _setup_session(self):
         """Setup session with default headers and cookies"""
@@ -132,8 +145,16 @@ class FacebookScraper:
         # Update session cookies
         self.session.cookies.update(self.cookies)
 
-    def search_pages(self, query: str) -> List[FacebookPage]:
+    @tracked('search_pages')
+    def search_pages(self, query: str, retry_auth: bool = True) -> List[FacebookPage]:
         """Search for Facebook pages"""
+        if self.replay:
+            response_text = self.archive.lookup('page_search', query)
+            if response_text is None:
+                logging.warning(f"No archived page search for query: {query}")
+                return []
+            return self._parse_page_results(response_text, query)
+
         url = "https://www.facebook.com/api/graphql/"
         
         variables = {
@@ -156,32 +177,56 @@ class FacebookScraper:
         try:
             response = self.session.post(url, data=data)
             response.raise_for_status()
+
+            data = self._parse_response(response.text)
+            if retry_auth and self._is_auth_failure(data):
+                logging.warning("Session tokens rejected. Refreshing bootstrap.")
+                RETRIES.inc(service='facebook', reason='auth')
+                self._ensure_bootstrap(force=True)
+                return self.search_pages(query, retry_auth=False)
             
-            # Save raw response
-            self._save_raw_response(response.text, f"page_search_{query}")
+            # Archive raw response, unless it is an error or rate-limit payload that replay would serve instead of a good one
+            if data and 'data' in data and not data.get('errors'):
+                self.archive.append('page_search', query, response.text)
             
-            # Parse response
-            data = self._parse_response(response.text)
-            if not data or 'data' not in data:
-                logging.error("Failed to parse page search response")
-                return []
-
-            pages = []
-            page_results = data.get('data', {}).get('ad_library_main', {}).get('typeahead_suggestions', {}).get('page_results', [])
-            for result in page_results:
-                if result.get('page_id'):  # Only add if we got a valid ID
-                    pages.append(result)
-
-            logging.info(f"Found {len(pages)} pages for query: {query}")
-            return pages
+            return self._parse_page_results(response.text, query)
 
         except Exception as e:
             logging.error(f"Error searching pages: {str(e)}")
+            STAGE_ERRORS.inc(stage='search_pages')
             return []
 
-    @RateLimiter(max_calls=15, period=5)
+    def _parse_page_results(self, response_text: str, query: str) -> List[dict]:
+        """Extract page results from a page search response"""
+        data = self._parse_response(response_text)
+        if not data or 'data' not in data:
+            logging.error("Failed to parse page search response")
+            return []
+
+        pages = []
+        page_results = data.get('data', {}).get('ad_library_main', {}).get('typeahead_suggestions', {}).get('page_results', [])
+        for result in page_results:
+            if result.get('page_id'):  # Only add if we got a valid ID
+                pages.append(result)
+
+        logging.info(f"Found {len(pages)} pages for query: {query}")
+        STAGE_ITEMS.inc(len(pages), stage='search_pages')
+        return pages
+
+    @tracked('get_page_ads')
     def get_page_ads(self, page_id: str,active:bool,country:List[str],limit:int,cursor:str=None) -> List[dict]:
-        """Get ads for a specific page"""
+        """Get ads for a specific page, from the archive when replaying"""
+        if self.replay:
+            response_text = self.archive.lookup('page_ads', page_id, cursor)
+            if response_text is None:
+                logging.warning(f"No archived ads for page ID: {page_id} (cursor={cursor})")
+                return []
+            return self._parse_response(response_text)
+        return self._fetch_page_ads(page_id, active, country, limit, cursor)
+
+    @RateLimiter(max_calls=15, period=5)
+    def _fetch_page_ads(self, page_id: str,active:bool,country:List[str],limit:int,cursor:str=None,retry_auth:bool=True) -> List[dict]:
+        """Fetch ads for a specific page from the Ad Library"""
         url = "https://www.facebook.com/api/graphql/"
         
         variables = {
@@ -235,13 +280,21 @@ class FacebookScraper:
             # Parse response
             data = self._parse_response(response.text)
             print(data)
+            if retry_auth and self._is_auth_failure(data):
+                logging.warning("Session tokens rejected. Refreshing bootstrap.")
+                RETRIES.inc(service='facebook', reason='auth')
+                self._ensure_bootstrap(force=True)
+                return self._fetch_page_ads(page_id,active,country,limit,cursor,retry_auth=False)
             if not data or 'data' not in data:
                 print(data)
                 logging.warning(f"Rate limit hit. Retrying in 60 seconds.")
                 retry_after = int(response.headers.get("Retry-After", 60))
+                RETRIES.inc(service='facebook', reason='rate_limit')
+                RATE_LIMIT_SLEEP.inc(retry_after, limiter='facebook_retry_after')
                 time.sleep(retry_after)
-                self.get_page_ads(page_id,active,country,limit,cursor)
+                return self._fetch_page_ads(page_id,active,country,limit,cursor)
             else:
+                self.archive.append('page_ads', page_id, response.text, cursor=cursor)
                 ads = []
                 ad_archive_ids = set()
                 
@@ -301,6 +354,7 @@ class FacebookScraper:
                         ads.append(ad)
 
                 logging.info(f"Found {len(ad_archive_ids)} unique ads (ad_archive_ids) for page ID: {page_id}")
+                STAGE_ITEMS.inc(len(ad_archive_ids), stage='get_page_ads')
             
             # Print detailed ad information
             # if ads:
@@ -391,9 +445,11 @@ class FacebookScraper:
         except Exception as e:
             if "ProxyError" in str(e) or "SSL" in str(e):
                 print(f"Error: {e}")
-                self.get_page_ads(page_id,active,country,limit,cursor)
+                RETRIES.inc(service='facebook', reason='proxy')
+                return self._fetch_page_ads(page_id,active,country,limit,cursor)
             else:
                 logging.error(f"Error getting page ads: {str(e)}")
+                STAGE_ERRORS.inc(stage='get_page_ads')
                 return []
 
     def get_ad_details(self, ad_archive_id: str, page_id: str) -> Optional[Dict]:
@@ -442,8 +498,8 @@ class FacebookScraper:
             response = self.session.post(url, data=data)
             response.raise_for_status()
             
-            # Save raw response
-            self._save_raw_response(response.text, f"ad_detail_{ad_archive_id}")
+            # Archive raw response
+            self.archive.append('ad_detail', ad_archive_id, response.text)
             
             # Parse response
             data = self._parse_response(response.text)
@@ -653,65 +709,82 @@ class FacebookScraper:
             logging.error(f"Failed to parse JSON response: {str(e)}")
             return {}
 
-    def _save_raw_response(self, response_text: str, prefix: str):
-        """Save raw response for debugging"""
-        filename = f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        filepath = os.path.join(self.data_dir, filename)
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(response_text)
-        logging.info(f"Saved raw response to {filepath}")
-
-    def _extract_page_params(self):
+    def _extract_page_params(self) -> Optional[Dict]:
         """Extract important parameters from Ad Library page"""
         try:
             response = self.session.get('https://www.facebook.com/ads/library/')
             if response.status_code == 200:
                 page_content = response.text
+                tokens = {}
                 
                 # Extract fb_dtsg token
                 fb_dtsg_match = re.search(r'"DTSGInitData",\[\],{"token":"([^"]+)"', page_content)
                 if fb_dtsg_match:
-                    self.fb_dtsg = fb_dtsg_match.group(1)
-                    logging.info(f"Found fb_dtsg token: {self.fb_dtsg}")
+                    tokens['fb_dtsg'] = fb_dtsg_match.group(1)
+                    logging.info(f"Found fb_dtsg token: {tokens['fb_dtsg']}")
                 
                 # Extract client revision
                 rev_match = re.search(r'"client_revision":(\d+),', page_content)
                 if rev_match:
-                    self.client_revision = rev_match.group(1)
-                    logging.info(f"Found client revision: {self.client_revision}")
+                    tokens['client_revision'] = rev_match.group(1)
+                    logging.info(f"Found client revision: {tokens['client_revision']}")
                 
                 # Extract LSD token
                 lsd_match = re.search(r'"LSD",\[\],{"token":"([^"]+)"', page_content)
                 if lsd_match:
-                    self.lsd = lsd_match.group(1)
-                    logging.info(f"Found LSD token: {self.lsd}")
+                    tokens['lsd'] = lsd_match.group(1)
+                    logging.info(f"Found LSD token: {tokens['lsd']}")
                 
                 # Extract haste session
                 hsi_match = re.search(r'"haste_session":"([^"]+)"', page_content)
                 if hsi_match:
-                    self.hsi = hsi_match.group(1)
-                    logging.info(f"Found haste session: {self.hsi}")
+                    tokens['hsi'] = hsi_match.group(1)
+                    logging.info(f"Found haste session: {tokens['hsi']}")
                 
                 # Extract spin parameters
                 spin_r_match = re.search(r'"__spin_r":(\d+),', page_content)
                 if spin_r_match:
-                    self.spin_r = spin_r_match.group(1)
-                    logging.info(f"Found spin_r: {self.spin_r}")
+                    tokens['spin_r'] = spin_r_match.group(1)
+                    logging.info(f"Found spin_r: {tokens['spin_r']}")
                 
                 spin_b_match = re.search(r'"__spin_b":"([^"]+)"', page_content)
                 if spin_b_match:
-                    self.spin_b = spin_b_match.group(1)
-                    logging.info(f"Found spin_b: {self.spin_b}")
+                    tokens['spin_b'] = spin_b_match.group(1)
+                    logging.info(f"Found spin_b: {tokens['spin_b']}")
                 
-                return True
+                # Cookies set by the Ad Library page belong with the tokens
+                tokens['cookies'] = self.session.cookies.get_dict()
+                return tokens
                 
         except Exception as e:
             logging.error(f"Error extracting page parameters: {str(e)}")
-            return False
+        return None
+
+    def _ensure_bootstrap(self, force: bool = False):
+        """Load bootstrap tokens from the shared cache, refreshing them when stale or rejected"""
+        if self.replay:
+            return
+        if not force and self.bootstrap.is_fresh(self.tokens):
+            return
+
+        tokens = self.bootstrap.get(self._extract_page_params, stale=self.tokens if force else None)
+        if not tokens:
+            logging.error("Could not bootstrap Ad Library session")
+            return
+
+        self.tokens = tokens
+        for name in ('fb_dtsg', 'client_revision', 'lsd', 'hsi', 'spin_r', 'spin_b'):
+            if name in tokens:
+                setattr(self, name, tokens[name])
+        self.session.cookies.update(tokens.get('cookies', {}))
+
+    def _is_auth_failure(self, data: Dict) -> bool:
+        """Check whether a GraphQL response rejected our session tokens"""
+        return isinstance(data, dict) and data.get('error') in self.AUTH_ERROR_CODES
 
     def _get_request_params(self):
         """Generate parameters for GraphQL request"""
+        self._ensure_bootstrap()
         return {
             'av': self.cookies.get('c_user', ''),
             '__user': self.cookies.get('c_user', ''),
@@ -763,43 +836,63 @@ def main():
     parser.add_argument('--page-id', type=str, help='Page ID for ads mode')
     parser.add_argument('--ad-archive-id', type=str, help='Ad Archive ID for detail mode')
     parser.add_argument('--data-dir', type=str, default='data', help='Directory for storing data')
+    parser.add_argument('--replay', action='store_true', help='Serve responses from the archive in --data-dir instead of the network')
+    parser.add_argument('--profile', action='store_true', help='Profile the run (CPU, wall-clock samples, allocations)')
+    parser.add_argument('--profile-dir', type=str, help='Directory for profiling reports (defaults to profiles/<timestamp>)')
     
     args = parser.parse_args()
+    profiler = Profiler(args.profile_dir) if args.profile else None
     
     try:
-        scraper = FacebookScraper(data_dir=args.data_dir)
+        with profile_stage(profiler, 'bootstrap'):
+            scraper = FacebookScraper(data_dir=args.data_dir, replay=args.replay)
+            scraper._ensure_bootstrap()
         
-        if args.mode == 'search':
-            if not args.query:
-                parser.error("--query is required for search mode")
-            pages = scraper.search_pages(args.query)
-            if pages:
-                print("\nFound Pages:")
-                print("-" * 80)
-                print(f"{'Page ID':<20} {'Name':<30} {'Verification':<15} {'Category':<15}")
-                print("-" * 80)
-                for page in pages:
-                    print(f"{page.id:<20} {page.name:<30} {page.verification_status:<15}")
-                print("-" * 80)
-                print(f"Total pages found: {len(pages)}")
-                
-        elif args.mode == 'ads':
-            if not args.page_id:
-                parser.error("--page-id is required for ads mode")
-            ads = scraper.get_page_ads(args.page_id)
-            if ads:
-                print(f"\nFound {len(ads)} ads for page ID: {args.page_id}")
-                
-        elif args.mode == 'adsdetail':
-            if not args.ad_archive_id:
-                parser.error("--ad-archive-id is required for adsdetail mode")
-            if not args.page_id:
-                parser.error("--page-id is required for adsdetail mode")
-            ad_details = scraper.get_ad_details(args.ad_archive_id, args.page_id)
-            if not ad_details:
-                print(f"No details found for ad {args.ad_archive_id}")
+        with profile_stage(profiler, args.mode):
+            run_mode(scraper, args, parser)
                 
     except KeyboardInterrupt:
         logging.info("Scraper stopped by user")
     except Exception as e:
         logging.error(f"Fatal error: {str(e)}")
+    finally:
+        if profiler is not None:
+            profiler.close()
+
+
+def run_mode(scraper: FacebookScraper, args, parser: argparse.ArgumentParser):
+    """Run the scraping mode selected on the command line"""
+    if args.mode == 'search':
+        if not args.query:
+            parser.error("--query is required for search mode")
+        pages = scraper.search_pages(args.query)
+        if pages:
+            print("\nFound Pages:")
+            print("-" * 80)
+            print(f"{'Page ID':<20} {'Name':<30} {'Verification':<15} {'Category':<15}")
+            print("-" * 80)
+            for page in pages:
+                print(f"{page.get('page_id', ''):<20} {str(page.get('name', ''))[:29]:<30} {str(page.get('verification', '')):<15} {str(page.get('category', '')):<15}")
+            print("-" * 80)
+            print(f"Total pages found: {len(pages)}")
+            
+    elif args.mode == 'ads':
+        if not args.page_id:
+            parser.error("--page-id is required for ads mode")
+        ads = scraper.get_page_ads(args.page_id, active=False, country=['IN'], limit=30)
+        edges = (ads or {}).get('data', {}).get('ad_library_main', {}).get('search_results_connection', {}).get('edges', [])
+        if edges:
+            print(f"\nFound {len(edges)} ads for page ID: {args.page_id}")
+            
+    elif args.mode == 'adsdetail':
+        if not args.ad_archive_id:
+            parser.error("--ad-archive-id is required for adsdetail mode")
+        if not args.page_id:
+            parser.error("--page-id is required for adsdetail mode")
+        ad_details = scraper.get_ad_details(args.ad_archive_id, args.page_id)
+        if not ad_details:
+            print(f"No details found for ad {args.ad_archive_id}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(names: Tuple[str, ...], labels: Dict) -> Tuple[str, ...]:
+    if set(labels) != set(names):
+        raise ValueError(f"Expected labels {names}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in names)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter with a fixed set of label names"""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(self.label_names, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(_label_key(self.label_names, labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value:g}")
+        return lines
+
+    def summary(self) -> Dict:
+        with self.lock:
+            return {"/".join(key) or "total": value for key, value in sorted(self.values.items())}
+
+
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus semantics) with a fixed set of label names"""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (+Inf last), count, sum, max]
+        self.series: Dict[Tuple[str, ...], list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.label_names, labels)
+        with self.lock:
+            series = self.series.setdefault(key, [[0] * (len(self.buckets) + 1), 0, 0.0, 0.0])
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += 1
+            series[2] += value
+            series[3] = max(series[3], value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Estimate a quantile by linear interpolation within buckets, capped at the largest observation"""
+        series = self.series.get(_label_key(self.label_names, labels))
+        return self._quantile(series, q) if series else None
+
+    def _quantile(self, series: list, q: float) -> Optional[float]:
+        counts, count, _, largest = series
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else largest
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, largest)
+            seen += bucket_count
+        return largest
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, count, total, _) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = 'le="+Inf"' if bound == float('inf') else f'le="{bound:g}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total:g}")
+        return lines
+
+    def summary(self) -> Dict:
+        with self.lock:
+            return {
+                "/".join(key) or "total": {
+                    'count': series[1],
+                    'sum': round(series[2], 6),
+                    'mean': round(series[2] / series[1], 6) if series[1] else None,
+                    'p50': self._quantile(series, 0.5),
+                    'p95': self._quantile(series, 0.95),
+                }
+                for key, series in sorted(self.series.items())
+            }
+
+
+class MetricsRegistry:
+    """Process-wide collection of metrics, exported as Prometheus text or a JSON summary"""
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.server = None
+
+    def _register(self, cls, name: str, *args, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self._register(Counter, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> Dict:
+        """Run summary: raw metrics plus a per-stage table and cache hit rates"""
+        stages = {}
+        for stage, stats in STAGE_SECONDS.summary().items():
+            stages[stage] = {
+                'calls': stats['count'],
+                'errors': int(STAGE_ERRORS.value(stage=stage)),
+                'total_s': stats['sum'],
+                'p50_ms': round(stats['p50'] * 1000, 2) if stats['p50'] is not None else None,
+                'p95_ms': round(stats['p95'] * 1000, 2) if stats['p95'] is not None else None,
+            }
+
+        caches = {}
+        for (cache, result), value in list(CACHE_REQUESTS.values.items()):
+            caches.setdefault(cache, {})[result] = value
+        for cache, results in caches.items():
+            total = sum(results.values())
+            results['hit_rate'] = round(results.get('hit', 0) / total, 4) if total else 0.0
+
+        return {
+            'started_at': self.started_at,
+            'duration_s': round(time.time() - self.started_at, 3),
+            'stages': dict(sorted(stages.items(), key=lambda item: -item[1]['total_s'])),
+            'caches': caches,
+            'metrics': {name: metric.summary() for name, metric in list(self.metrics.items())},
+        }
+
+    def write_summary(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def serve(self, port: int = 9108, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        """Serve /metrics (Prometheus text) and /summary (JSON) from a daemon thread"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.startswith('/metrics'):
+                    body, content_type = registry.render().encode('utf-8'), 'text/plain; version=0.0.4'
+                elif self.path.startswith('/summary'):
+                    body, content_type = json.dumps(registry.summary()).encode('utf-8'), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="metrics").start()
+        return self.server
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram('ads_stage_seconds', 'Latency of pipeline stage calls', ['stage'])
+STAGE_ERRORS = REGISTRY.counter('ads_stage_errors_total', 'Failed pipeline stage calls', ['stage'])
+STAGE_ITEMS = REGISTRY.counter('ads_stage_items_total', 'Items produced by pipeline stages (pages, ads, documents)', ['stage'])
+RATE_LIMIT_SLEEP = REGISTRY.counter('ads_rate_limit_sleep_seconds_total', 'Seconds spent sleeping in rate limiters', ['limiter'])
+RETRIES = REGISTRY.counter('ads_retries_total', 'Retried or retryable requests', ['service', 'reason'])
+CACHE_REQUESTS = REGISTRY.counter('ads_cache_requests_total', 'Cache lookups by result', ['cache', 'result'])
+LLM_TOKENS = REGISTRY.counter('ads_llm_tokens_total', 'LLM tokens used', ['model', 'stage', 'kind'])
+
+
+def tracked(stage: str):
+    """Decorator recording a call's latency under ``stage`` and counting exceptions that escape it"""
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                STAGE_ERRORS.inc(stage=stage)
+                raise
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+        return wrapped
+    return decorator
+
+
+def retry_hook(service: str):
+    """httpx response hook counting 429/5xx responses, which the OpenAI/Anthropic SDKs retry"""
+    def hook(response):
+        if response.status_code == 429 or response.status_code >= 500:
+            RETRIES.inc(service=service, reason=str(response.status_code))
+    return hook
+
+
+def usage_tokens(usage) -> Dict[str, int]:
+    """Normalize an OpenAI or Anthropic ``usage`` object to {input, output, cache_read, cache_write}"""
+    tokens = {'input': 0, 'output': 0, 'cache_read': 0, 'cache_write': 0}
+    if usage is None:
+        return tokens
+    if getattr(usage, 'prompt_tokens', None) is not None:
+        # OpenAI counts cached prompt tokens inside prompt_tokens
+        cached = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None) or 0
+        tokens['input'] = usage.prompt_tokens - cached
+        tokens['cache_read'] = cached
+        tokens['output'] = getattr(usage, 'completion_tokens', None) or 0
+    else:
+        tokens['input'] = getattr(usage, 'input_tokens', None) or 0
+        tokens['output'] = getattr(usage, 'output_tokens', None) or 0
+        tokens['cache_read'] = getattr(usage, 'cache_read_input_tokens', None) or 0
+        tokens['cache_write'] = getattr(usage, 'cache_creation_input_tokens', None) or 0
+    return tokens
+
+
+def record_usage(model: str, stage: str, usage) -> Dict[str, int]:
+    """Count tokens from an OpenAI or Anthropic ``usage`` object; returns the normalized counts"""
+    tokens = usage_tokens(usage)
+    for kind, value in tokens.items():
+        if value:
+            LLM_TOKENS.inc(value, model=model, stage=stage, kind=kind)
+    return tokens
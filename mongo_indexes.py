@@ -0,0 +1,84 @@
+import logging
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from prompts import FACET_FIELDS
+
+# (keys, options) for every index the ads collection relies on
+AD_INDEXES = [
+    # Only real IDs are unique: ads scraped without ad_archive_id are stored with ""
+    ([('ad_id', ASCENDING)], {'unique': True, 'partialFilterExpression': {'ad_id': {'$type': 'string', '$gt': ''}}}),
+    ([('advertiser_info.page_id', ASCENDING)], {}),
+    ([('ad_info.start_date', DESCENDING)], {}),
+    ([('product_type', ASCENDING), ('price_tier', ASCENDING)], {}),
+    ([('cluster_id', ASCENDING)], {}),
+] + [([(field, ASCENDING)], {}) for field in FACET_FIELDS if field != 'product_type']
+
+# Indexes earlier versions created that are now redundant: the
+# (product_type, price_tier) prefix already serves product_type filters
+REDUNDANT_INDEXES = ['product_type_1']
+
+
+def index_name(keys) -> str:
+    """MongoDB's default index name, e.g. 'ad_info.start_date_-1'"""
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+def remove_duplicate_ads(collection, dry_run: bool = False) -> int:
+    """Keep only the most recently processed document for each ad_id; returns the number removed
+
+    Documents without an ad_id (missing, null or "") are never touched. Among
+    duplicates, the survivor is the latest by processed_at, then by insertion
+    (_id), so legacy documents without processed_at lose to newer ones.
+    """
+    duplicates = collection.aggregate([
+        {'$match': {'ad_id': {'$nin': [None, '']}}},
+        {'$sort': {'processed_at': -1, '_id': -1}},
+        {'$group': {'_id': '$ad_id', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ], allowDiskUse=True)
+    stale = []
+    for group in duplicates:
+        logging.info(f"ad_id {group['_id']}: keeping {group['ids'][0]}, {'would remove' if dry_run else 'removing'} {[str(doc_id) for doc_id in group['ids'][1:]]}")
+        stale.extend(group['ids'][1:])
+    logging.info(f"{'Would remove' if dry_run else 'Removing'} {len(stale)} duplicate ad documents")
+    if stale and not dry_run:
+        collection.delete_many({'_id': {'$in': stale}})
+    return len(stale)
+
+
+def ensure_indexes(collection) -> bool:
+    """Create the ads collection indexes and verify they all exist
+
+    Never modifies documents: if duplicate ad_ids block the unique index, it
+    is reported and left to ``remove_duplicate_ads`` (``ads_pipeline.py dedupe``).
+    An index created with older options (e.g. ad_id unique without the
+    partial filter) is dropped and recreated, and redundant ones are dropped.
+    """
+    current = collection.index_information()
+    for name in REDUNDANT_INDEXES:
+        if name in current:
+            logging.info(f"Dropping redundant index {name}")
+            collection.drop_index(name)
+    for keys, options in AD_INDEXES:
+        try:
+            previous = current.get(index_name(keys))
+            if previous is not None and any(previous.get(option) != value for option, value in options.items()):
+                logging.info(f"Recreating index {index_name(keys)} with options {options}")
+                collection.drop_index(index_name(keys))
+            collection.create_index(keys, **options)
+        except (DuplicateKeyError, OperationFailure) as e:
+            if options.get('unique') and getattr(e, 'code', None) == 11000:
+                logging.error(f"Duplicate values block unique index {index_name(keys)}; "
+                              f"run `python ads_pipeline.py dedupe --dry-run` to review them, then `dedupe` to remove them")
+            else:
+                logging.error(f"Error creating index {index_name(keys)}: {e}")
+
+    existing = collection.index_information()
+    missing = [index_name(keys) for keys, _ in AD_INDEXES if index_name(keys) not in existing]
+    if missing:
+        logging.error(f"Missing MongoDB indexes: {missing}")
+        return False
+    logging.info(f"Verified {len(AD_INDEXES)} MongoDB indexes on {collection.name}")
+    return True
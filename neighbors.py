@@ -0,0 +1,233 @@
+import io
+import json
+import logging
+import os
+import re
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from clustering import index_vectors
+from metrics import tracked
+from vector_store import _fsync_dir, _write_atomic
+
+GRAPH_PATTERN = re.compile(r'^graph-(\d+)$')
+
+
+def _unique(ad_ids: List[str], vectors: np.ndarray) -> Tuple[List[str], np.ndarray]:
+    """First vector of each ad ID"""
+    rows, seen = [], set()
+    for row, ad_id in enumerate(ad_ids):
+        if ad_id not in seen:
+            seen.add(ad_id)
+            rows.append(row)
+    return [ad_ids[row] for row in rows], np.ascontiguousarray(np.asarray(vectors, dtype='float32')[rows])
+
+
+class NeighborLists:
+    """One loaded graph: row-aligned ad IDs, neighbour rows and their distances"""
+
+    def __init__(self, name: str, ad_ids: List[str], neighbors: np.ndarray, distances: np.ndarray):
+        self.name = name
+        self.ad_ids = ad_ids
+        self.neighbors = neighbors
+        self.distances = distances
+        self.rows: Dict[str, int] = {ad_id: row for row, ad_id in enumerate(ad_ids)}
+
+    @property
+    def n_neighbors(self) -> int:
+        return self.neighbors.shape[1]
+
+    def similar(self, ad_id: str, k: int = None) -> List[Tuple[str, float]]:
+        """(ad_id, squared L2 distance) of an ad's stored neighbours, closest first; [] for unknown ads"""
+        row = self.rows.get(ad_id)
+        if row is None:
+            return []
+        neighbors, distances = self.neighbors[row][:k], self.distances[row][:k]
+        return [(self.ad_ids[neighbor], float(distance)) for neighbor, distance in zip(neighbors, distances) if neighbor >= 0]
+
+
+class NeighborGraph:
+    """Materialized top-N nearest neighbours of every indexed ad.
+
+    Layout under ``root``:
+
+    - ``graph-<n>/ids.json``: ad ID of each row
+    - ``graph-<n>/neighbors.npy``: (rows, N) int32 neighbour rows, -1 (at float max distance) where an ad has fewer than N neighbours
+    - ``graph-<n>/distances.npy``: (rows, N) float32 squared L2 distances, ascending
+    - ``CURRENT``: name of the published graph, replaced with an atomic rename
+
+    Neighbours are computed offline with batched FAISS searches over the
+    stored vectors, so a "more like this" lookup is a dict lookup and a row
+    read, with no embedding call and no index scan. ``update`` only searches
+    for what changed when ads are added: new ads against every ad, and
+    existing ads against the new ones, reading the vectors in place from the
+    flat index.
+    """
+
+    def __init__(self, root: str = "neighbor_graph", n_neighbors: int = 20, batch_size: int = 1024, keep_graphs: int = 2):
+        """
+        Args:
+            root (str): Graph directory
+            n_neighbors (int): Neighbours stored per ad
+            batch_size (int): Query rows per FAISS search
+            keep_graphs (int): Published graphs kept on disk for readers still loading them
+        """
+        self.root = root
+        self.n_neighbors = n_neighbors
+        self.batch_size = batch_size
+        self.keep_graphs = keep_graphs
+
+    def current(self) -> Optional[str]:
+        """Name of the published graph, or None if nothing was published yet"""
+        try:
+            with open(os.path.join(self.root, "CURRENT"), "r") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def load(self, name: str = None, mmap: bool = True) -> Optional[NeighborLists]:
+        """Load a published graph (the current one by default); its arrays are memory-mapped"""
+        name = name or self.current()
+        if name is None:
+            return None
+        directory = os.path.join(self.root, name)
+        with open(os.path.join(directory, "ids.json"), "r") as f:
+            ad_ids = json.load(f)
+        mode = 'r' if mmap else None
+        return NeighborLists(name, ad_ids,
+                             np.load(os.path.join(directory, "neighbors.npy"), mmap_mode=mode),
+                             np.load(os.path.join(directory, "distances.npy"), mmap_mode=mode))
+
+    def _search(self, index: faiss.Index, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Batched index.search; returns (distances, rows)"""
+        distances = np.empty((len(queries), k), dtype='float32')
+        rows = np.empty((len(queries), k), dtype='int64')
+        for start in range(0, len(queries), self.batch_size):
+            distances[start:start + self.batch_size], rows[start:start + self.batch_size] = index.search(queries[start:start + self.batch_size], k)
+        return distances, rows
+
+    def _without_self(self, distances: np.ndarray, rows: np.ndarray, own_rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Drop each query's own row from its k + 1 results, leaving k"""
+        keep = rows != own_rows[:, None]
+        # An exact duplicate can push an ad's own row out of its results; drop the farthest instead
+        keep[keep.all(axis=1), -1] = False
+        k = rows.shape[1] - 1
+        return distances[keep].reshape(-1, k), rows[keep].reshape(-1, k)
+
+    def _neighbors_of(self, vectors: np.ndarray, queries: np.ndarray, own_rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-N neighbours among ``vectors`` for rows ``own_rows`` of it"""
+        index = faiss.IndexFlatL2(vectors.shape[1])
+        index.add(vectors)
+        distances, rows = self._search(index, queries, self.n_neighbors + 1)
+        return self._without_self(distances, rows, own_rows)
+
+    @tracked('neighbor_graph')
+    def build(self, ad_ids: List[str], vectors: np.ndarray) -> int:
+        """Compute every ad's neighbours from scratch and publish the graph; returns the number of ads"""
+        ad_ids, vectors = _unique(ad_ids, vectors)
+        if not ad_ids:
+            logging.warning("No vectors to build a neighbour graph from")
+            return 0
+        distances, rows = self._neighbors_of(vectors, vectors, np.arange(len(ad_ids)))
+        self._publish(ad_ids, rows, distances)
+        return len(ad_ids)
+
+    @tracked('neighbor_graph')
+    def update(self, index: faiss.Index, ad_ids: List[str]) -> int:
+        """Add ads of a flat index missing from the published graph and refresh the lists they enter; returns the number added
+
+        ``ad_ids`` is row-aligned with ``index``. Only the new ads' vectors are
+        copied: they are searched against the index, and the index's rows are
+        searched, a batch at a time, against the new ads alone. Falls back to
+        ``build`` when there is no graph yet, when N changed, or when ads in
+        the graph are no longer indexed (the index was rebuilt).
+        """
+        graph = self.load()
+        if graph is None or graph.n_neighbors != self.n_neighbors or not graph.rows.keys() <= set(ad_ids):
+            return self.build(ad_ids, index_vectors(index))
+
+        # Graph row of every index row: existing ads keep theirs, new ones are
+        # appended after them, and repeats of an already-seen ad get -1
+        old = len(graph.ad_ids)
+        graph_rows = np.full(len(ad_ids), -1, dtype='int64')
+        positions: Dict[str, int] = {}
+        new_ids, new_index_rows = [], []
+        for row, ad_id in enumerate(ad_ids):
+            if ad_id in positions:
+                continue
+            if ad_id in graph.rows:
+                positions[ad_id] = graph.rows[ad_id]
+            else:
+                positions[ad_id] = old + len(new_ids)
+                new_ids.append(ad_id)
+                new_index_rows.append(row)
+            graph_rows[row] = positions[ad_id]
+        if not new_ids:
+            return 0
+
+        vectors = index_vectors(index)
+        new_vectors = np.ascontiguousarray(vectors[new_index_rows])
+
+        # New ads against every ad, with room for their own and repeated rows
+        repeated = int((graph_rows < 0).sum())
+        distances, rows = self._search(index, new_vectors, min(self.n_neighbors + 1 + repeated, index.ntotal))
+        rows = np.where(rows >= 0, graph_rows[rows], -1)
+        new_neighbors = np.full((len(new_ids), self.n_neighbors), -1, dtype='int64')
+        new_distances = np.full((len(new_ids), self.n_neighbors), np.finfo('float32').max, dtype='float32')
+        for i in range(len(new_ids)):
+            keep = (rows[i] >= 0) & (rows[i] != old + i)
+            found = rows[i][keep][:self.n_neighbors]
+            new_neighbors[i, :len(found)] = found
+            new_distances[i, :len(found)] = distances[i][keep][:self.n_neighbors]
+
+        # New ads can only displace an existing ad's farthest neighbours, so search them alone
+        fresh = faiss.IndexFlatL2(index.d)
+        fresh.add(new_vectors)
+        k = min(self.n_neighbors, len(new_ids))
+        candidate_distances = np.full((old, k), np.finfo('float32').max, dtype='float32')
+        candidate_rows = np.full((old, k), -1, dtype='int64')
+        for start in range(0, len(ad_ids), self.batch_size):
+            targets = graph_rows[start:start + self.batch_size]
+            existing = (targets >= 0) & (targets < old)
+            if not existing.any():
+                continue
+            batch_distances, batch_rows = fresh.search(vectors[start:start + self.batch_size][existing], k)
+            candidate_distances[targets[existing]] = batch_distances
+            candidate_rows[targets[existing]] = np.where(batch_rows >= 0, batch_rows + old, -1)
+
+        distances = np.concatenate([graph.distances, candidate_distances], axis=1)
+        rows = np.concatenate([graph.neighbors.astype('int64'), candidate_rows], axis=1)
+        closest = np.argsort(distances, axis=1, kind='stable')[:, :self.n_neighbors]
+        old_distances = np.take_along_axis(distances, closest, axis=1)
+        old_neighbors = np.take_along_axis(rows, closest, axis=1)
+
+        self._publish(graph.ad_ids + new_ids, np.concatenate([old_neighbors, new_neighbors]), np.concatenate([old_distances, new_distances]))
+        return len(new_ids)
+
+    def _publish(self, ad_ids: List[str], neighbors: np.ndarray, distances: np.ndarray):
+        """Write a new graph directory and point CURRENT at it"""
+        os.makedirs(self.root, exist_ok=True)
+        previous = self.current()
+        number = int(GRAPH_PATTERN.match(previous).group(1)) + 1 if previous else 1
+        name = f"graph-{number:06d}"
+        directory = os.path.join(self.root, name)
+        os.makedirs(directory, exist_ok=True)
+
+        for filename, array in (("neighbors.npy", neighbors.astype('int32')), ("distances.npy", distances.astype('float32'))):
+            buffer = io.BytesIO()
+            np.save(buffer, array)
+            _write_atomic(os.path.join(directory, filename), buffer.getvalue())
+        _write_atomic(os.path.join(directory, "ids.json"), json.dumps(ad_ids).encode('utf-8'))
+        _fsync_dir(directory)
+        _write_atomic(os.path.join(self.root, "CURRENT"), f"{name}\n".encode('utf-8'))
+        self._collect_garbage()
+        logging.info(f"Published neighbour graph {name} ({len(ad_ids)} ads, {neighbors.shape[1]} neighbours each)")
+
+    def _collect_garbage(self):
+        """Remove graphs older than the last keep_graphs"""
+        graphs = sorted(name for name in os.listdir(self.root) if GRAPH_PATTERN.match(name))
+        for name in graphs[:-self.keep_graphs]:
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
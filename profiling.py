@@ -0,0 +1,198 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Dict, Optional
+
+
+class WallSampler:
+    """Samples every thread's stack at a fixed interval, for wall-clock flamegraphs.
+
+    cProfile only sees the thread that enabled it and counts CPU work; the
+    sampler also shows where download and worker threads spend time waiting.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.labels: Dict[object, str] = {}
+        self.stage: Optional[str] = None
+        self.samples: Dict[str, Counter] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            stage = self.stage
+            if stage is None:
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            counts = self.samples.setdefault(stage, Counter())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = self.labels.get(code)
+                    if label is None:
+                        label = self.labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    stack.append(label)
+                    frame = frame.f_back
+                counts[";".join([names.get(ident, str(ident))] + stack[::-1])] += 1
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True, name="wall-sampler")
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def collapsed(self, stage: str) -> str:
+        """Samples in collapsed-stack format (flamegraph.pl, speedscope)"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.get(stage, Counter()).most_common())
+
+
+class Profiler:
+    """Per-stage CPU (cProfile), wall-clock (stack sampling) and allocation (tracemalloc) profiling.
+
+    Wrap coarse stages in ``with profiler.stage(name):``; entering a stage again
+    accumulates into the same reports. ``close()`` writes, per stage:
+
+    - ``<stage>.pstats`` / ``<stage>.txt``: cProfile stats and the top functions by cumulative time
+    - ``<stage>.collapsed``: wall-clock stack samples of all threads, for flamegraphs
+    - ``<stage>.alloc.txt``: source lines with the largest net allocations during the stage
+
+    plus a ``summary.json`` with wall time, CPU time and peak traced memory per stage.
+    """
+
+    def __init__(self, run_dir: str = None, sample_interval: float = 0.01, top: int = 40, traceback_frames: int = 1):
+        """
+        Args:
+            run_dir (str): Output directory (defaults to profiles/<timestamp>)
+            sample_interval (float): Seconds between wall-clock stack samples
+            top (int): Number of functions and allocation sites listed in text reports
+            traceback_frames (int): Frames tracemalloc keeps per allocation; reports group by
+                the innermost one, and each extra frame slows traced code down further
+        """
+        self.run_dir = run_dir or os.path.join("profiles", datetime.now().strftime("%Y%m%d-%H%M%S"))
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.top = top
+        self.traceback_frames = traceback_frames
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.allocations: Dict[str, Dict] = {}
+        self.totals: Dict[str, Dict] = {}
+        self.sampler = WallSampler(sample_interval)
+        self.active: Optional[str] = None
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.active is not None:
+            # cProfile and the sampler are per run, not per nesting level
+            logging.debug(f"Profiling stage {name} runs inside {self.active}; reported as part of it")
+            yield
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.traceback_frames)
+        tracemalloc.reset_peak()
+        before = self._snapshot()
+
+        profile = self.profiles.get(name) or cProfile.Profile()
+        try:
+            profile.enable()
+            self.profiles[name] = profile
+        except ValueError as e:
+            # Another profiler (a debugger, coverage) already owns the hook
+            logging.warning(f"CPU profiling disabled for {name}: {e}")
+            profile = None
+
+        self.active = name
+        self.sampler.stage = name
+        self.sampler.start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            self.sampler.stage = None
+            self.active = None
+            if profile is not None:
+                profile.disable()
+
+            peak = tracemalloc.get_traced_memory()[1]
+            after = self._snapshot()
+            self._add_allocations(name, after.compare_to(before, 'lineno'))
+
+            totals = self.totals.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_traced_mb': 0.0})
+            totals['calls'] += 1
+            totals['wall_s'] += wall
+            totals['cpu_s'] += cpu
+            totals['peak_traced_mb'] = max(totals['peak_traced_mb'], peak / 1024 / 1024)
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ])
+
+    def _add_allocations(self, name: str, diffs):
+        sites = self.allocations.setdefault(name, {})
+        for diff in diffs:
+            if diff.size_diff <= 0:
+                continue
+            frame = diff.traceback[0]
+            site = sites.setdefault(f"{frame.filename}:{frame.lineno}", {'size': 0, 'count': 0})
+            site['size'] += diff.size_diff
+            site['count'] += diff.count_diff
+
+    def close(self) -> str:
+        """Stop sampling and write every stage's reports; returns the run directory"""
+        self.sampler.stop()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(self.run_dir, f"{name}.pstats"))
+            report = io.StringIO()
+            stats = pstats.Stats(profile, stream=report)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            stats.sort_stats('tottime').print_stats(self.top)
+            with open(os.path.join(self.run_dir, f"{name}.txt"), 'w') as f:
+                f.write(report.getvalue())
+
+        for name in self.totals:
+            with open(os.path.join(self.run_dir, f"{name}.collapsed"), 'w') as f:
+                f.write(self.sampler.collapsed(name))
+
+        for name, sites in self.allocations.items():
+            ranked = sorted(sites.items(), key=lambda item: -item[1]['size'])[:self.top]
+            with open(os.path.join(self.run_dir, f"{name}.alloc.txt"), 'w') as f:
+                f.write(f"{'KiB':>12} {'blocks':>10}  site\n")
+                for site, stats in ranked:
+                    f.write(f"{stats['size'] / 1024:>12.1f} {stats['count']:>10}  {site}\n")
+
+        with open(os.path.join(self.run_dir, "summary.json"), 'w') as f:
+            json.dump({name: {key: round(value, 4) if isinstance(value, float) else value for key, value in totals.items()}
+                       for name, totals in self.totals.items()}, f, indent=2)
+        logging.info(f"Wrote profiles to {self.run_dir}")
+        return self.run_dir
+
+
+def profile_stage(profiler: Optional[Profiler], name: str):
+    """``profiler.stage(name)``, or a no-op context when profiling is off"""
+    return profiler.stage(name) if profiler is not None else nullcontext()
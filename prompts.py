@@ -0,0 +1,150 @@
+import json
+import re
+from typing import Dict, List, Optional
+
+ENRICHMENT_MODEL = "claude-3-5-sonnet-20240620"
+
+# The answer is a short JSON object; 8192 only made the API reserve a long generation
+ENRICHMENT_MAX_TOKENS = 1024
+
+PRICE_TIERS = ["budget", "mid-range", "premium", "luxury", "unknown"]
+
+PRODUCT_TYPES = [
+    "serum", "moisturizer", "cleanser", "sunscreen", "toner", "face mask", "eye cream",
+    "exfoliant", "face oil", "lip care", "body care", "hair care", "makeup", "supplement",
+    "device", "kit", "other",
+]
+
+MARKETING_ANGLES = [
+    "ingredient-led", "results", "clinical", "natural", "luxury", "value",
+    "social proof", "problem-solution", "education", "other",
+]
+
+# Enrichment fields stored as top-level, indexed document fields
+FACET_FIELDS = ["price_tier", "product_type", "key_benefits", "target_audience", "marketing_angle"]
+
+# Static across every ad, so it is sent as a cacheable system prefix
+ENRICHMENT_INSTRUCTIONS = f"""You analyze skincare advertisements and their creative content in relation to the search keywords that surfaced them. Evaluate:
+
+- The main features of the product being advertised.
+- Visual elements analysis (imagery, colors, layout, text overlays).
+- How the visual content supports the marketing message.
+- How well the ad's target audience aligns with the search intent implied by the keywords.
+- The key benefits of the product as emphasized in both text and visuals.
+- Pricing information, including its positioning (e.g., affordable, premium) if mentioned.
+- The marketing strategy or angle employed to appeal to potential customers.
+- The relevance of both the advertisement's content and visuals to the specified search keywords.
+
+Analyze both the ad text and the attached image or video keyframes (if any).
+Ensure your analysis is concise, actionable, and aligned with the perspective of enhancing advertising effectiveness.
+
+Provide your answer within <answer> tags as a single JSON object with exactly these keys:
+- "summary": the evaluation above as concise prose (at most 200 words).
+- "price_tier": one of {json.dumps(PRICE_TIERS)}.
+- "product_type": one of {json.dumps(PRODUCT_TYPES)}.
+- "key_benefits": up to 5 short lowercase benefit phrases, e.g. ["hydration", "brightening"].
+- "target_audience": a short lowercase phrase, e.g. "women 25-40 with dry skin".
+- "marketing_angle": one of {json.dumps(MARKETING_ANGLES)}."""
+
+MAX_FIELD_CHARS = 1500
+MAX_CARDS = 5
+
+
+def _clean(value) -> Optional[str]:
+    """Collapse whitespace and truncate a text field; None for empty or non-text values"""
+    if isinstance(value, dict):
+        value = value.get('text')
+    if not isinstance(value, str):
+        return None
+    value = re.sub(r'\s+', ' ', value).strip()
+    return value[:MAX_FIELD_CHARS] or None
+
+
+def compact_ad(snapshot: Dict) -> str:
+    """Project the fields of an ad snapshot that matter for analysis into 'key: value' lines"""
+    fields = [
+        ('advertiser', snapshot.get('page_name')),
+        ('format', snapshot.get('display_format')),
+        ('title', snapshot.get('title')),
+        ('body', snapshot.get('body')),
+        ('caption', snapshot.get('caption')),
+        ('link_description', snapshot.get('link_description')),
+        ('cta', snapshot.get('cta_text')),
+    ]
+    lines = [f"{name}: {text}" for name, value in fields if (text := _clean(value))]
+
+    categories = [c for c in snapshot.get('page_categories') or [] if isinstance(c, str)]
+    if categories:
+        lines.append(f"page_categories: {', '.join(categories)}")
+
+    seen = set()
+    for card in (snapshot.get('cards') or [])[:MAX_CARDS]:
+        if not isinstance(card, dict):
+            continue
+        text = " | ".join(t for t in (_clean(card.get('title')), _clean(card.get('body'))) if t)
+        if text and text not in seen:
+            seen.add(text)
+            lines.append(f"card: {text}")
+
+    return "\n".join(lines)
+
+
+def build_enrichment_request(snapshot: Dict, keywords: str, creatives: List[str], media_type: str) -> Dict:
+    """Keyword arguments for ``messages.create`` analysing one ad"""
+    content = [
+        {
+            "type": "image",
+            "source": {"type": "base64", "media_type": "image/jpeg", "data": creative}
+        }
+        for creative in creatives
+    ]
+
+    text = f"Search keywords: {keywords}\n\nAd:\n{compact_ad(snapshot)}"
+    if media_type == "VIDEO" and creatives:
+        text += "\n\nThe attached images are keyframes sampled from the video ad, in playback order."
+    content.append({"type": "text", "text": text})
+
+    return {
+        "model": ENRICHMENT_MODEL,
+        "max_tokens": ENRICHMENT_MAX_TOKENS,
+        "temperature": 0,
+        "system": [
+            {
+                "type": "text",
+                "text": ENRICHMENT_INSTRUCTIONS,
+                "cache_control": {"type": "ephemeral"}
+            }
+        ],
+        "messages": [{"role": "user", "content": content}],
+    }
+
+
+def _choice(value, choices: List[str], default: str) -> str:
+    value = value.strip().lower() if isinstance(value, str) else ""
+    return value if value in choices else default
+
+
+def parse_enrichment(response: str) -> Optional[Dict]:
+    """Parse the <answer> JSON of an enrichment response into the stored schema"""
+    match = re.search(r"<answer>(.*?)</answer>", response, re.DOTALL)
+    if not match:
+        return None
+    answer = match.group(1).strip()
+
+    try:
+        data = json.loads(answer)
+    except json.JSONDecodeError:
+        # Keep the prose even if the model didn't return valid JSON
+        data = {'summary': answer}
+    if not isinstance(data, dict):
+        data = {'summary': answer}
+
+    benefits = data.get('key_benefits')
+    return {
+        'summary': _clean(data.get('summary')) or answer,
+        'price_tier': _choice(data.get('price_tier'), PRICE_TIERS, "unknown"),
+        'product_type': _choice(data.get('product_type'), PRODUCT_TYPES, "other"),
+        'key_benefits': [b.strip().lower() for b in benefits if isinstance(b, str) and b.strip()][:5] if isinstance(benefits, list) else [],
+        'target_audience': (_clean(data.get('target_audience')) or "").lower() or None,
+        'marketing_angle': _choice(data.get('marketing_angle'), MARKETING_ANGLES, "other"),
+    }
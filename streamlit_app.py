@@ -1,25 +1,21 @@
 import streamlit as st
-import pandas as pd
-from ads_pipeline import AdsPipeline
+from ads_search import AdsSearch
 import os
-from datetime import datetime
-import json
 from dotenv import load_dotenv
 
-load_dotenv()
-
-mongo_uri = os.getenv("MONGO_URI")
-openai_api_key = os.getenv("OPENAI_API_KEY")
-anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-    
-pipeline = AdsPipeline(
-    openai_api_key=openai_api_key,
-    anthropic_api_key=anthropic_api_key,
-    mongo_uri=mongo_uri,
-    keywords_file='skincare_keywords.csv',
-    use_proxy=False,
-    verbose=False
-)
+@st.cache_resource
+def get_searcher() -> AdsSearch:
+    """Process-wide search facade, shared across reruns and sessions"""
+    load_dotenv()
+    searcher = AdsSearch(
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        mongo_uri=os.getenv("MONGO_URI"),
+        # e.g. the representatives-only index written by `ads_pipeline.py cluster --representatives-dir`
+        index_dir=os.getenv("SEARCH_INDEX_DIR", "vector_index"),
+    )
+    # Pick up newly published index generations without a restart
+    searcher.watch()
+    return searcher
 
 st.set_page_config(
     page_title="Ads Analysis Dashboard",
@@ -130,13 +126,28 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+@st.cache_data(max_entries=500)
+def load_thumbnail(ref):
+    """Thumbnail bytes, cached across reruns"""
+    return get_searcher().thumbnail(ref)
+
 def display_ad_card(result, index):
     """Display compact version of ad card"""
     with st.container():
-        if result.get('ad_info', {}).get('display_format') == "VIDEO":
-            st.video(result['ad_info']['videos'][0]['video_sd_url'])
-        elif result.get('ad_info', {}).get('display_format') == "IMAGE":
-            st.image(result['ad_info']['images'][0]['original_image_url'], use_container_width =True)
+        thumbnail = load_thumbnail(result.get('thumbnail'))
+        if thumbnail:
+            st.image(thumbnail, use_container_width =True)
+
+        # Full-size media comes straight from the Facebook CDN, so only load it on request
+        display_format = result.get('ad_info', {}).get('display_format')
+        if display_format in ("VIDEO", "IMAGE") and st.toggle("Show full media", key=f"media_{index}_{result.get('ad_id')}"):
+            try:
+                if display_format == "VIDEO":
+                    st.video(result['ad_info']['videos'][0]['video_sd_url'])
+                else:
+                    st.image(result['ad_info']['images'][0]['original_image_url'], use_container_width =True)
+            except (KeyError, IndexError):
+                st.caption("Media not available")
 
         title = result.get('ad_info', {}).get('title', 'No Title')
         if title:
@@ -144,8 +155,19 @@ def display_ad_card(result, index):
         else:
             st.markdown("### No Title")
         st.markdown(f"**Ad ID:** {result.get('ad_id', 'N/A')}")
+        if (result.get('cluster_size') or 1) > 1:
+            st.caption(f"+{result['cluster_size'] - 1} near-duplicate variants")
         st.markdown(result.get('ad_info', {}).get('body', 'No content available'))
 
+        # Answered from the precomputed neighbour graph, without embedding anything
+        if st.toggle("More like this", key=f"similar_{index}_{result.get('ad_id')}"):
+            similar = get_searcher().more_like_this(result.get('ad_id'), k=5)
+            if similar:
+                for ad in similar:
+                    st.markdown(f"- **{ad.get('ad_info', {}).get('title') or 'No Title'}** · {ad.get('advertiser_info', {}).get('page_name', '')} ({ad['ad_id']}, {ad['relevance_score']:.3f})")
+            else:
+                st.caption("No similar ads computed for this ad yet")
+
         with st.expander("More Details"):
             st.markdown(f'''<div class="metric-container">
                         <p class="metric-label">Page Likes</p>
@@ -154,26 +176,64 @@ def display_ad_card(result, index):
             
             st.markdown(f'''<div class="metric-container">
                         <p class="metric-label">Relevance Score</p>
-                        <p class="metric-value">0.788</p>
+                        <p class="metric-value">{result.get("relevance_score", 0):.3f}</p>
                         </div>''', unsafe_allow_html=True)
             
-            active_time = result.get('ad_info', {}).get('total_active_time', 0) / 3600
+            active_time = (result.get('ad_info', {}).get('total_active_time') or 0) / 3600
             st.markdown(f'''<div class="metric-container">
                         <p class="metric-label">Active Time (hours)</p>
                         <p class="metric-value">{active_time:.1f}</p>
                         </div>''', unsafe_allow_html=True)
         
+            if result.get('product_type'):
+                st.markdown(f"**Product:** {result['product_type']} · **Price tier:** {result.get('price_tier', 'unknown')} · **Angle:** {result.get('marketing_angle', 'other')}")
+            if result.get('key_benefits'):
+                st.markdown(f"**Key benefits:** {', '.join(result['key_benefits'])}")
+            if result.get('target_audience'):
+                st.markdown(f"**Target audience:** {result['target_audience']}")
+
+            # Search results only carry card fields; the full document is fetched on demand
+            if not st.toggle("Show full details", key=f"details_{index}_{result.get('ad_id')}"):
+                return
+            details = get_searcher().get_ad(result.get('ad_id')) or {}
+
             st.markdown(f"#### Ad Info")
-            st.json(result.get('ad_info', {}))
+            st.json(details.get('ad_info', {}))
 
             st.markdown(f"#### Advertiser Info")
-            st.json(result.get('advertiser_info', {}))
-                
+            st.json(details.get('advertiser_info', {}))
+
+            st.markdown(f"#### Company")
+            st.markdown(details.get('company_description') or 'No description available')
+
             st.markdown(f"#### Ad Analysis")
             st.markdown(f"""
-            {result.get('enriched_data', 'No analysis available')}
+            {details.get('enriched_data', 'No analysis available')}
             """, unsafe_allow_html=True)
 
+@st.cache_data(ttl=300)
+def facet_counts(field):
+    """Indexed facet counts, refreshed every few minutes"""
+    return get_searcher().facet_counts(field)
+
+def facet_filters():
+    """Sidebar facet selectors; returns {field: [selected values]}"""
+    st.sidebar.header("Filters")
+    filters = {}
+    for field, label in [('product_type', 'Product type'), ('price_tier', 'Price tier'), ('marketing_angle', 'Marketing angle')]:
+        try:
+            counts = dict(facet_counts(field))
+        except Exception:
+            counts = {}
+        selected = st.sidebar.multiselect(label, options=list(counts), format_func=lambda value, counts=counts: f"{value} ({counts[value]})")
+        if selected:
+            filters[field] = selected
+    return filters
+
+def collapse_toggle():
+    """Sidebar switch for showing one result per near-duplicate cluster"""
+    return st.sidebar.toggle("Collapse near-duplicates", value=True)
+
 def main():    
     st.image("assets/banner.png", use_container_width=True)
     st.title("Ads Analysis Dashboard")
@@ -183,12 +243,16 @@ def main():
         placeholder="e.g., luxury anti-aging cream",
         key="search_input"
     )
+    filters = facet_filters()
+    collapse = collapse_toggle()
     
-    if search_query:
-        search_query = search_query.lower()
+    if search_query or filters:
         try:
             with st.spinner('Searching for relevant ads...'):
-                results = pipeline.search_ads(search_query)
+                if search_query:
+                    results = get_searcher().search(search_query.lower(), filters=filters, collapse=collapse)
+                else:
+                    results = get_searcher().filter_ads(filters)
             
             if results:
                 st.success(f"Found {len(results)} relevant ads!")
@@ -207,7 +271,7 @@ def main():
             st.error(f"An error occurred: {str(e)}")
             
     else:
-        st.info("Enter a search query to start exploring ads.")
+        st.info("Enter a search query or pick filters to start exploring ads.")
     
 
 if __name__ == "__main__":
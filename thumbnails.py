@@ -0,0 +1,79 @@
+import io
+import logging
+import os
+from typing import Optional
+
+from PIL import Image
+
+GRIDFS_PREFIX = "gridfs:"
+
+
+class ThumbnailStore:
+    """Small JPEG thumbnails for dashboard cards, kept on local disk or in GridFS"""
+
+    def __init__(self, directory: str = "thumbnails", db=None, size: int = 320, quality: int = 75):
+        """
+        Args:
+            directory (str): Local thumbnail directory (ignored when db is given)
+            db: MongoDB database; when given, thumbnails are stored in its 'thumbnails' GridFS bucket
+            size (int): Longest edge of a thumbnail in pixels
+            quality (int): JPEG quality of thumbnails
+        """
+        self.directory = directory
+        self.size = size
+        self.quality = quality
+        self.fs = None
+        if db is not None:
+            import gridfs
+
+            self.fs = gridfs.GridFS(db, collection="thumbnails")
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+    def make(self, content: bytes) -> Optional[bytes]:
+        """Downscale an image (or video poster frame) to a thumbnail JPEG"""
+        try:
+            image = Image.open(io.BytesIO(content))
+            if image.format == 'JPEG':
+                image.draft('RGB', (self.size, self.size))
+            image = image.convert('RGB')
+            image.thumbnail((self.size, self.size), Image.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=self.quality, optimize=True)
+            return buffer.getvalue()
+        except Exception as e:
+            logging.debug(f"Error making thumbnail: {e}")
+            return None
+
+    def save(self, ad_id: str, content: bytes) -> Optional[str]:
+        """Store a thumbnail for an ad and return its reference (file path or 'gridfs:<ad_id>')"""
+        thumbnail = self.make(content)
+        if thumbnail is None:
+            return None
+
+        if self.fs is not None:
+            for old in self.fs.find({'filename': ad_id}):
+                self.fs.delete(old._id)
+            self.fs.put(thumbnail, filename=ad_id, contentType='image/jpeg')
+            return f"{GRIDFS_PREFIX}{ad_id}"
+
+        path = os.path.join(self.directory, f"{ad_id}.jpg")
+        with open(path, 'wb') as f:
+            f.write(thumbnail)
+        return path
+
+
+def load_thumbnail(ref: Optional[str], db=None) -> Optional[bytes]:
+    """Read a thumbnail by the reference ThumbnailStore.save returned"""
+    if not ref:
+        return None
+    try:
+        if ref.startswith(GRIDFS_PREFIX):
+            import gridfs
+
+            return gridfs.GridFS(db, collection="thumbnails").get_last_version(ref[len(GRIDFS_PREFIX):]).read()
+        with open(ref, 'rb') as f:
+            return f.read()
+    except Exception as e:
+        logging.debug(f"Error loading thumbnail {ref}: {e}")
+        return None
@@ -0,0 +1,122 @@
+import json
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from metrics import REGISTRY, record_usage
+
+# USD per million tokens. Check against the providers' price lists when models change.
+PRICES = {
+    "claude-3-5-sonnet-20240620": {'input': 3.00, 'output': 15.00, 'cache_read': 0.30, 'cache_write': 3.75},
+    "gpt-4": {'input': 30.00, 'output': 60.00, 'cache_read': 30.00, 'cache_write': 30.00},
+    "text-embedding-ada-002": {'input': 0.10, 'output': 0.0, 'cache_read': 0.10, 'cache_write': 0.10},
+}
+
+TOKEN_KINDS = ('input', 'output', 'cache_read', 'cache_write')
+
+LLM_COST = REGISTRY.counter('ads_llm_cost_usd_total', 'Estimated LLM spend in USD', ['model', 'stage'])
+
+
+class BudgetExceeded(Exception):
+    """Raised before a model call that would take spend past the budget"""
+
+
+class UsageMeter:
+    """Run-level token and cost accounting per model and stage, with a spend budget.
+
+    ``throttle`` is called before each billable request. Past ``slow_at`` of the
+    budget it delays requests progressively, and it raises BudgetExceeded
+    when the next request's expected cost would cross the budget.
+    """
+
+    def __init__(self, budget_usd: Optional[float] = None, slow_at: float = 0.8, max_delay: float = 10.0, prices: Dict[str, Dict[str, float]] = None):
+        """
+        Args:
+            budget_usd (float): Spend ceiling for the run; None disables throttling
+            slow_at (float): Fraction of the budget after which requests are delayed
+            max_delay (float): Delay in seconds just below the ceiling
+            prices (dict): Model -> USD per million tokens by token kind (defaults to PRICES)
+        """
+        self.budget_usd = budget_usd
+        self.slow_at = slow_at
+        self.max_delay = max_delay
+        self.prices = prices or PRICES
+        # (model, stage) -> {'calls', 'cost', input/output/cache_read/cache_write tokens}
+        self.totals: Dict[tuple, Dict[str, float]] = {}
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.unpriced = set()
+
+    def cost_of(self, model: str, tokens: Dict[str, int]) -> float:
+        prices = self.prices.get(model)
+        if prices is None:
+            if model not in self.unpriced:
+                self.unpriced.add(model)
+                logging.warning(f"No price configured for {model}; counting its cost as 0")
+            return 0.0
+        return sum(tokens[kind] * prices.get(kind, 0.0) for kind in TOKEN_KINDS) / 1_000_000
+
+    def record(self, model: str, stage: str, usage) -> float:
+        """Account for one response's ``usage`` and return its cost in USD"""
+        tokens = record_usage(model, stage, usage)
+        cost = self.cost_of(model, tokens)
+        with self.lock:
+            entry = self.totals.setdefault((model, stage), {'calls': 0, 'cost': 0.0, **dict.fromkeys(TOKEN_KINDS, 0)})
+            entry['calls'] += 1
+            entry['cost'] += cost
+            for kind in TOKEN_KINDS:
+                entry[kind] += tokens[kind]
+        LLM_COST.inc(cost, model=model, stage=stage)
+        return cost
+
+    def spent(self, stage: str = None) -> float:
+        with self.lock:
+            return sum(entry['cost'] for (_, entry_stage), entry in self.totals.items() if stage is None or entry_stage == stage)
+
+    def expected_cost(self, stage: str) -> float:
+        """Mean cost of a billable call in this stage so far"""
+        with self.lock:
+            entries = [entry for (_, entry_stage), entry in self.totals.items() if entry_stage == stage]
+        calls = sum(entry['calls'] for entry in entries)
+        return sum(entry['cost'] for entry in entries) / calls if calls else 0.0
+
+    def throttle(self, stage: str):
+        """Delay or refuse a billable call in ``stage`` according to the budget"""
+        if self.budget_usd is None:
+            return
+        spent = self.spent()
+        if spent + self.expected_cost(stage) > self.budget_usd:
+            raise BudgetExceeded(f"Spent ${spent:.2f} of ${self.budget_usd:.2f}; next {stage} call would exceed the budget")
+
+        slow_from = self.slow_at * self.budget_usd
+        if spent > slow_from:
+            delay = self.max_delay * (spent - slow_from) / (self.budget_usd - slow_from)
+            logging.debug(f"Budget {spent / self.budget_usd:.0%} used; delaying {stage} by {delay:.1f}s")
+            time.sleep(delay)
+
+    def projection(self, done: int, pending: int, spent_before: float = 0.0) -> float:
+        """Projected run cost if the pending items cost what the ``done`` ones did on average"""
+        spent = self.spent()
+        if not done:
+            return spent
+        return spent + (spent - spent_before) / done * pending
+
+    def summary(self) -> Dict:
+        with self.lock:
+            by_model: Dict[str, Dict] = {}
+            for (model, stage), entry in self.totals.items():
+                model_entry = by_model.setdefault(model, {'cost_usd': 0.0, 'stages': {}})
+                model_entry['cost_usd'] = round(model_entry['cost_usd'] + entry['cost'], 6)
+                model_entry['stages'][stage] = {**entry, 'cost': round(entry['cost'], 6)}
+        total = self.spent()
+        return {
+            'cost_usd': round(total, 6),
+            'budget_usd': self.budget_usd,
+            'duration_s': round(time.time() - self.started_at, 3),
+            'models': by_model,
+        }
+
+    def write_summary(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
@@ -0,0 +1,269 @@
+import fcntl
+import json
+import logging
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+
+from artifacts import VectorLog
+
+MANIFEST_PATTERN = re.compile(r'^gen-(\d+)\.json$')
+WAL_PATTERN = re.compile(r'^wal-(\d+)\.(f32|ids)$')
+
+
+def _fsync_dir(directory: str):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_atomic(path: str, data: bytes):
+    """Write a file under a temporary name, fsync it and rename it into place"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    _fsync_dir(os.path.dirname(path) or ".")
+
+
+class VectorStore:
+    """Crash-safe, incremental persistence for the FAISS index.
+
+    Layout under ``root``:
+
+    - ``shards/shard-<n>.faiss`` / ``shard-<n>.ids.json``: immutable index shards and their ad IDs
+    - ``gen-<n>.json``: a generation's manifest, listing its shards in order
+    - ``CURRENT``: name of the published manifest, replaced with an atomic rename
+    - ``wal-<n>.f32`` / ``wal-<n>.ids``: vectors added on top of generation n
+    - ``rebuild.f32`` / ``rebuild.ids``: vectors of a rebuild after ``reset``, adopted only by ``compact``
+
+    ``append`` writes new vectors to the WAL and fsyncs them, so nothing it
+    returned for is lost in a crash. ``compact`` turns the WAL into one new
+    shard and publishes a generation that adds it. Persistence therefore costs
+    time proportional to the new vectors, not to the corpus. Once there are
+    more than ``max_shards`` shards, compaction merges them into one.
+
+    Readers only follow ``CURRENT`` to a complete manifest whose shards were
+    written before it. They never see a half-written index, or an index with
+    a mismatched ID list. Readers use ``load_generation``; ``open`` is for the
+    single writer and holds ``LOCK`` until ``close``, since the writer is also
+    the one removing shards no published generation lists.
+    """
+
+    def __init__(self, root: str = "vector_index", dimension: int = 1536, max_shards: int = 8, keep_generations: int = 3,
+                 legacy_index: str = "skincare_ads.index", legacy_ids: str = "ad_ids.json"):
+        """
+        Args:
+            root (str): Store directory
+            dimension (int): Vector dimension
+            max_shards (int): Shards a generation may list before compaction merges them
+            keep_generations (int): Published generations kept on disk for readers still loading them
+            legacy_index, legacy_ids (str): Single-file index imported as the first generation
+        """
+        self.root = root
+        self.dimension = dimension
+        self.max_shards = max_shards
+        self.keep_generations = keep_generations
+        self.legacy_index = legacy_index
+        self.legacy_ids = legacy_ids
+        self.shard_dir = os.path.join(root, "shards")
+        self.generation = 0
+        self.ntotal = 0
+        self.shards: List[str] = []
+        self.replaced = False
+        self.wal: Optional[VectorLog] = None
+        self._lock_file = None
+
+    def current(self) -> Optional[str]:
+        """Name of the published manifest, or None if nothing was published yet"""
+        try:
+            with open(os.path.join(self.root, "CURRENT"), "r") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def read_manifest(self, name: str) -> Dict:
+        with open(os.path.join(self.root, name), "r") as f:
+            return json.load(f)
+
+    def load_generation(self, name: str = None) -> Tuple[faiss.Index, List[str], Dict]:
+        """Load a published generation (the current one by default) as one in-memory index"""
+        manifest = self.read_manifest(name or self.current())
+        index, ad_ids = self._merge(manifest['shards'])
+        if index.ntotal != len(ad_ids):
+            raise ValueError(f"Generation {manifest['generation']} has {index.ntotal} vectors but {len(ad_ids)} IDs")
+        return index, ad_ids, manifest
+
+    def _acquire(self):
+        """Take the writer lock, failing if another process holds it"""
+        lock_file = open(os.path.join(self.root, "LOCK"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(f"Another process is writing the index in {self.root}; only one writer may open it")
+        self._lock_file = lock_file
+
+    def close(self):
+        """Release the writer lock"""
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def open(self) -> Tuple[faiss.Index, List[str]]:
+        """Load the current generation plus its WAL, for the process that writes the index"""
+        os.makedirs(self.shard_dir, exist_ok=True)
+        if self._lock_file is None:
+            self._acquire()
+        if self.current() is None:
+            self._import_legacy()
+
+        index, ad_ids, manifest = self.load_generation()
+        self.generation = manifest['generation']
+        self.shards = list(manifest['shards'])
+        self.ntotal = manifest['ntotal']
+        self.wal = VectorLog(os.path.join(self.root, f"wal-{self.generation:06d}"), self.dimension, durable=True)
+
+        rebuild = VectorLog(os.path.join(self.root, "rebuild"), self.dimension)
+        rebuild_ids, _ = rebuild.read()
+        if rebuild_ids or os.path.exists(rebuild.vectors_path):
+            # Never published, so the generation it was replacing is still the current one
+            logging.warning(f"Discarding {len(rebuild_ids)} vectors of an interrupted rebuild; run the rebuild again")
+            rebuild.remove()
+
+        wal_ids, wal_vectors = self.wal.read()
+        if wal_ids:
+            index.add(wal_vectors)
+            ad_ids.extend(wal_ids)
+            logging.info(f"Replayed {len(wal_ids)} vectors from the write-ahead log")
+        return index, ad_ids
+
+    @property
+    def wal_rows(self) -> int:
+        if self.wal.rows is None:
+            self.wal.rows = len(self.wal.read()[0])
+        return self.wal.rows
+
+    def append(self, ad_ids: List[str], vectors) -> int:
+        """Durably log vectors added to the in-memory index; returns the WAL's row count"""
+        self.wal.append(ad_ids, vectors)
+        return self.wal_rows
+
+    def _write_shard(self, name: str, index: faiss.Index, ad_ids: List[str]):
+        _write_atomic(os.path.join(self.shard_dir, f"{name}.faiss"), faiss.serialize_index(index).tobytes())
+        _write_atomic(os.path.join(self.shard_dir, f"{name}.ids.json"), json.dumps(ad_ids).encode('utf-8'))
+
+    def _publish(self, shards: List[str], ntotal: int):
+        """Write the next generation's manifest, point CURRENT at it and start its WAL"""
+        generation = self.generation + 1
+        name = f"gen-{generation:06d}.json"
+        _write_atomic(os.path.join(self.root, name), json.dumps({'generation': generation, 'shards': shards, 'ntotal': ntotal}).encode('utf-8'))
+        _write_atomic(os.path.join(self.root, "CURRENT"), f"{name}\n".encode('utf-8'))
+
+        previous_wal = self.wal
+        self.generation = generation
+        self.shards = shards
+        self.ntotal = ntotal
+        self.replaced = False
+        self.wal = VectorLog(os.path.join(self.root, f"wal-{generation:06d}"), self.dimension, durable=True)
+        if previous_wal is not None:
+            previous_wal.remove()
+        self._collect_garbage()
+        logging.info(f"Published index generation {generation} ({len(shards)} shards, {ntotal} vectors)")
+
+    def compact(self) -> bool:
+        """Fold the WAL into a new shard and publish it; False if there was nothing to fold"""
+        ad_ids, vectors = self.wal.read()
+        if not ad_ids and not self.replaced:
+            return False
+
+        shards = list(self.shards)
+        if ad_ids:
+            shard = f"shard-{self.generation + 1:06d}"
+            shard_index = faiss.IndexFlatL2(self.dimension)
+            shard_index.add(vectors)
+            self._write_shard(shard, shard_index, ad_ids)
+            shards.append(shard)
+
+        if len(shards) > self.max_shards:
+            merged = f"merged-{self.generation + 1:06d}"
+            index, merged_ids = self._merge(shards)
+            self._write_shard(merged, index, merged_ids)
+            shards = [merged]
+        self._publish(shards, self.ntotal + len(ad_ids))
+        return True
+
+    def _merge(self, shards: List[str]) -> Tuple[faiss.Index, List[str]]:
+        """Concatenate shards, in order, into one in-memory index"""
+        index = faiss.IndexFlatL2(self.dimension)
+        ad_ids: List[str] = []
+        for shard in shards:
+            index.merge_from(faiss.read_index(os.path.join(self.shard_dir, f"{shard}.faiss")))
+            with open(os.path.join(self.shard_dir, f"{shard}.ids.json"), "r") as f:
+                ad_ids.extend(json.load(f))
+        return index, ad_ids
+
+    def reset(self):
+        """Drop every vector; the next compaction publishes only what is appended after this
+
+        The published generation stays current until then, so readers keep
+        serving it while the index is rebuilt. Appends go to a separate
+        rebuild log instead of the generation's WAL, so a crash before the
+        compaction leaves the published generation and its WAL as they were.
+        """
+        self.wal = VectorLog(os.path.join(self.root, "rebuild"), self.dimension, durable=True)
+        self.wal.remove()
+        self.shards, self.ntotal = [], 0
+        self.replaced = True
+
+    def _import_legacy(self):
+        """Start from the single-file index if there is one, otherwise from an empty generation"""
+        os.makedirs(self.shard_dir, exist_ok=True)
+        shards, ntotal = [], 0
+        if os.path.exists(self.legacy_index) and os.path.exists(self.legacy_ids):
+            index = faiss.read_index(self.legacy_index)
+            with open(self.legacy_ids, "r") as f:
+                ad_ids = json.load(f)
+            if index.ntotal == len(ad_ids):
+                self._write_shard("shard-000001", index, ad_ids)
+                shards, ntotal = ["shard-000001"], index.ntotal
+                logging.info(f"Imported {ntotal} vectors from {self.legacy_index}")
+            else:
+                logging.warning(f"Not importing {self.legacy_index}: {index.ntotal} vectors but {len(ad_ids)} IDs")
+        self._publish(shards, ntotal)
+
+    def _collect_garbage(self):
+        """Remove generations older than the last keep_generations and shards none of those use
+
+        Only the writer calls this, right after publishing, so it never races
+        a shard that is written but not yet listed in a manifest.
+        """
+        manifests = sorted(name for name in os.listdir(self.root) if MANIFEST_PATTERN.match(name))
+        keep = manifests[-self.keep_generations:]
+        for name in manifests[:-self.keep_generations]:
+            os.remove(os.path.join(self.root, name))
+
+        used = set()
+        for name in keep:
+            used.update(self.read_manifest(name)['shards'])
+        for name in os.listdir(self.shard_dir):
+            shard = name.split('.', 1)[0]
+            if shard not in used:
+                os.remove(os.path.join(self.shard_dir, name))
+
+        for name in os.listdir(self.root):
+            match = WAL_PATTERN.match(name)
+            if match and int(match.group(1)) < self.generation:
+                os.remove(os.path.join(self.root, name))
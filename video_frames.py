@@ -0,0 +1,219 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import cv2
+import numpy as np
+import requests
+
+from creative_hash import dhash
+from metrics import CACHE_REQUESTS, STAGE_ERRORS, tracked
+
+
+class VideoKeyframer:
+    """Samples scene-change keyframes from the head of a video ad without downloading all of it"""
+
+    def __init__(self, cache_dir: str = "media_cache/keyframes", max_bytes: int = 4 * 1024 * 1024, max_frames: int = 3, max_samples: int = 40, sample_interval: float = 0.5, max_edge: int = 768, max_workers: int = 2, timeout: int = 15, proxies: Optional[Dict] = None):
+        """
+        Args:
+            cache_dir (str): Directory for extracted keyframes
+            max_bytes (int): Bytes requested with an HTTP Range header per video
+            max_frames (int): Keyframes kept per video
+            max_samples (int): Frames decoded per video while looking for scene changes
+            sample_interval (float): Seconds between sampled frames
+            max_edge (int): Longest edge of the stored keyframes
+            max_workers (int): Videos processed concurrently
+            timeout (int): Per-request timeout in seconds
+            proxies (dict): Optional requests proxy configuration
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.max_samples = max_samples
+        self.sample_interval = sample_interval
+        self.max_edge = max_edge
+        self.timeout = timeout
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.session = requests.Session()
+        if proxies:
+            self.session.proxies.update(proxies)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="keyframes")
+        self.pending: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+    def _cache_path(self, url: str) -> str:
+        # CDN URLs carry expiring signatures in the query string; the path identifies the video
+        key = hashlib.sha256(urlsplit(url).path.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def _download_head(self, url: str, path: str) -> bool:
+        """Stream at most max_bytes of the video into path"""
+        headers = {'Range': f"bytes=0-{self.max_bytes - 1}"}
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            written = 0
+            with open(path, 'wb') as f:
+                # Servers that ignore Range still get cut off at max_bytes
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk[:self.max_bytes - written])
+                    written += len(chunk)
+                    if written >= self.max_bytes:
+                        break
+        return written > 0
+
+    def _sample_frames(self, path: str) -> List[np.ndarray]:
+        """Decode evenly spaced frames and keep the first plus the strongest scene changes"""
+        capture = cv2.VideoCapture(path)
+        try:
+            fps = capture.get(cv2.CAP_PROP_FPS) or 25
+            step = max(1, int(fps * self.sample_interval))
+
+            samples = []
+            previous_hist = None
+            position = 0
+            while len(samples) < self.max_samples:
+                if position % step == 0:
+                    ok, frame = capture.read()
+                    if not ok:
+                        break
+                    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+                    hist = cv2.calcHist([hsv], [0, 1], None, [32, 32], [0, 180, 0, 256])
+                    cv2.normalize(hist, hist)
+                    change = 1.0 if previous_hist is None else 1.0 - cv2.compareHist(previous_hist, hist, cv2.HISTCMP_CORREL)
+                    samples.append((change, position, frame))
+                    previous_hist = hist
+                elif not capture.grab():  # advance without decoding unsampled frames to pixels
+                    break
+                position += 1
+        finally:
+            capture.release()
+
+        if not samples:
+            return []
+        first, rest = samples[0], samples[1:]
+        keyframes = [first] + sorted(rest, key=lambda s: s[0], reverse=True)[:self.max_frames - 1]
+        return [frame for _, _, frame in sorted(keyframes, key=lambda s: s[1])]
+
+    def _resize(self, frame: np.ndarray) -> np.ndarray:
+        height, width = frame.shape[:2]
+        scale = self.max_edge / max(height, width)
+        if scale >= 1:
+            return frame
+        return cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+    def _read_cached(self, cache_path: str) -> Optional[Tuple[List[str], Optional[str]]]:
+        """(frames, dHash) of a cached extraction, or None if it is missing or unreadable"""
+        try:
+            with open(os.path.join(cache_path, "meta.json"), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            frames = []
+            for name in meta['frames']:
+                with open(os.path.join(cache_path, name), 'rb') as f:
+                    frames.append(base64.b64encode(f.read()).decode('utf-8'))
+            return frames, meta['dhash']
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug(f"Unreadable keyframe cache {cache_path}, extracting again: {e}")
+            return None
+
+    def _store(self, cache_path: str, url: str, frames: List[bytes], creative_hash: str):
+        """Write the frames and meta.json to a temporary directory and rename it into place
+
+        The same video often runs under many ad IDs, so several workers can
+        extract it at once; readers only ever see a complete directory.
+        """
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            names = []
+            for i, frame in enumerate(frames):
+                name = f"frame-{i}.jpg"
+                with open(os.path.join(tmp_dir, name), 'wb') as f:
+                    f.write(frame)
+                names.append(name)
+            with open(os.path.join(tmp_dir, "meta.json"), 'w', encoding='utf-8') as f:
+                json.dump({'url': url, 'frames': names, 'dhash': creative_hash}, f)
+            try:
+                os.replace(tmp_dir, cache_path)
+            except OSError:
+                # Another worker published it first, or a broken entry is in the way
+                if self._read_cached(cache_path) is not None:
+                    return
+                shutil.rmtree(cache_path, ignore_errors=True)
+                os.replace(tmp_dir, cache_path)
+        except OSError as e:
+            logging.debug(f"Could not cache keyframes of {url}: {e}")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @tracked('video_keyframes')
+    def _extract(self, url: str) -> Tuple[List[str], Optional[str]]:
+        cache_path = self._cache_path(url)
+        cached = self._read_cached(cache_path)
+        if cached is not None:
+            CACHE_REQUESTS.inc(cache='keyframes', result='hit')
+            return cached
+
+        CACHE_REQUESTS.inc(cache='keyframes', result='miss')
+        fd, tmp_path = tempfile.mkstemp(suffix=".mp4")
+        os.close(fd)
+        try:
+            if not self._download_head(url, tmp_path):
+                return [], None
+            frames = [self._resize(frame) for frame in self._sample_frames(tmp_path)]
+        except Exception as e:
+            logging.debug(f"Error extracting keyframes: {e}")
+            STAGE_ERRORS.inc(stage='video_keyframes')
+            return [], None
+        finally:
+            os.remove(tmp_path)
+
+        if not frames:
+            return [], None
+
+        jpegs = []
+        for frame in frames:
+            ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
+            if ok:
+                jpegs.append(buffer.tobytes())
+
+        creative_hash = dhash(cv2.cvtColor(frames[0], cv2.COLOR_BGR2GRAY))
+        self._store(cache_path, url, jpegs, creative_hash)
+        return [base64.b64encode(jpeg).decode('utf-8') for jpeg in jpegs], creative_hash
+
+    def prefetch(self, urls: Iterable[str]):
+        """Start extracting keyframes in the background"""
+        with self.lock:
+            for url in urls:
+                if url and url not in self.pending:
+                    self.pending[url] = self.executor.submit(self._extract, url)
+
+    def discard(self, url: str):
+        """Forget a prefetch nobody will ask for, cancelling it if it hasn't started"""
+        with self.lock:
+            future = self.pending.pop(url, None)
+        if future is not None:
+            future.cancel()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def keyframes(self, url: str) -> Tuple[List[str], Optional[str]]:
+        """Return (base64 JPEG keyframes, dHash of the first keyframe) for a video URL"""
+        if not url:
+            return [], None
+        with self.lock:
+            future = self.pending.pop(url, None)
+        if future is not None:
+            return future.result()
+        return self._extract(url)
@@ -0,0 +1,353 @@
+"""Distributed pipeline workers sharing a MongoDB job queue
+
+    python workers.py enqueue --keywords skincare_keywords.csv
+    python workers.py run --role collect
+    python workers.py run --role enrich --budget-usd 20
+    python workers.py run --role embed
+    python workers.py run --role index
+    python workers.py stats
+
+Start as many collect, enrich and embed workers as the APIs' rate limits
+allow, on any number of machines pointed at the same MONGO_URI. Run a
+single index worker per index file.
+"""
+import argparse
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from ads_pipeline import AdsPipeline
+from jobqueue import DONE, LEASED, JobQueue
+from metrics import REGISTRY, STAGE_ITEMS
+from usage import BudgetExceeded
+
+# Job kinds each role leases, in priority order. Keywords are drained before
+# pages, so a page is usually fetched with every keyword that matches it.
+ROLES = {
+    'collect': ['keyword', 'page'],
+    'enrich': ['enrich'],
+    'embed': ['embed'],
+}
+
+
+class PipelineWorker:
+    """Runs one pipeline role against the shared job queue.
+
+    collect: 'keyword' jobs search for pages and enqueue a 'page' job per page;
+        'page' jobs fetch the page's ads into raw-ads and enqueue an 'enrich' job per ad.
+    enrich: analyses a raw ad, stores its document and enqueues an 'embed' job.
+    embed: stores the ad's embedding in ad-embeddings.
+    index: folds new embeddings into the local FAISS index. Not queue driven;
+        FAISS files aren't safe to write from several processes, so run one.
+
+    Jobs are keyed by keyword, page ID and ad ID, and every handler checks for
+    its own output before calling an API, so a job that is retried after a
+    crash or a lost lease doesn't pay for the same call twice. A keyword that
+    matches a page already fetched is added to that page's stored ads instead.
+    """
+
+    def __init__(self, pipeline: AdsPipeline, queue: JobQueue, role: str, worker_id: str = None, idle_sleep: float = 5.0, lake_batch: int = 100, neighbors_every: int = 1000):
+        """
+        Args:
+            pipeline (AdsPipeline): Pipeline providing the scraper, models, stores and optional lake
+            queue (JobQueue): Shared job queue
+            role (str): 'collect', 'enrich', 'embed' or 'index'
+            worker_id (str): Identifies this worker's leases (defaults to host-pid-random)
+            idle_sleep (float): Seconds to wait when no job is available
+            lake_batch (int): Enriched documents buffered per lake file
+            neighbors_every (int): New ads indexed before the index role extends the neighbour graph
+        """
+        if role not in ROLES and role != 'index':
+            raise ValueError(f"Unknown role {role}; expected one of {list(ROLES) + ['index']}")
+        self.pipeline = pipeline
+        self.queue = queue
+        self.role = role
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.idle_sleep = idle_sleep
+        self.logger = pipeline.logger
+        self.raw_ads = pipeline.db["raw-ads"]
+        self.embeddings = pipeline.db["ad-embeddings"]
+        self.handlers = {
+            'keyword': self.handle_keyword,
+            'page': self.handle_page,
+            'enrich': self.handle_enrich,
+            'embed': self.handle_embed,
+        }
+        self.processed = 0
+        self.synced_at: Optional[datetime] = None
+        # Enrich jobs produce one document each; they reach the lake in batches
+        self.lake_batch = lake_batch
+        self.lake_pending: List[Dict] = []
+        # Extending the graph rewrites all of it, so it is batched. Starts at 1 so the
+        # first idle sync picks up ads a previous worker indexed but never added.
+        self.neighbors_every = neighbors_every
+        self.neighbors_pending = 1
+
+    def ensure_indexes(self):
+        self.queue.ensure_indexes()
+        self.raw_ads.create_index('ad_id', unique=True)
+        self.raw_ads.create_index('page_id')
+        self.embeddings.create_index('ad_id', unique=True)
+        self.embeddings.create_index('created_at')
+
+    def handle_keyword(self, job: Dict):
+        keyword_info = job['payload']['keyword_info']
+        pages = self.pipeline.scraper.search_pages(query=keyword_info['Keyword'])
+        for page in pages:
+            # A page matched by several keywords is fetched once, tagged with all of them
+            if self.queue.enqueue('page', page['page_id'], {'page_id': page['page_id'], 'name': page.get('name')},
+                                  add_to_set={'keyword_infos': keyword_info}):
+                continue
+            # Already running or done: its ads may be stored without this keyword
+            existing = self.queue.get('page', page['page_id'])
+            if existing is not None and existing['status'] in (LEASED, DONE):
+                self.tag_page_ads(page['page_id'], [keyword_info])
+        self.logger.info(f"Keyword {keyword_info['Keyword']}: {len(pages)} pages")
+
+    def tag_page_ads(self, page_id: str, keyword_infos: List[Dict]):
+        """Add keywords and their categories to a page's stored raw ads and ad documents"""
+        keyword_infos = self.pipeline.clean_data(keyword_infos)
+        tags = {
+            'keyword_info': {'$each': keyword_infos},
+            'keywords': {'$each': list(dict.fromkeys(info['Keyword'] for info in keyword_infos))},
+            'categories': {'$each': list(dict.fromkeys(info['Category'] for info in keyword_infos))},
+        }
+        self.raw_ads.update_many({'page_id': page_id}, {'$addToSet': {f"ad.{field}": value for field, value in tags.items()}})
+        self.pipeline.collection.update_many({'advertiser_info.page_id': page_id}, {'$addToSet': tags})
+
+    def handle_page(self, job: Dict):
+        keyword_infos = job['payload']['keyword_infos']
+        edges = self.pipeline.fetch_page_ads(job['key'], keyword_infos)
+        new_ads, new_edges = [], []
+        collected_at = datetime.now(timezone.utc)
+        for edge in edges:
+            ad = edge['node']['collated_results'][0]
+            ad_id = ad.get('ad_archive_id')
+            if not ad_id:
+                continue
+            inserted = self.raw_ads.update_one(
+                {'ad_id': ad_id},
+                {'$setOnInsert': {'ad_id': ad_id, 'page_id': job['key'], 'ad': self.pipeline.clean_data(ad),
+                                  'collected_at': collected_at}},
+                upsert=True,
+            ).upserted_id is not None
+            if inserted:
+                new_edges.append(edge)
+            new_ads.append((ad_id, {}))
+        if self.pipeline.lake is not None and new_edges:
+            try:
+                self.pipeline.lake.write_raw(new_edges, collected_at=collected_at.isoformat())
+            except Exception as e:
+                self.logger.error(f"Error writing raw ads to the lake: {e}")
+        # Keywords that matched the page while it was being fetched
+        latest = self.queue.get('page', job['key'])
+        late = [info for info in (latest or {}).get('payload', {}).get('keyword_infos', []) if info not in keyword_infos]
+        if late:
+            self.tag_page_ads(job['key'], late)
+        added = self.queue.enqueue_many('enrich', new_ads)
+        STAGE_ITEMS.inc(added, stage='collect')
+        self.logger.info(f"Page {job['key']}: {len(edges)} ads, {added} new")
+
+    def handle_enrich(self, job: Dict):
+        ad_id = job['key']
+        if self.pipeline.collection.count_documents({'ad_id': ad_id}, limit=1) == 0:
+            raw = self.raw_ads.find_one({'ad_id': ad_id})
+            if raw is None:
+                raise ValueError(f"No raw ad stored for {ad_id}")
+            self.pipeline.prefetch_creatives([raw['ad']])
+            try:
+                doc = self.pipeline.process_ad(raw['ad'])
+            finally:
+                self.pipeline.release_creatives(raw['ad'])
+            if doc is None:
+                raise RuntimeError(f"Could not analyse ad {ad_id}")
+            doc = self.pipeline.clean_data(doc)
+            self.pipeline.collection.replace_one({'ad_id': ad_id}, doc, upsert=True)
+            # Keywords tagged onto the raw ad while it was being analysed
+            raw = self.raw_ads.find_one({'ad_id': ad_id}, {'ad.keyword_info': 1, 'ad.keywords': 1, 'ad.categories': 1})
+            tags = {field: {'$each': raw['ad'][field]} for field in ('keyword_info', 'keywords', 'categories') if raw['ad'].get(field)}
+            if tags:
+                self.pipeline.collection.update_one({'ad_id': ad_id}, {'$addToSet': tags})
+            if self.pipeline.lake is not None:
+                self.lake_pending.append(doc)
+                if len(self.lake_pending) >= self.lake_batch:
+                    self.flush_lake()
+        self.queue.enqueue('embed', ad_id)
+
+    def flush_lake(self):
+        """Write buffered enriched documents to the lake's processed table"""
+        if self.pipeline.lake is None or not self.lake_pending:
+            return
+        docs, self.lake_pending = self.lake_pending, []
+        try:
+            self.pipeline.lake.write_processed(docs)
+        except Exception as e:
+            self.logger.error(f"Error writing processed ads to the lake: {e}")
+
+    def handle_embed(self, job: Dict):
+        ad_id = job['key']
+        if self.embeddings.count_documents({'ad_id': ad_id}, limit=1):
+            return
+        doc = self.pipeline.collection.find_one({'ad_id': ad_id}, {'_id': 0, 'ad_info.title': 1, 'ad_info.body': 1, 'enriched_data': 1})
+        if doc is None:
+            raise ValueError(f"No enriched document for {ad_id}")
+        embedding = self.pipeline.get_embedding(self.pipeline.ad_text(doc))
+        if embedding is None:
+            raise RuntimeError(f"Could not embed ad {ad_id}")
+        self.embeddings.update_one(
+            {'ad_id': ad_id},
+            {'$set': {'embedding': embedding, 'created_at': datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+    def sync_index(self) -> int:
+        """Add embeddings stored since the last sync to the FAISS index and save it
+
+        The neighbour graph is extended every ``neighbors_every`` new ads, and
+        once ingest pauses (a sync that finds nothing new).
+        """
+        # Look back a little further than the last sync to allow for clock skew between workers
+        query = {'created_at': {'$gte': self.synced_at - timedelta(minutes=5)}} if self.synced_at else {}
+        started = datetime.now(timezone.utc)
+        known = set(self.pipeline.ad_ids)
+        vectors, ad_ids = [], []
+        for doc in self.embeddings.find(query, {'_id': 0, 'ad_id': 1, 'embedding': 1}):
+            if doc['ad_id'] not in known:
+                known.add(doc['ad_id'])
+                vectors.append(doc['embedding'])
+                ad_ids.append(doc['ad_id'])
+        if vectors:
+            self.pipeline.add_embeddings(vectors, ad_ids)
+            self.pipeline.save_index()
+            self.logger.info(f"Indexed {len(vectors)} new ads ({self.pipeline.index.ntotal} total)")
+            self.neighbors_pending += len(vectors)
+        if self.neighbors_pending >= self.neighbors_every or (self.neighbors_pending and not vectors):
+            self.pipeline.update_neighbors()
+            self.neighbors_pending = 0
+        self.synced_at = started
+        return len(vectors)
+
+    def run_once(self) -> bool:
+        """Lease and run one job; False when no job was available"""
+        job = self.queue.lease(ROLES[self.role], self.worker_id)
+        if job is None:
+            return False
+        handler = self.handlers[job['kind']]
+        with self.queue.keepalive(job):
+            try:
+                handler(job)
+            except BudgetExceeded:
+                self.queue.release(job)
+                raise
+            except Exception as e:
+                self.logger.error(f"{job['kind']} job {job['key']} failed (attempt {job['attempts']}): {e}")
+                self.queue.fail(job, str(e))
+                return True
+        if not self.queue.complete(job):
+            self.logger.warning(f"{job['kind']} job {job['key']} finished after its lease expired")
+        self.processed += 1
+        return True
+
+    def run(self, max_jobs: int = None, exit_when_idle: bool = False) -> int:
+        """Work until stopped, out of budget, ``max_jobs`` jobs ran, or idle with ``exit_when_idle``"""
+        self.logger.info(f"Worker {self.worker_id} running role {self.role}")
+        try:
+            self._work(max_jobs, exit_when_idle)
+        finally:
+            self.flush_lake()
+        self.logger.info(f"Worker {self.worker_id} ran {self.processed} jobs; LLM spend ${self.pipeline.usage.spent():.4f}")
+        return self.processed
+
+    def _work(self, max_jobs: Optional[int], exit_when_idle: bool):
+        while max_jobs is None or self.processed < max_jobs:
+            if self.role == 'index':
+                indexed = self.sync_index()
+                self.processed += indexed
+                if not indexed and exit_when_idle:
+                    break
+                time.sleep(self.idle_sleep)
+                continue
+
+            try:
+                worked = self.run_once()
+            except BudgetExceeded as e:
+                self.logger.warning(f"Worker {self.worker_id} stopping: {e}")
+                break
+            if not worked:
+                self.flush_lake()
+                if exit_when_idle:
+                    break
+                time.sleep(self.idle_sleep)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distributed Meta ads pipeline workers')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    enqueue = subparsers.add_parser('enqueue', help='Queue a keyword job for every row of the keywords CSV')
+    enqueue.add_argument('--keywords', default='skincare_keywords.csv', help='Keywords CSV file')
+
+    run = subparsers.add_parser('run', help='Run a worker')
+    run.add_argument('--role', required=True, choices=list(ROLES) + ['index'])
+    run.add_argument('--max-jobs', type=int, help='Stop after this many jobs')
+    run.add_argument('--exit-when-idle', action='store_true', help='Stop once the queue has no work for this role')
+    run.add_argument('--budget-usd', type=float, help="LLM spend ceiling for this worker")
+    run.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port')
+    run.add_argument('--neighbors-every', type=int, default=1000, help='Index role: new ads between neighbour graph updates')
+    run.add_argument('--lake-dir', default='lake', help='Parquet dataset receiving raw and processed ads (empty to disable)')
+
+    stats = subparsers.add_parser('stats', help='Print job counts by kind and status')
+    stats.add_argument('--retry-failed', action='store_true', help='Requeue jobs that ran out of attempts')
+
+    for subparser in (enqueue, run, stats):
+        subparser.add_argument('--lease-seconds', type=float, default=300, help='Job lease length')
+        subparser.add_argument('--max-attempts', type=int, default=5, help='Attempts before a job is marked failed')
+    args = parser.parse_args()
+
+    load_dotenv()
+    if getattr(args, 'metrics_port', None):
+        REGISTRY.serve(args.metrics_port)
+
+    # Workers on different machines share the LLM cache and thumbnails through MongoDB.
+    # Only the index role opens the FAISS store; it is its single writer.
+    pipeline = AdsPipeline(
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        anthropic_api_key=os.getenv("ANTHROPIC_API_KEY"),
+        mongo_uri=os.getenv("MONGO_URI"),
+        keywords_file=getattr(args, 'keywords', 'skincare_keywords.csv'),
+        use_proxy=True,
+        llm_cache_backend="mongo",
+        thumbnail_store="gridfs",
+        budget_usd=getattr(args, 'budget_usd', None),
+        lake_dir=getattr(args, 'lake_dir', None) or None,
+        index_mode='write' if getattr(args, 'role', None) == 'index' else 'off',
+    )
+    queue = JobQueue(pipeline.db["job-queue"], lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+
+    if args.command == 'enqueue':
+        queue.ensure_indexes()
+        keywords_data = pipeline.read_keywords_from_csv()
+        added = queue.enqueue_many('keyword', ((info['Keyword'], {'keyword_info': info}) for info in keywords_data))
+        logging.info(f"Queued {added} new keyword jobs ({len(keywords_data) - added} already queued)")
+    elif args.command == 'run':
+        worker = PipelineWorker(pipeline, queue, args.role, neighbors_every=args.neighbors_every)
+        worker.ensure_indexes()
+        try:
+            worker.run(max_jobs=args.max_jobs, exit_when_idle=args.exit_when_idle)
+        finally:
+            pipeline.close()
+    elif args.command == 'stats':
+        if args.retry_failed:
+            logging.info(f"Requeued {queue.retry_failed()} failed jobs")
+        for kind, statuses in sorted(queue.counts().items()):
+            print(f"{kind:10s} " + "  ".join(f"{status}={count}" for status, count in sorted(statuses.items())))
+
+
+if __name__ == "__main__":
+    main()